@@ -0,0 +1,248 @@
+"""Network emulator proxy for exercising the UDP protocol.
+
+Sits between the client and the server and impairs datagrams in each direction
+with configurable loss, duplication, reordering, latency/jitter and a bandwidth
+cap with a bounded queue. All random decisions come from seeded generators, so a
+run with the same seed and traffic makes the same decisions. Download data
+ports announced by the server ("OK <name> SIZE <n> PORT <p>") are proxied as
+well, with the port rewritten, so whole transfers go through the emulator.
+
+Use it from scripts:
+
+    proxy = NetemProxy("127.0.0.1", 51234, loss=0.02, latency_ms=10, seed=7).start()
+    ... point the client at ("127.0.0.1", proxy.listen_port) ...
+    print(proxy.stats())
+    proxy.stop()
+
+or standalone:
+
+    python3 bench/netem.py --listen 9000 --upstream localhost:51234 --loss 0.05 --jitter-ms 20
+"""
+import argparse
+import heapq
+import itertools
+import json
+import random
+import re
+import select
+import socket
+import sys
+import threading
+import time
+from dataclasses import dataclass, asdict
+
+PORT_REPLY = re.compile(rb"^(OK \S+ SIZE \d+ PORT )(\d+)$")
+
+
+@dataclass
+class Impairment:
+    """Impairments applied to one direction of traffic"""
+    loss: float = 0.0         # probability a datagram is dropped
+    duplicate: float = 0.0    # probability a datagram is delivered twice
+    reorder: float = 0.0      # probability a datagram is held back by reorder_ms
+    reorder_ms: float = 10.0
+    latency_ms: float = 0.0   # fixed one-way delay
+    jitter_ms: float = 0.0    # uniform extra delay in [0, jitter_ms]
+    rate_kbps: float = 0.0    # bandwidth cap in kbit/s, 0 = unlimited
+    queue_ms: float = 200.0   # datagrams that would wait longer than this for the link are dropped
+
+
+class _Link:
+    """One direction: seeded random decisions plus serialisation on a rate-limited link."""
+
+    def __init__(self, impairment: Impairment, rng: random.Random):
+        self.impairment = impairment
+        self.rng = rng
+        self.free_at = 0.0
+
+    def schedule(self, now: float, size: int) -> list:
+        """Return the delivery times for one datagram (empty if dropped), plus what happened"""
+        imp = self.impairment
+        if imp.loss and self.rng.random() < imp.loss:
+            return [], "dropped"
+        copies = 2 if imp.duplicate and self.rng.random() < imp.duplicate else 1
+        event = "duplicated" if copies == 2 else None
+        times = []
+        for _ in range(copies):
+            depart = now
+            if imp.rate_kbps:
+                start = max(now, self.free_at)
+                if start - now > imp.queue_ms / 1000.0:
+                    return times, "queue_dropped" if not times else event
+                self.free_at = start + size * 8 / (imp.rate_kbps * 1000.0)
+                depart = self.free_at
+            delay = imp.latency_ms / 1000.0
+            if imp.jitter_ms:
+                delay += self.rng.uniform(0, imp.jitter_ms) / 1000.0
+            if imp.reorder and self.rng.random() < imp.reorder:
+                delay += imp.reorder_ms / 1000.0
+                event = event or "reordered"
+            times.append(depart + delay)
+        return times, event
+
+
+class NetemProxy:
+    """Forward datagrams between local listeners and an upstream server through impaired links."""
+
+    def __init__(self, upstream_host: str, upstream_port: int, listen_port: int = 0,
+                 up: Impairment = None, down: Impairment = None, seed: int = None,
+                 listen_host: str = "127.0.0.1", follow_data_ports: bool = True, **impairment):
+        """up/down configure each direction separately; plain keyword arguments such as
+        loss=0.01 or latency_ms=5 apply the same Impairment to both directions."""
+        self.upstream_host = socket.gethostbyname(upstream_host)
+        self.listen_host = listen_host
+        self.follow_data_ports = follow_data_ports
+        self.seed = seed
+        self.up = _Link(up or Impairment(**impairment), random.Random(f"{seed}-up"))
+        self.down = _Link(down or Impairment(**impairment), random.Random(f"{seed}-down"))
+        self._listeners = {}  # listener socket -> upstream port
+        self._data_ports = {}  # upstream data port -> local listener port
+        self._flows = {}  # (listener, client addr) -> upstream socket
+        self._upstreams = {}  # upstream socket -> (listener, client addr)
+        self._flow_stats = {}  # flow name -> counters
+        self._pending = []  # heap of (due time, seq, socket, data, address)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self.listen_port = self._add_listener(upstream_port, listen_port)
+
+    def _add_listener(self, upstream_port: int, listen_port: int = 0) -> int:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.listen_host, listen_port))
+        self._listeners[sock] = upstream_port
+        return sock.getsockname()[1]
+
+    def start(self) -> "NetemProxy":
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout=2)
+        for sock in list(self._listeners) + list(self._upstreams):
+            sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def stats(self) -> dict:
+        """Per-flow counters plus totals, keyed '<client ip>:<port> -> <upstream port>'"""
+        with self._lock:
+            flows = {name: dict(counters) for name, counters in self._flow_stats.items()}
+        totals = {}
+        for counters in flows.values():
+            for key, value in counters.items():
+                totals[key] = totals.get(key, 0) + value
+        return {"seed": self.seed, "up": asdict(self.up.impairment), "down": asdict(self.down.impairment),
+                "totals": totals, "flows": flows}
+
+    def _count(self, flow: str, direction: str, size: int, event: str, delivered: int) -> None:
+        with self._lock:
+            counters = self._flow_stats.setdefault(flow, {})
+            for key, value in ((f"{direction}_packets", 1), (f"{direction}_bytes", size),
+                               (f"{direction}_delivered", delivered)):
+                counters[key] = counters.get(key, 0) + value
+            if event:
+                counters[f"{direction}_{event}"] = counters.get(f"{direction}_{event}", 0) + 1
+
+    def _forward(self, link: _Link, direction: str, flow: str, sock, data: bytes, address) -> None:
+        times, event = link.schedule(time.monotonic(), len(data))
+        self._count(flow, direction, len(data), event, len(times))
+        for due in times:
+            heapq.heappush(self._pending, (due, next(self._seq), sock, data, address))
+
+    def _run(self) -> None:
+        while self._running:
+            now = time.monotonic()
+            while self._pending and self._pending[0][0] <= now:
+                _, _, sock, data, address = heapq.heappop(self._pending)
+                try:
+                    sock.sendto(data, address)
+                except OSError:
+                    pass
+            wait = (self._pending[0][0] - now) if self._pending else 0.05
+            try:
+                readable, _, _ = select.select(list(self._listeners) + list(self._upstreams), [], [],
+                                               max(0.0, min(wait, 0.05)))
+            except (OSError, ValueError):
+                break  # sockets closed by stop()
+            for sock in readable:
+                try:
+                    data, address = sock.recvfrom(65535)
+                except OSError:
+                    continue
+                if sock in self._listeners:
+                    upstream_port = self._listeners[sock]
+                    upstream = self._flows.get((sock, address))
+                    if upstream is None:
+                        # 每个客户端流使用独立的上游套接字，服务器看到的地址各不相同
+                        upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        upstream.bind((self.listen_host, 0))
+                        self._flows[(sock, address)] = upstream
+                        self._upstreams[upstream] = (sock, address)
+                    flow = f"{address[0]}:{address[1]} -> {upstream_port}"
+                    self._forward(self.up, "up", flow, upstream, data, (self.upstream_host, upstream_port))
+                elif sock in self._upstreams:
+                    listener, client_address = self._upstreams[sock]
+                    flow = f"{client_address[0]}:{client_address[1]} -> {self._listeners[listener]}"
+                    match = PORT_REPLY.match(data) if self.follow_data_ports else None
+                    if match:
+                        # 为服务器新开的数据端口建立对应的代理端口
+                        upstream_data_port = int(match.group(2))
+                        local_port = self._data_ports.get(upstream_data_port)
+                        if local_port is None:
+                            local_port = self._data_ports[upstream_data_port] = self._add_listener(upstream_data_port)
+                        data = match.group(1) + str(local_port).encode()
+                    self._forward(self.down, "down", flow, listener, data, client_address)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="UDP network emulator proxy for UDP-Localsend")
+    parser.add_argument("--listen", type=int, default=0, help="local port clients connect to (default: random)")
+    parser.add_argument("--listen-host", default="127.0.0.1")
+    parser.add_argument("--upstream", default="127.0.0.1:51234", help="server host:port")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--stats-interval", type=float, default=0, help="print JSON stats every N seconds")
+    parser.add_argument("--no-follow-data-ports", action="store_true",
+                        help="do not proxy download data ports announced by the server")
+    for field, default in asdict(Impairment()).items():
+        option = field.replace("_", "-")
+        parser.add_argument(f"--{option}", type=float, default=default, help=f"both directions (default: {default})")
+        parser.add_argument(f"--up-{option}", type=float, help="client -> server only")
+        parser.add_argument(f"--down-{option}", type=float, help="server -> client only")
+    args = parser.parse_args()
+
+    def impairment(direction: str) -> Impairment:
+        values = {}
+        for field in asdict(Impairment()):
+            specific = getattr(args, f"{direction}_{field}")
+            values[field] = specific if specific is not None else getattr(args, field)
+        return Impairment(**values)
+
+    host, port = args.upstream.rsplit(":", 1)
+    proxy = NetemProxy(host, int(port), args.listen, up=impairment("up"), down=impairment("down"),
+                       seed=args.seed, listen_host=args.listen_host,
+                       follow_data_ports=not args.no_follow_data_ports).start()
+    print(f"[netem] {args.listen_host}:{proxy.listen_port} -> {args.upstream} (seed={args.seed})", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(args.stats_interval or 3600)
+            if args.stats_interval:
+                print(json.dumps(proxy.stats()), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.stop()
+        print(json.dumps(proxy.stats(), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,375 @@
+"""Reproducible benchmarks for UDP-Localsend.
+
+Each workload starts a fresh server.py on loopback in a temporary directory,
+generates a synthetic data set and drives it with the asyncio client,
+optionally through the bench/netem.py network emulator. Results are printed as JSON so
+runs can be compared across commits:
+
+    python3 bench/run_bench.py --quick
+    python3 bench/run_bench.py --workloads huge,sync_modified --loss 0.01 --latency-ms 2 -o before.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import client  # noqa: E402
+from netem import Impairment, NetemProxy  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class BenchServer:
+    """server.py running in its own temporary directory, with /proc based resource readings."""
+
+    def __init__(self, workdir: Path, server_args: list):
+        self.workdir = workdir
+        self.port = free_port()
+        self.base_dir = workdir / "serverfile"
+        self.mcast_port = free_port()  # 每个服务器使用自己的组播端口，互不干扰
+        self.process = subprocess.Popen(
+            [sys.executable, str(REPO_ROOT / "server.py"), str(self.port), "--log-level", "WARNING",
+             "--mcast-port", str(self.mcast_port), "--mcast-interface", "127.0.0.1", *server_args],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._wait_ready()
+
+    def _wait_ready(self) -> None:
+        deadline = time.monotonic() + 10
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(0.2)
+            while time.monotonic() < deadline:
+                sock.sendto(b"LIST_FILES", ("127.0.0.1", self.port))
+                try:
+                    sock.recvfrom(65535)
+                    return
+                except socket.timeout:
+                    continue
+        raise RuntimeError("server did not start")
+
+    def cpu_seconds(self):
+        try:
+            fields = Path(f"/proc/{self.process.pid}/stat").read_text().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def peak_rss_kb(self):
+        try:
+            for line in Path(f"/proc/{self.process.pid}/status").read_text().splitlines():
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def stop(self) -> None:
+        self.process.terminate()  # lets a --workers supervisor stop its workers
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def write_tree(root: Path, files: list, rng: random.Random) -> int:
+    """Create (relative path, size) files under root with random content; returns total bytes"""
+    total = 0
+    for rel_path, size in files:
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(rng.randbytes(size))
+        total += size
+    return total
+
+
+async def bench_huge(ctx) -> dict:
+    size = ctx.args.huge_mb * 1024 * 1024
+    source = ctx.data_dir / "huge.bin"
+    write_tree(ctx.data_dir, [("huge.bin", size)], ctx.rng)
+    start = time.perf_counter()
+    await ctx.client.upload(source, "huge.bin")
+    upload_seconds = time.perf_counter() - start
+
+    target = ctx.data_dir / "huge.download"
+    start = time.perf_counter()
+    await ctx.client.download("huge.bin", target)
+    download_seconds = time.perf_counter() - start
+    ok = client.calculate_md5(source) == client.calculate_md5(target)
+    return {"bytes": size, "verified": ok,
+            "upload_seconds": upload_seconds, "upload_mb_s": size / 1048576 / upload_seconds,
+            "download_seconds": download_seconds, "download_mb_s": size / 1048576 / download_seconds}
+
+
+async def bench_tiny(ctx) -> dict:
+    count = ctx.args.tiny_count
+    files = [(f"tiny/{i:06d}.txt", ctx.rng.randint(16, 1024)) for i in range(count)]
+    total = write_tree(ctx.data_dir, files, ctx.rng)
+    latencies = []
+    semaphore = asyncio.Semaphore(ctx.args.jobs)
+
+    async def upload(rel_path):
+        async with semaphore:
+            start = time.perf_counter()
+            await ctx.client.upload(ctx.data_dir / rel_path, Path(rel_path).name)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(upload(rel_path) for rel_path, _ in files))
+    seconds = time.perf_counter() - start
+    return {"files": count, "bytes": total, "seconds": seconds, "files_s": count / seconds,
+            "mb_s": total / 1048576 / seconds,
+            "p50_latency_s": percentile(latencies, 0.50), "p99_latency_s": percentile(latencies, 0.99)}
+
+
+async def bench_deep(ctx) -> dict:
+    depth, per_level = ctx.args.deep_depth, ctx.args.deep_files
+    files = []
+    level_dir = Path("deep")
+    for level in range(depth):
+        level_dir = level_dir / f"level{level:02d}"
+        files += [(str(level_dir / f"file{i:03d}.dat"), ctx.rng.randint(512, 8192)) for i in range(per_level)]
+    total = write_tree(ctx.data_dir, files, ctx.rng)
+    start = time.perf_counter()
+    summary = await ctx.client.sync(ctx.data_dir / "deep", "deep")
+    seconds = time.perf_counter() - start
+    return {"files": len(files), "depth": depth, "bytes": total, "seconds": seconds,
+            "files_s": len(files) / seconds, "failed": len(summary["failed"])}
+
+
+async def bench_sync_modified(ctx) -> dict:
+    count = ctx.args.sync_files
+    files = [(f"proj/dir{i % 20:02d}/file{i:05d}.bin", 4096) for i in range(count)]
+    write_tree(ctx.data_dir, files, ctx.rng)
+    root = ctx.data_dir / "proj"
+
+    start = time.perf_counter()
+    await ctx.client.sync(root, "proj")
+    initial_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await ctx.client.sync(root, "proj")
+    unchanged_seconds = time.perf_counter() - start
+
+    modified = ctx.rng.sample(files, max(1, count // 10))
+    write_tree(ctx.data_dir, modified, ctx.rng)
+    start = time.perf_counter()
+    summary = await ctx.client.sync(root, "proj")
+    modified_seconds = time.perf_counter() - start
+    return {"files": count, "modified": len(modified), "uploaded": summary["uploaded"],
+            "initial_seconds": initial_seconds, "unchanged_seconds": unchanged_seconds,
+            "modified_seconds": modified_seconds, "files_s": count / initial_seconds}
+
+
+async def bench_listing(ctx) -> dict:
+    listing_dir = ctx.server.base_dir / "listing"
+    listing_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(ctx.args.list_entries):
+        (listing_dir / f"entry{i:05d}.txt").touch()
+    await ctx.client.cd("listing")
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(ctx.args.list_repeats):
+        op_start = time.perf_counter()
+        entries = await ctx.client.list()
+        latencies.append(time.perf_counter() - op_start)
+    seconds = time.perf_counter() - start
+    await ctx.client.cd("..")
+    return {"entries": len(entries), "requests": len(latencies), "seconds": seconds,
+            "lists_s": len(latencies) / seconds,
+            "p50_latency_s": percentile(latencies, 0.50), "p99_latency_s": percentile(latencies, 0.99)}
+
+
+async def bench_multicast(ctx) -> dict:
+    size = ctx.args.mcast_mb * 1024 * 1024
+    count = ctx.args.mcast_receivers
+    source = ctx.data_dir / "mcast.bin"
+    write_tree(ctx.data_dir, [("mcast.bin", size)], ctx.rng)
+    await ctx.client.upload(source, "mcast.bin")
+
+    group = f"{client.MCAST_GROUP.rpartition(':')[0]}:{ctx.server.mcast_port}"
+    receivers = [subprocess.Popen(
+        [sys.executable, str(REPO_ROOT / "client.py"), "mcast-recv", str(ctx.data_dir / f"recv{i}"),
+         "--group", group, "--interface", "127.0.0.1", "--wait", "30"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True) for i in range(count)]
+    await asyncio.sleep(1.0)  # 等所有接收端加入组播组
+    before = (await ctx.client.stats())["counters"]
+    start = time.perf_counter()
+    await ctx.client.publish("mcast.bin")
+    outputs = await asyncio.gather(*(asyncio.to_thread(p.communicate, timeout=120) for p in receivers))
+    seconds = time.perf_counter() - start
+    await asyncio.sleep(client.MCAST_NACK_INTERVAL)
+    after = (await ctx.client.stats())["counters"]
+
+    digest = client.calculate_md5(source)
+    received = [client.calculate_md5(ctx.data_dir / f"recv{i}" / "mcast.bin")
+                if (ctx.data_dir / f"recv{i}" / "mcast.bin").is_file() else None for i in range(count)]
+    egress = after.get("mcast_bytes_total", 0) - before.get("mcast_bytes_total", 0)
+    result = {"bytes": size, "receivers": count, "verified": all(md5 == digest for md5 in received),
+              "seconds": seconds, "mb_s": size / 1048576 / seconds, "egress_bytes": egress,
+              "egress_per_receiver": egress / (size * count),
+              "nacks": after.get("mcast_nacks_total", 0) - before.get("mcast_nacks_total", 0),
+              "repairs": after.get("mcast_repairs_total", 0) - before.get("mcast_repairs_total", 0),
+              "receiver_exit_codes": [p.returncode for p in receivers]}
+    # 组播的意义在于服务器只发一份：出口字节必须明显少于逐个单播的总量
+    if not result["verified"] or egress >= size * count:
+        raise RuntimeError(f"multicast check failed: {json.dumps(result)} {outputs[0][0][-500:]!r}")
+    return result
+
+
+WORKLOADS = {
+    "huge": bench_huge,
+    "tiny": bench_tiny,
+    "deep": bench_deep,
+    "sync_modified": bench_sync_modified,
+    "listing": bench_listing,
+    "multicast": bench_multicast,
+}
+
+
+class Context:
+    def __init__(self, args, server: BenchServer, data_dir: Path, client_obj, rng: random.Random):
+        self.args = args
+        self.server = server
+        self.data_dir = data_dir
+        self.client = client_obj
+        self.rng = rng
+
+
+def run_workload(name: str, args) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix=f"udpls-bench-{name}-"))
+    # 默认测量 UDP 协议本身；--local 时改测本机快速通道
+    server = BenchServer(workdir, args.server_arg + ([] if args.local else ["--no-local"]))
+    proxy = None
+    port = server.port
+    impairment = Impairment(loss=args.loss, duplicate=args.duplicate, reorder=args.reorder,
+                            latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_kbps=args.rate_kbps)
+    if impairment != Impairment():
+        proxy = NetemProxy("127.0.0.1", server.port, up=impairment, down=impairment, seed=args.seed).start()
+        port = proxy.listen_port
+    data_dir = workdir / "data"
+    data_dir.mkdir()
+    rng = random.Random(args.seed)
+
+    async def run():
+        async with client.AsyncClient("127.0.0.1", port, timeout=args.timeout,
+                                      max_concurrency=args.jobs) as c:
+            return await WORKLOADS[name](Context(args, server, data_dir, c, rng))
+
+    cpu_start = time.process_time()
+    server_cpu_start = server.cpu_seconds()
+    wall_start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = asyncio.run(run())
+        result["ok"] = True
+    except Exception as e:
+        result = {"ok": False, "error": str(e)}
+    finally:
+        result["wall_seconds"] = time.perf_counter() - wall_start
+        result["client_cpu_seconds"] = time.process_time() - cpu_start
+        server_cpu = server.cpu_seconds()
+        result["server_cpu_seconds"] = (server_cpu - server_cpu_start
+                                        if server_cpu is not None and server_cpu_start is not None else None)
+        result["server_peak_rss_kb"] = server.peak_rss_kb()
+        result["client_peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if proxy:
+            proxy.stop()
+            result["network"] = proxy.stats()["totals"]
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help=f"comma separated subset of: {', '.join(WORKLOADS)}")
+    parser.add_argument("--quick", action="store_true", help="small data sets for a smoke run")
+    parser.add_argument("--huge-mb", type=int, default=64)
+    parser.add_argument("--tiny-count", type=int, default=10000)
+    parser.add_argument("--deep-depth", type=int, default=40)
+    parser.add_argument("--deep-files", type=int, default=10)
+    parser.add_argument("--sync-files", type=int, default=2000)
+    parser.add_argument("--list-entries", type=int, default=1000)
+    parser.add_argument("--list-repeats", type=int, default=200)
+    parser.add_argument("--mcast-mb", type=int, default=32)
+    parser.add_argument("--mcast-receivers", type=int, default=3, help="mcast-recv processes in the multicast workload")
+    parser.add_argument("--jobs", type=int, default=8, help="concurrent client operations")
+    parser.add_argument("--timeout", type=float, default=1.0, help="client request timeout")
+    parser.add_argument("--loss", type=float, default=0.0, help="datagram loss probability (via proxy)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="one-way added latency (via proxy)")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="uniform extra one-way delay (via proxy)")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="datagram duplication probability")
+    parser.add_argument("--reorder", type=float, default=0.0, help="datagram reordering probability")
+    parser.add_argument("--rate-kbps", type=float, default=0.0, help="bandwidth cap per direction")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--local", action="store_true",
+                        help="let transfers use the same-host Unix socket fast path instead of UDP")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="extra argument passed to server.py (repeatable), e.g. --server-arg=--dedup")
+    parser.add_argument("-o", "--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+    if args.quick:
+        args.huge_mb, args.tiny_count, args.deep_depth = 4, 300, 10
+        args.deep_files, args.sync_files, args.list_repeats, args.mcast_mb = 5, 200, 50, 2
+
+    names = [n.strip() for n in args.workloads.split(",") if n.strip()]
+    unknown = [n for n in names if n not in WORKLOADS]
+    if unknown:
+        parser.error(f"unknown workload(s): {', '.join(unknown)}")
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "workloads")},
+        "results": {},
+    }
+    for name in names:
+        print(f"[bench] running {name}...", file=sys.stderr)
+        report["results"][name] = run_workload(name, args)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    return 0 if all(r.get("ok") for r in report["results"].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
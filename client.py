@@ -3,13 +3,34 @@ import os
 import base64
 import time
 import sys
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import hashlib # <-- 新增
 import json    # <-- 新增
+import mmap
+import asyncio
+import argparse
+import contextlib
+import shlex
+import logging
+import threading
+import zlib
+import errno
+import re
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from localsend_common import (
+    METRICS, PROFILER, CDC_MIN_FILE_SIZE, cdc_chunks, is_zero_block, update_md5_zeros,
+    IgnoreRules, walk_tree, is_local_address, copy_file_data, partial_path,
+)
 
 
 CONFIG_FILE = "sync_config.json"
 
+logger = logging.getLogger("udp_localsend.client")
+METRICS.prefix = "udp_localsend_client"
+
 def load_sync_config() -> list:
     """从配置文件加载同步对。"""
     if not Path(CONFIG_FILE).is_file():
@@ -26,84 +47,350 @@ def save_sync_config(config: list):
     with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
         json.dump(config, f, indent=2)
 
-# Create client_files directory at program start
-Path("client_files").mkdir(exist_ok=True)
-
 def calculate_md5(file_path: Path) -> str:
     """计算文件的 MD5 哈希值"""
     hash_md5 = hashlib.md5()
+    start = time.perf_counter()
+    size = 0
     with file_path.open("rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(65536), b""):
             hash_md5.update(chunk)
+            size += len(chunk)
+    METRICS.inc("hash_bytes_total", size)
+    METRICS.inc("hash_seconds_total", time.perf_counter() - start)
     return hash_md5.hexdigest()
 
-def generate_md5_manifest(directory: str) -> dict:
-    """生成包含 {路径: MD5值} 的字典清单"""
+CDC_RECIPE_BATCH = 64  # recipe entries offered per datagram
+CDC_INDEX_POLL = 0.2  # seconds between CDC_BEGIN/CDC_COMMIT retries while the server indexes or reassembles
+CDC_INDEX_WAIT = 300.0  # give up on a chunked upload if indexing or reassembly takes longer than this
+
+def compute_cdc_recipe(file_path: Path) -> list:
+    """Return [(offset, length, sha256)] for the content-defined chunks of a file"""
+    with file_path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return [(off, length, hashlib.sha256(data[off:off + length]).hexdigest())
+                for off, length in cdc_chunks(data)]
+
+def generate_md5_manifest(directory: str, ignore: IgnoreRules = None) -> dict:
+    """生成包含 {路径: MD5值} 的字典清单；被忽略的目录不会被遍历"""
+    with PROFILER.section("manifest", Path(directory).name):
+        return _generate_md5_manifest(directory, ignore)
+
+def _generate_md5_manifest(directory: str, ignore: IgnoreRules = None) -> dict:
     manifest = {}
-    base_dir = Path(directory)
     try:
-        for item in base_dir.rglob('*'):
-            if item.is_file():
-                relative_path = str(item.relative_to(base_dir)).replace(os.path.sep, '/')
-                manifest[relative_path] = calculate_md5(item)
-                print(f"Debug: Added to client manifest - {relative_path}: {manifest[relative_path]}")
+        for entry in walk_tree(directory, ignore):
+            if not entry.is_dir:
+                manifest[entry.rel_path] = calculate_md5(Path(entry.path))
+                logger.debug("Added to client manifest - %s: %s", entry.rel_path, manifest[entry.rel_path])
     except Exception as e:
         print(f"Error generating client manifest: {e}")
     return manifest
 
-def sendAndReceive(sock, message, server_address, timeout=1.0, max_retries=5):
+def manifest_payload(manifest: dict, ignore: IgnoreRules = None) -> str:
+    """JSON sent in SYNC_CHUNKs: a v2 manifest carrying the ignore rules, so the server
+    skips (and never deletes) the same paths"""
+    return json.dumps({"version": 2, "files": manifest, "ignore": ignore.patterns if ignore else []})
+
+def sendAndReceive(sock, message, server_address, timeout=1.0, max_retries=5, expect=None):
+    """Send a message and wait for its response; replies not starting with one of the
+    `expect` prefixes are late duplicates of earlier replies and are skipped."""
+    payload = message.encode('utf-8')
+    command = message.split(' ', 1)[0].split('\n', 1)[0]
+    start = time.perf_counter()
     for attempt in range(max_retries):
         try:
             sock.settimeout(timeout)
-            sock.sendto(message.encode('utf-8'), server_address)
-            
-            response_bytes, addr = sock.recvfrom(4096)
+            sock.sendto(payload, server_address)
+            METRICS.inc("packets_out_total")
+            METRICS.inc("bytes_out_total", len(payload))
+
+            response_bytes, addr = sock.recvfrom(65535)
+            METRICS.inc("packets_in_total")
+            METRICS.inc("bytes_in_total", len(response_bytes))
+            while expect and not response_bytes.decode('utf-8', 'replace').startswith(expect):
+                METRICS.inc("stale_replies_total")
+                response_bytes, addr = sock.recvfrom(65535)
+            METRICS.observe("request_seconds", time.perf_counter() - start, command=command)
             return response_bytes.decode('utf-8'), addr
 
         except socket.timeout:
+            METRICS.inc("retransmits_total")
             if attempt < max_retries - 1:
-                print(f"*** Timeout after {timeout:.1f}s. Retrying... ({attempt + 1}/{max_retries}) ***")
+                logger.warning("*** Timeout after %.1fs. Retrying... (%s/%s) ***", timeout, attempt + 1, max_retries)
                 continue
             else:
                 raise Exception(f"Server not responding after {max_retries} attempts.")
 
-def _perform_upload(sock, server_address, local_path: Path, remote_path: str, verbose: bool = True) -> bool:
+DATA_RETRIES = 5  # resends of one chunk after a checksum error or a stale reply
+SERVER_BUSY = "server syncing , plz wait"  # the target folder is locked by a running sync
+UPLOAD_READY_REPLIES = ("UPLOAD_READY", "ERR", SERVER_BUSY)
+UPLOAD_SIZE_REPLIES = ("ACK_SIZE", "ERR")
+DATA_REPLIES = ("ACK_DATA", "NACK_DATA", "ERR")
+CDC_DATA_REPLIES = ("ACK_DATA", "CDC_ERR", "ERR")
+CDC_COMMIT_REPLIES = ("CDC_DONE", "CDC_COMMITTING", "CDC_ERR", "ERR")
+SYNC_FINISH_REPLIES = ("SYNC_OK_NO_CHANGES", "NEEDS_FILES_READY", "SYNC_PROCESSING", "ERR")
+SYNC_POLL = 0.2  # seconds between SYNC_FINISH retries while the server compares the manifest
+# 不能只写 "ERR"：迟到的 DATA 回复 (ERR_...) 会被当成 UPLOAD_DONE 的回复
+UPLOAD_DONE_REPLIES = ("UPLOAD_COMPLETE", "UPLOAD_FAILED", "ERR_INVALID_UPLOAD_DONE")
+
+def _data_message(offset: int, chunk: bytes) -> str:
+    """'DATA <offset> <crc32> <base64>' for one upload chunk"""
+    return f"DATA {offset} {zlib.crc32(chunk):08x} {base64.b64encode(chunk).decode('utf-8')}"
+
+def _parse_data_reply(response: str):
+    """(offset, data) from a 'DATA <offset> <crc32> <base64>' reply, or None if malformed or corrupted"""
+    parts = response.split(' ', 3)
+    if len(parts) != 4 or parts[0] != "DATA":
+        return None
     try:
-        file_size = local_path.stat().st_size
-        
+        offset, crc = int(parts[1]), int(parts[2], 16)
+        data = base64.b64decode(parts[3])
+    except ValueError:
+        return None
+    if zlib.crc32(data) != crc:
+        METRICS.inc("checksum_errors_total")
+        return None
+    return offset, data
+
+def is_sparse(st: os.stat_result) -> bool:
+    """Whether the file has holes (fewer blocks allocated than its size needs)"""
+    return hasattr(st, "st_blocks") and st.st_blocks * 512 < st.st_size
+
+def iter_extents(f, size: int, chunk_size: int = 1024):
+    """Yield (offset, length, data) covering the file; data is None for a run of zeros.
+
+    Holes are found with SEEK_DATA/SEEK_HOLE where the OS supports them; all-zero
+    chunks inside data regions are merged into the same runs.
+    """
+    fd = f.fileno()
+    offset = 0
+    zero_start = None
+    while offset < size:
+        data_start, data_end = offset, size
+        try:
+            data_start = os.lseek(fd, offset, os.SEEK_DATA)
+            data_end = min(os.lseek(fd, data_start, os.SEEK_HOLE), size)
+        except AttributeError:
+            pass  # 平台不支持 SEEK_DATA：逐块检查
+        except OSError as e:
+            data_start = size if e.errno == errno.ENXIO else offset
+        if data_start > offset and zero_start is None:
+            zero_start = offset
+        offset = min(data_start, size)
+        f.seek(offset)
+        while offset < data_end:
+            chunk = f.read(min(chunk_size, data_end - offset))
+            if not chunk:
+                size = offset  # 文件在读取过程中变短了
+                break
+            if is_zero_block(chunk):
+                if zero_start is None:
+                    zero_start = offset
+            else:
+                if zero_start is not None:
+                    yield zero_start, offset - zero_start, None
+                    zero_start = None
+                yield offset, len(chunk), chunk
+            offset += len(chunk)
+    if zero_start is not None:
+        yield zero_start, offset - zero_start, None
+
+def _extent_message(offset: int, length: int, data) -> str:
+    """DATA message for a chunk, or 'ZERO <offset> <length>' for a run of zeros"""
+    return _data_message(offset, data) if data is not None else f"ZERO {offset} {length}"
+
+def _parse_zero_reply(response: str):
+    """(offset, length) from a 'ZERO <offset> <length>' reply, or None"""
+    parts = response.split()
+    if len(parts) != 3 or parts[0] != "ZERO" or not parts[1].isdigit() or not parts[2].isdigit():
+        return None
+    return int(parts[1]), int(parts[2])
+
+def _verify_transfer(response: str, size: int, digest: str) -> bool:
+    """Check 'TRANSFER_COMPLETE <size> <md5>' against what was received"""
+    parts = response.split()
+    if len(parts) != 3:
+        return True  # 旧版服务器不提供摘要
+    return parts[1] == str(size) and parts[2] == digest
+
+LOCAL_HELLO_REPLIES = ("LOCAL_OK", "LOCAL_NO", "ERR")
+LOCAL_CONNECT_TIMEOUT = 2.0
+_NO_LOCAL_PATH = set()  # server addresses known not to offer the same-host fast path
+
+def wants_local_path(server_address) -> bool:
+    return server_address not in _NO_LOCAL_PATH and is_local_address(server_address[0])
+
+def _parse_local_hello(server_address, response: str) -> Optional[tuple]:
+    """(token, socket path) from 'LOCAL_OK <token> <path>'; otherwise remember that the server has no fast path"""
+    parts = response.split(' ', 2)
+    if parts[0] == "LOCAL_OK" and len(parts) == 3 and os.path.exists(parts[2]):
+        return parts[1], parts[2]
+    _NO_LOCAL_PATH.add(server_address)
+    return None
+
+def _local_session(sock, server_address) -> Optional[tuple]:
+    """Ask a server on this machine for a same-host transfer token (one per transfer)"""
+    if not wants_local_path(server_address):
+        return None
+    response, _ = sendAndReceive(sock, "LOCAL_HELLO", server_address, expect=LOCAL_HELLO_REPLIES)
+    return _parse_local_hello(server_address, response)
+
+def _local_request(socket_path: str, request: str, fds=()) -> tuple:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(LOCAL_CONNECT_TIMEOUT)
+        conn.connect(socket_path)
+        conn.settimeout(None)  # 服务器复制完才回复，耗时取决于文件大小
+        if fds:
+            socket.send_fds(conn, [request.encode('utf-8') + b"\n"], list(fds))
+        else:
+            conn.sendall(request.encode('utf-8') + b"\n")
+        message, reply_fds, _, _ = socket.recv_fds(conn, 4096, 1)
+    return message.decode('utf-8').strip(), reply_fds
+
+def local_upload(session: tuple, local_path: Path, remote_path: str) -> bool:
+    """Hand the file's descriptor to a server on this machine; False means fall back to UDP"""
+    token, socket_path = session
+    start = time.perf_counter()
+    try:
+        with local_path.open("rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            reply, fds = _local_request(socket_path, f"PUT {token} {size} {remote_path}", [f.fileno()])
+        for fd in fds:
+            os.close(fd)
+    except OSError as e:
+        logger.debug("Same-host upload of %s failed: %s", local_path, e)
+        return False
+    if reply != "UPLOAD_COMPLETE":
+        logger.debug("Same-host upload of %s refused: %s", local_path, reply)
+        return False
+    METRICS.inc("local_bytes_total", size, direction="upload")
+    METRICS.observe("local_transfer_seconds", time.perf_counter() - start, direction="upload")
+    return True
+
+def local_download(session: tuple, remote_name: str, local_path: Path) -> bool:
+    """Copy a file from a server on this machine through its descriptor; False means fall back to UDP"""
+    token, socket_path = session
+    start = time.perf_counter()
+    try:
+        reply, fds = _local_request(socket_path, f"GET {token} {remote_name}")
+    except OSError as e:
+        logger.debug("Same-host download of %s failed: %s", remote_name, e)
+        return False
+    try:
+        if not reply.startswith("OK ") or len(fds) != 1:
+            logger.debug("Same-host download of %s refused: %s", remote_name, reply)
+            return False
+        size = int(reply.split()[1])
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        # 先写入同目录下的临时文件，完成后再原子替换，失败时不会留下截断的目标文件
+        tmp_path = partial_path(local_path, f"local{secrets.token_hex(4)}")
+        try:
+            with tmp_path.open("wb") as f:
+                copy_file_data(fds[0], f.fileno(), size)
+            os.replace(tmp_path, local_path)
+        except OSError as e:
+            tmp_path.unlink(missing_ok=True)
+            logger.debug("Same-host download of %s failed: %s", remote_name, e)
+            return False
+    finally:
+        for fd in fds:
+            os.close(fd)
+    METRICS.inc("local_bytes_total", size, direction="download")
+    METRICS.observe("local_transfer_seconds", time.perf_counter() - start, direction="download")
+    return True
+
+_NO_DEDUP = set()  # server addresses without an object store: no HAVE, no CDC and no hashing up front
+
+def _note_have_reply(server_address, response: str) -> bool:
+    """False (and remembered) if the HAVE reply says the server keeps no object store"""
+    if response == "HAVE_UNSUPPORTED" or response.startswith("ERR"):
+        _NO_DEDUP.add(server_address)
+        return False
+    return True
+
+def _update_md5_extent(hash_md5, length: int, data) -> None:
+    """Add an extent from iter_extents (data None for a run of zeros) to hash_md5"""
+    if data is None:
+        update_md5_zeros(hash_md5, length)
+    else:
+        hash_md5.update(data)
+
+def _perform_upload(sock, server_address, local_path: Path, remote_path: str, verbose: bool = True,
+                    digest: str = None) -> bool:
+    try:
+        st = local_path.stat()
+        file_size = st.st_size
+
+        # 0. 询问服务器是否已有相同内容 (content-addressed store)，有则无需传输；
+        #    服务器没有对象存储时不再预先计算摘要，MD5 在发送数据时顺带计算
+        dedup = server_address not in _NO_DEDUP
+        if dedup:
+            digest = digest or calculate_md5(local_path)
+            response_str, _ = sendAndReceive(sock, f"HAVE {digest} {remote_path}", server_address)
+            if response_str == "HAVE_OK":
+                if verbose: print(f"\n[SUCCESS] File '{remote_path}' already on server, linked without upload!")
+                return True
+            dedup = _note_have_reply(server_address, response_str)
+
+        # 0.2 服务器在本机时直接传递文件描述符，由内核复制，不经过 UDP
+        session = _local_session(sock, server_address)
+        if session and local_upload(session, local_path, remote_path):
+            if verbose: print(f"\n[SUCCESS] File '{remote_path}' uploaded successfully (same host)!")
+            return True
+
+        # 0.5 大文件先尝试分块去重上传，服务器不支持时退回整文件上传
+        if dedup and file_size >= CDC_MIN_FILE_SIZE:
+            result = _perform_chunked_upload(sock, server_address, local_path, remote_path, digest, verbose)
+            if result is not None:
+                return result
+
         # 1. 发送 UPLOAD 命令，告知服务器准备接收
-        response_str, _ = sendAndReceive(sock, f"UPLOAD {remote_path}", server_address)
+        response_str, _ = sendAndReceive(sock, f"UPLOAD {remote_path}", server_address, expect=UPLOAD_READY_REPLIES)
         if response_str != "UPLOAD_READY":
             if verbose: print(f"\n[ERROR] Server not ready for upload: {response_str}")
             return False
 
-        # 2. 开始分块传输
+        # 1.5 告知文件大小：服务器据此预分配空间，有空洞的文件只截断到该长度
+        response_str, _ = sendAndReceive(sock, f"UPLOAD_SIZE {file_size} {'SPARSE' if is_sparse(st) else 'DENSE'}",
+                                         server_address, expect=UPLOAD_SIZE_REPLIES)
+        if response_str != f"ACK_SIZE {file_size}":
+            if verbose: print(f"\n[ERROR] Server could not allocate the file: {response_str}")
+            return False
+
+        # 2. 开始分块传输；空洞和全零的区段只发送 "ZERO <offset> <length>"
+        hash_md5 = None if digest else hashlib.md5()
         with local_path.open("rb") as f:
             bytes_sent = 0
-            while True:
-                chunk = f.read(1024)
-                if not chunk:
-                    break
-                
-                # 直接在这里发送数据块，不再需要 transfer_file_chunk
-                encoded_chunk = base64.b64encode(chunk).decode('utf-8')
-                data_message = f"DATA {encoded_chunk}"
-                response_str, _ = sendAndReceive(sock, data_message, server_address)
-                
-                if response_str != "ACK_DATA":
-                    if verbose: print(f"\n[ERROR] Failed to get ACK for a chunk.")
+            for offset, length, chunk in iter_extents(f, file_size):
+                # 每块带偏移量和 CRC32；服务器校验失败 (NACK) 或收到迟到的旧 ACK 时只重发这一块
+                data_message = _extent_message(offset, length, chunk)
+                for _ in range(DATA_RETRIES):
+                    response_str, _ = sendAndReceive(sock, data_message, server_address, expect=DATA_REPLIES)
+                    if response_str == f"ACK_DATA {offset}" or response_str.startswith("ERR"):
+                        break
+                    METRICS.inc("chunk_resends_total")
+
+                if response_str != f"ACK_DATA {offset}":
+                    if verbose: print(f"\n[ERROR] Failed to get ACK for a chunk: {response_str}")
                     return False
+                if hash_md5:
+                    _update_md5_extent(hash_md5, length, chunk)
 
-                bytes_sent += len(chunk)
+                bytes_sent = offset + length
                 if verbose:
                     progress = (bytes_sent / file_size) * 100 if file_size > 0 else 100
                     print(f"\rUpload progress: {progress:.2f}% ({bytes_sent}/{file_size} bytes)", end='')
 
-        # 3. 发送上传完成信号
-        response_str, _ = sendAndReceive(sock, "UPLOAD_DONE", server_address)
+        # 3. 发送上传完成信号，附带大小和 MD5 供服务器校验后再原子替换
+        digest = digest or hash_md5.hexdigest()
+        response_str, _ = sendAndReceive(sock, f"UPLOAD_DONE {file_size} {digest}", server_address,
+                                         expect=UPLOAD_DONE_REPLIES)
         if response_str == "UPLOAD_COMPLETE":
             if verbose: print(f"\n[SUCCESS] File '{remote_path}' uploaded successfully!")
             return True
+        elif response_str.startswith("UPLOAD_FAILED"):
+            if verbose: print(f"\n[ERROR] Server rejected the upload ({response_str[14:]}); its copy is unchanged.")
+            return False
         else:
             if verbose: print(f"\n[WARNING] Unexpected final response: {response_str}")
             return False
@@ -112,7 +399,96 @@ def _perform_upload(sock, server_address, local_path: Path, remote_path: str, ve
         if verbose: print(f"\n[ERROR] Upload failed: {str(e)}")
         return False
 
-def _perform_download(sock, server_address, remote_filename: str, local_path: Path) -> bool:
+def _build_cdc_recipe_message(recipe: list, start: int) -> str:
+    batch = recipe[start:start + CDC_RECIPE_BATCH]
+    return f"CDC_RECIPE {start}\n" + " ".join(f"{digest}:{length}" for _, length, digest in batch)
+
+def _parse_cdc_need(response_str: str, start: int):
+    """Parse 'CDC_NEED <start> <i,j,...|->' into a list of chunk indices, or None if invalid"""
+    parts = response_str.split()
+    if len(parts) != 3 or parts[0] != "CDC_NEED" or parts[1] != str(start):
+        return None
+    return [] if parts[2] == "-" else [int(i) for i in parts[2].split(',')]
+
+def _is_cdc_data_reply(response_str: str, index: int, offset: int) -> bool:
+    """True if response_str answers 'CDC_DATA <index> <offset>' rather than an earlier piece"""
+    if response_str.startswith(("ACK_DATA", "CDC_ERR BAD_CHUNK ")):
+        return response_str.split()[-2:] == [str(index), str(offset)]
+    return True
+
+def _perform_chunked_upload(sock, server_address, local_path: Path, remote_path: str, digest: str,
+                            verbose: bool = True):
+    """Upload only the content-defined chunks the server does not know yet.
+
+    Returns True/False for success, or None if the server does not support chunked uploads.
+    """
+    recipe = compute_cdc_recipe(local_path)
+    file_size = local_path.stat().st_size
+    # 服务器在后台为已有的目标文件建立块索引，完成前回复 CDC_INDEXING
+    deadline = time.monotonic() + CDC_INDEX_WAIT
+    while True:
+        response_str, _ = sendAndReceive(
+            sock, f"CDC_BEGIN {len(recipe)} {file_size} {remote_path}", server_address)
+        if response_str != "CDC_INDEXING" or time.monotonic() > deadline:
+            break
+        time.sleep(CDC_INDEX_POLL)
+    if response_str != "CDC_READY":
+        return None
+
+    # 1. 分批提供块摘要，服务器回复缺少的块索引
+    needed = []
+    for start in range(0, len(recipe), CDC_RECIPE_BATCH):
+        message = _build_cdc_recipe_message(recipe, start)
+        response_str, _ = sendAndReceive(sock, message, server_address)
+        batch_needed = _parse_cdc_need(response_str, start)
+        if batch_needed is None:
+            if verbose: print(f"\n[ERROR] Unexpected recipe response: {response_str}")
+            return False
+        needed.extend(batch_needed)
+
+    if verbose:
+        print(f"Chunked upload: {len(recipe) - len(needed)}/{len(recipe)} chunk(s) already on server")
+
+    # 2. 只发送未知的块
+    total_bytes = sum(recipe[i][1] for i in needed)
+    bytes_sent = 0
+    with local_path.open("rb") as f:
+        for index in needed:
+            chunk_offset, chunk_length, _ = recipe[index]
+            f.seek(chunk_offset)
+            for piece in range(0, chunk_length, 1024):
+                body = f.read(min(1024, chunk_length - piece))
+                encoded_chunk = base64.b64encode(body).decode('utf-8')
+                # 迟到的上一片段的 ACK 不算数，重发这一片段
+                for _ in range(DATA_RETRIES):
+                    response_str, _ = sendAndReceive(
+                        sock, f"CDC_DATA {index} {piece}\n{encoded_chunk}", server_address, expect=CDC_DATA_REPLIES)
+                    if _is_cdc_data_reply(response_str, index, piece):
+                        break
+                    METRICS.inc("chunk_resends_total")
+                if response_str != f"ACK_DATA {index} {piece}":
+                    if verbose: print(f"\n[ERROR] Failed to get ACK for chunk {index}: {response_str}")
+                    return False
+                bytes_sent += len(body)
+                if verbose:
+                    progress = (bytes_sent / total_bytes) * 100 if total_bytes > 0 else 100
+                    print(f"\rUpload progress: {progress:.2f}% ({bytes_sent}/{total_bytes} new bytes)", end='')
+
+    # 3. 通知服务器从块索引重组文件；服务器在后台重组，完成前回复 CDC_COMMITTING
+    deadline = time.monotonic() + CDC_INDEX_WAIT
+    while True:
+        response_str, _ = sendAndReceive(sock, f"CDC_COMMIT {digest}", server_address, expect=CDC_COMMIT_REPLIES)
+        if response_str != "CDC_COMMITTING" or time.monotonic() > deadline:
+            break
+        time.sleep(CDC_INDEX_POLL)
+    if response_str == "CDC_DONE":
+        if verbose: print(f"\n[SUCCESS] File '{remote_path}' uploaded successfully!")
+        return True
+    if verbose: print(f"\n[WARNING] Chunked upload failed: {response_str}")
+    return False
+
+def _perform_download(sock, server_address, remote_filename: str, local_path: Path,
+                      file_size: int = None) -> bool:
     try:
         # 1. 发送 DOWNLOAD 命令 (此处的 socket 是主命令 socket)
         # 注意: 你的原逻辑是新开一个端口，这里为了简化，我们假设仍在同一个 socket 上通信
@@ -122,21 +498,51 @@ def _perform_download(sock, server_address, remote_filename: str, local_path: Pa
             print(f"[ERROR] Server not ready for download: {response_str}")
             return False
             
-        # 2. 开始分块接收
-        with local_path.open("wb") as f:
-            bytes_received = 0
-            while True:
-                response_str, _ = sendAndReceive(sock, "GET_CHUNK", server_address)
-                if response_str == "TRANSFER_COMPLETE":
-                    break
-                if not response_str.startswith("DATA "):
-                    print("\n[ERROR] Invalid data chunk received from server.")
-                    return False
-                    
-                data = base64.b64decode(response_str[5:])
-                f.write(data)
-                bytes_received += len(data)
-                print(f"\rDownload progress: {bytes_received} bytes received", end='')
+        # 2. 开始分块接收：按偏移量请求，校验每块的 CRC32，同时累计整个文件的 MD5
+        # 先写入同目录下的临时文件，校验通过后再原子替换；失败时原有文件保持不变
+        hash_md5 = hashlib.md5()
+        tmp_path = partial_path(local_path, f"udp{secrets.token_hex(4)}")
+        try:
+            with tmp_path.open("wb") as f:
+                if file_size:
+                    f.truncate(file_size)  # 零区不写入，留作空洞
+                bytes_received = 0
+                failures = 0
+                while True:
+                    response_str, _ = sendAndReceive(sock, f"GET_CHUNK {bytes_received}", server_address)
+                    if response_str.startswith("TRANSFER_COMPLETE"):
+                        break
+                    zeros = _parse_zero_reply(response_str)
+                    if zeros and zeros[0] == bytes_received:
+                        failures = 0
+                        update_md5_zeros(hash_md5, zeros[1])
+                        bytes_received += zeros[1]
+                        f.seek(bytes_received)
+                        continue
+                    chunk = _parse_data_reply(response_str)
+                    if chunk is None or chunk[0] != bytes_received:
+                        # 损坏或迟到的数据块：重新请求同一偏移量
+                        failures += 1
+                        METRICS.inc("chunk_resends_total")
+                        if failures > DATA_RETRIES:
+                            print("\n[ERROR] Invalid data chunk received from server.")
+                            return False
+                        continue
+                    failures = 0
+                    data = chunk[1]
+                    f.write(data)
+                    hash_md5.update(data)
+                    bytes_received += len(data)
+                    print(f"\rDownload progress: {bytes_received} bytes received", end='')
+
+                f.truncate(bytes_received)
+            if not _verify_transfer(response_str, bytes_received, hash_md5.hexdigest()):
+                print(f"\n[ERROR] Download of '{remote_filename}' failed verification ({response_str}); "
+                      f"'{local_path}' was not changed.")
+                return False
+            os.replace(tmp_path, local_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
         
         print(f"\n[SUCCESS] File '{remote_filename}' downloaded successfully to '{local_path}'!")
         return True
@@ -168,6 +574,21 @@ def handle_upload(sock, server_address, command_input):
     # 直接调用核心上传函数，并要求详细输出
     _perform_upload(sock, server_address, local_path_to_read, path_for_server_norm, verbose=True)
 
+SUPLOAD_META_BYTES = 7000  # records per SUPLOAD_META packet, below the server's 8 KiB receive buffer
+
+def _supload_batches(records: list):
+    """Group metadata records into packets of at most SUPLOAD_META_BYTES"""
+    batch, size = [], 0
+    for record in records:
+        length = len(record.encode('utf-8')) + 1
+        if batch and size + length > SUPLOAD_META_BYTES:
+            yield batch
+            batch, size = [], 0
+        batch.append(record)
+        size += length
+    if batch:
+        yield batch
+
 def handle_super_upload(sock, server_address, local_folder_path):
     """Handle folder upload with simplified logic."""
     folder_path = Path(local_folder_path.strip().strip('\'"'))
@@ -176,35 +597,47 @@ def handle_super_upload(sock, server_address, local_folder_path):
         return
 
     try:
-        # Get all files recursively
-        files = [f for f in folder_path.rglob("*") if f.is_file()]
+        # One walk for both lists; sorted so every directory precedes its contents
+        entries = sorted(walk_tree(folder_path))
+        files = [e for e in entries if not e.is_dir]
         if not files:
             print(f"\n[ERROR] No files found in '{folder_path}'")
             return
+        dirs = [e for e in entries if e.is_dir]
 
-        # Create directory structure
-        dirs = [str(d.relative_to(folder_path)).replace("\\", "/") 
-                for d in folder_path.rglob("*") if d.is_dir()]
-        
-        structure_payload = f"SUPLOAD_STRUCTURE {folder_path.name}\n" + "\n".join(dirs)
-        response_str, _ = sendAndReceive(sock, structure_payload, server_address)
-        if response_str != "STRUCTURE_OK":
-            print(f"\n[ERROR] Failed to create directory structure: {response_str}")
+        response_str, _ = sendAndReceive(sock, f"SUPLOAD_BEGIN {folder_path.name}", server_address,
+                                         expect=("SUPLOAD_", "ERR", SERVER_BUSY))
+        if response_str != "SUPLOAD_READY":
+            print(f"\n[ERROR] Failed to start folder upload: {response_str}")
             return
 
+        # Send the directory structure and the file list in batches of records, several per packet
+        records = [f"D {d.rel_path}" for d in dirs] + [f"F {f.rel_path}" for f in files]
+        skipped = set()
+        index = 0
+        for seq, batch in enumerate(_supload_batches(records)):
+            response_str, _ = sendAndReceive(sock, f"SUPLOAD_META {seq}\n" + "\n".join(batch), server_address,
+                                             expect=("META_", "ERR"))
+            parts = response_str.split()
+            if parts[:2] != ["META_OK", str(seq)]:
+                print(f"\n[ERROR] Failed to create directory structure: {response_str}")
+                return
+            if len(parts) == 4 and parts[2] == "SKIP":
+                skipped.update(index + int(i) for i in parts[3].split(','))
+            index += len(batch)
+
         # Upload each file
-        for i, file_path in enumerate(files, 1):
-            rel_path = str(file_path.relative_to(folder_path)).replace("\\", "/")
-            print(f"\n({i}/{len(files)}) Uploading: {rel_path}")
-            
-            response_str, _ = sendAndReceive(sock, f"SUPLOAD_FILE {rel_path}", server_address)
-            if response_str != "FILE_READY":
-                print(f"[WARNING] Server not ready for '{rel_path}', skipping.")
+        for i, entry in enumerate(files, 1):
+            file_path, rel_path = Path(entry.path), entry.rel_path
+            if len(dirs) + i - 1 in skipped:
+                print(f"\n[WARNING] Server rejected the path '{rel_path}', skipping.")
                 continue
+            print(f"\n({i}/{len(files)}) Uploading: {rel_path}")
 
-            # _perform_upload 现在处理完整的上传握手，无需额外操作
-            # 我们给它传递 verbose=False 来减少输出
-            if not _perform_upload(sock, server_address, file_path, rel_path, verbose=False):
+            # _perform_upload 处理完整的上传握手，传递 verbose=False 来减少输出
+            # 服务器的文件夹会话根目录就是当前目录下的 <folder>，因此按此路径上传
+            remote_file_path = f"{folder_path.name}/{rel_path}"
+            if not _perform_upload(sock, server_address, file_path, remote_file_path, verbose=False):
                  print(f"[ERROR] Failed to upload '{rel_path}'")
 
         # Complete the upload
@@ -220,24 +653,41 @@ def handle_super_upload(sock, server_address, local_folder_path):
 class SyncManager:
     """Manages file synchronization between client and server."""
     
-    def __init__(self, sock, server_address, local_path: str, remote_path: str):
+    def __init__(self, sock, server_address, local_path: str, remote_path: str,
+                 ignore: list = None, include: list = None, buffered: bool = False):
         self.sock = sock
         self.server_address = server_address
         self.local_path = Path(local_path)   # <-- 新增: 本地同步路径
         self.remote_path = remote_path       # <-- 新增: 远程同步路径
+        self.ignore = ignore                 # 同步对配置中的 ignore / include 规则
+        self.include = include
         self.chunk_size = 1024
-        self.sync_interval = 3  # seconds
-        
-    def generate_md5_manifest(self, directory: str) -> dict:
+        # 多个同步对并发运行时，输出先收集起来，周期结束后整段打印，避免互相穿插
+        self.output = [] if buffered else None
+
+    def _print(self, *args, end: str = "\n") -> None:
+        if self.output is None:
+            print(*args, end=end)
+            return
+        text = " ".join(str(arg) for arg in args)
+        if not text.startswith("\r"):  # 进度行只在终端上有意义
+            self.output.append(text + end)
+
+    def flush_output(self) -> str:
+        """Return and clear the output collected in buffered mode"""
+        text, self.output = "".join(self.output or []), ([] if self.output is not None else None)
+        return text
+
+    def generate_md5_manifest(self, directory: str, ignore: IgnoreRules = None) -> dict:
         """Generate a manifest by calling the global utility function."""
-        return generate_md5_manifest(directory)
+        return generate_md5_manifest(directory, ignore)
 
-    def transfer_manifest(self, manifest: dict) -> bool:
+    def transfer_manifest(self, manifest: dict, ignore: IgnoreRules = None) -> bool:
         """Transfer the manifest to server in chunks."""
         try:
-            manifest_payload = json.dumps(manifest)
-            chunks = [manifest_payload[i:i+self.chunk_size] 
-                     for i in range(0, len(manifest_payload), self.chunk_size)]
+            payload = manifest_payload(manifest, ignore)
+            chunks = [payload[i:i+self.chunk_size] 
+                     for i in range(0, len(payload), self.chunk_size)]
             num_chunks = len(chunks)
 
             # 使用 self.remote_path 告知服务器要同步哪个目录
@@ -257,15 +707,15 @@ class SyncManager:
 
             return True
         except Exception as e:
-            print(f"Error transferring manifest: {e}")
+            self._print(f"Error transferring manifest: {e}")
             return False
 
-    def process_server_response(self, response: str) -> None:
-        """Process server's response to manifest and handle file uploads."""
+    def process_server_response(self, response: str, manifest: dict = None) -> bool:
+        """Process server's response to manifest and handle file uploads; False if any upload failed."""
         # Case 1: Files are already in sync
         if response == "SYNC_OK_NO_CHANGES":
-            print(" -> All files are in sync.")
-            return
+            self._print(" -> All files are in sync.")
+            return True
 
         # Case 2: Server has prepared data chunks, client needs to fetch them
         if response.startswith("NEEDS_FILES_READY"):
@@ -275,7 +725,7 @@ class SyncManager:
                     raise ValueError("Invalid READY response format")
                 
                 num_chunks = int(parts[1])
-                print(f" -> Server has {num_chunks} data chunk(s). Fetching...")
+                self._print(f" -> Server has {num_chunks} data chunk(s). Fetching...")
 
                 chunks = []
                 for i in range(num_chunks):
@@ -283,9 +733,9 @@ class SyncManager:
                     command = f"GET_SYNC_CHUNK {i}"
                     chunk_data, _ = sendAndReceive(self.sock, command, self.server_address, timeout=5.0)
                     chunks.append(chunk_data)
-                    print(f"\r -> Receiving file list... {i+1}/{num_chunks}", end="")
+                    self._print(f"\r -> Receiving file list... {i+1}/{num_chunks}", end="")
                 
-                print()  # New line after progress
+                self._print()  # New line after progress
                 json_payload = "".join(chunks)
 
                 # Parse JSON and handle file uploads
@@ -297,103 +747,1035 @@ class SyncManager:
                 if not isinstance(files_to_upload, list):
                     raise ValueError("Expected list of files")
                 
+                failures = 0
+                # remote_path 相对于服务器根目录；每个同步对的 socket 都停留在根目录
+                remote_root = self.remote_path.strip('/')
                 if files_to_upload:
-                    print(f" -> Server needs {len(files_to_upload)} file(s). Starting sync upload...")
+                    self._print(f" -> Server needs {len(files_to_upload)} file(s). Starting sync upload...")
                     for file_path_str in files_to_upload:
                         # 使用 self.local_path 作为基础路径，而不是写死的 "client_files"
                         local_path = self.local_path / file_path_str
                         if local_path.is_file():
-                            print(f"    - Syncing '{file_path_str}'...", end='')
+                            self._print(f"    - Syncing '{file_path_str}'...", end='')
                             # 调用核心上传函数，但设置 verbose=False 来禁止详细输出
-                            success = _perform_upload(self.sock, self.server_address, local_path, file_path_str, verbose=False)
-                            print(" OK" if success else " FAILED")
+                            remote_file = f"{remote_root}/{file_path_str}" if remote_root else file_path_str
+                            success = _perform_upload(self.sock, self.server_address, local_path, remote_file,
+                                                      verbose=False, digest=(manifest or {}).get(file_path_str))
+                            self._print(" OK" if success else " FAILED")
+                            failures += not success
                         else:
-                            print(f"    - Skipping '{file_path_str}': Not found locally.")
+                            self._print(f"    - Skipping '{file_path_str}': Not found locally.")
                 else:
-                    print(" -> All files are in sync.")
+                    self._print(" -> All files are in sync.")
+                return failures == 0
             except Exception as e:
-                print(f"\n[ERROR] Failed to process server's sync response: {e}")
-                print(f"Raw response: {response}")
+                self._print(f"\n[ERROR] Failed to process server's sync response: {e}")
+                self._print(f"Raw response: {response}")
+                return False
         else:
-            print(f"\n[WARNING] Received unexpected response from server: {response}")
+            self._print(f"\n[WARNING] Received unexpected response from server: {response}")
+            return False
 
     def sync_cycle(self) -> bool:
         """为 self.local_path 和 self.remote_path 执行一个同步周期。"""
+        with METRICS.timer("sync_cycle_seconds"), PROFILER.section("sync", self.remote_path):
+            return self._sync_cycle()
+
+    def _sync_cycle(self) -> bool:
         try:
             # 打印当前正在同步的路径对
-            print(f"\n--- Syncing Local: '{self.local_path}' <==> Server: '{self.remote_path}' ---")
+            self._print(f"\n--- Syncing Local: '{self.local_path}' <==> Server: '{self.remote_path}' ---")
 
             if not self.local_path.is_dir():
-                print(f"[ERROR] Local directory '{self.local_path}' not found or is not a directory. Skipping.")
+                self._print(f"[ERROR] Local directory '{self.local_path}' not found or is not a directory. Skipping.")
                 return False
 
-            print(" -> Step 1/3: Generating local MD5 manifest...")
-            # 使用 self.local_path 来生成清单
-            manifest = self.generate_md5_manifest(str(self.local_path))
+            self._print(" -> Step 1/3: Generating local MD5 manifest...")
+            # 使用 self.local_path 来生成清单；忽略规则每个周期编译一次，.syncignore 的修改随即生效
+            ignore = IgnoreRules.for_sync_root(self.local_path, self.ignore, self.include)
+            manifest = self.generate_md5_manifest(str(self.local_path), ignore)
             
             # 后续逻辑与原来相同...
-            print(" -> Step 2/3: Transferring manifest to server...")
-            if not self.transfer_manifest(manifest):
+            self._print(" -> Step 2/3: Transferring manifest to server...")
+            if not self.transfer_manifest(manifest, ignore):
                 return False
 
-            print(" -> Step 3/3: Processing server's file request list...")
-            response, _ = sendAndReceive(self.sock, "SYNC_FINISH", self.server_address)
-            self.process_server_response(response)
+            self._print(" -> Step 3/3: Processing server's file request list...")
+            # 服务器在后台线程中扫描目标目录并比较清单，完成前回复 SYNC_PROCESSING
+            while True:
+                response, _ = sendAndReceive(self.sock, "SYNC_FINISH", self.server_address, expect=SYNC_FINISH_REPLIES)
+                if response != "SYNC_PROCESSING":
+                    break
+                time.sleep(SYNC_POLL)
+            if not self.process_server_response(response, manifest):
+                self._print("\n[-] Sync cycle finished with errors.")
+                return False
 
-            print("\n[+] Sync cycle completed successfully.")
-            print("------------------------------------------------------------")
+            self._print("\n[+] Sync cycle completed successfully.")
+            self._print("------------------------------------------------------------")
             return True
             
         except Exception as e:
-            print(f"\n[ERROR] An error occurred during sync cycle: {e}")
+            self._print(f"\n[ERROR] An error occurred during sync cycle: {e}")
             return False
 
-    def start_sync_mode(self):
-        """为所有在配置文件中的项启动持续同步模式。"""
-        print("\n[AUTO SYNC MODE ACTIVATED]")
-        print("Client will now sync ALL configured pairs every cycle.")
-        print("按下Enter键退出sync模式。")
-        
+SYNC_WORKERS = 4  # sync pairs run concurrently, each with its own socket
+SYNC_INTERVAL = 3.0  # default seconds between auto-sync cycles of one pair ("interval" in sync_config.json)
+SYNC_MAX_BACKOFF = 300.0  # upper bound of the retry delay after failed cycles
+
+class SyncScheduler:
+    """Runs the configured sync pairs on a bounded thread pool.
+
+    Every pair gets its own SyncManager and socket, so a slow pair does not hold
+    up the others. In auto mode each pair is due again <interval> seconds after
+    its last cycle; failed cycles back off exponentially up to SYNC_MAX_BACKOFF.
+    """
+
+    def __init__(self, server_address, workers: int = SYNC_WORKERS):
+        self.server_address = server_address
+        self.workers = max(1, workers)
+        self._print_lock = threading.Lock()
+        self.next_due = {}  # pair id -> monotonic time of its next cycle
+        self.failures = {}  # pair id -> consecutive failed cycles
+
+    def _sync_pair(self, item: dict) -> bool:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            manager = SyncManager(sock, self.server_address, item['local_path'], item['remote_path'],
+                                  item.get('ignore'), item.get('include'), buffered=self.workers > 1)
+            ok = manager.sync_cycle()
+        with self._print_lock:
+            print(manager.flush_output(), end="")
+        return ok
+
+    def _delay(self, item: dict) -> float:
+        interval = float(item.get('interval', SYNC_INTERVAL))
+        failures = self.failures.get(item['id'], 0)
+        return min(interval * 2 ** failures, max(interval, SYNC_MAX_BACKOFF)) if failures else interval
+
+    def _finished(self, item: dict, ok: bool) -> None:
+        self.failures[item['id']] = 0 if ok else self.failures.get(item['id'], 0) + 1
+        self.next_due[item['id']] = time.monotonic() + self._delay(item)
+
+    def run_once(self, config: list) -> int:
+        """Sync every pair once; returns the number of pairs that failed"""
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(self._sync_pair, config))
+        return results.count(False)
+
+    def run_auto(self) -> None:
+        """Keep syncing all configured pairs until Enter is pressed"""
+        import select
+        running = {}  # pair id -> future
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                try:
+                    config = load_sync_config()  # 每轮重新读取，运行中增删的同步对随即生效
+                    if not config and not running:
+                        print("No sync pairs configured. Exiting auto-sync mode.")
+                        break
+                    now = time.monotonic()
+                    for item in config:
+                        if item['id'] not in running and self.next_due.get(item['id'], 0.0) <= now:
+                            running[item['id']] = (item, pool.submit(self._sync_pair, item))
+                    for pair_id, (item, future) in list(running.items()):
+                        if future.done():
+                            del running[pair_id]
+                            ok = not future.exception() and future.result()
+                            self._finished(item, ok)
+                            if not ok:
+                                with self._print_lock:
+                                    print(f"[WARNING] Sync pair {pair_id} failed, retrying in {self._delay(item):.0f}s.")
+                    if sys.stdin in select.select([sys.stdin], [], [], 0.5)[0]:
+                        _ = sys.stdin.readline()
+                        print("\n[SYNC MODE DEACTIVATED] (检测到Enter) Waiting for running syncs, then returning to command menu.")
+                        break
+                except Exception as e:
+                    # 例如配置文件在编辑途中无法读取：等一会儿再试，不退出自动同步
+                    with self._print_lock:
+                        print(f"\n[ERROR] An error occurred during auto-sync loop: {e}")
+                        print(f"Waiting {SYNC_INTERVAL:.0f} seconds before retrying...")
+                    time.sleep(SYNC_INTERVAL)
+
+MCAST_GROUP = "239.255.77.77:51233"  # the server's default --mcast-group and --mcast-port
+MCAST_CHUNK = 1024  # payload bytes per MDATA packet, as sent by the server
+MCAST_NACK_INTERVAL = 0.2  # seconds between NACKs of one stream while chunks are missing
+MCAST_STALL = 0.5  # NACK after this long without data even if MEND was lost
+MCAST_NACK_BYTES = 1200  # ranges per MNACK datagram; the rest is asked for in the next one
+MCAST_REPLIES = ("MCAST_OK", "ERR", SERVER_BUSY)
+
+class MulticastReceiver:
+    """Receives files the server streams to a multicast group (MCAST_PUBLISH).
+
+    Chunks are written in place as they arrive. Once the stream's MEND is seen, or the
+    stream stalls, missing chunks are NACKed to the stream's source and the server
+    multicasts them again. Several receivers may run on one host; each gets every packet.
+    """
+
+    def __init__(self, group: str = MCAST_GROUP, interface: str = "", output_dir="client_files"):
+        host, _, port = group.rpartition(':')
+        self.group = (host, int(port))
+        self.output_dir = Path(output_dir)
+        self.sessions = {}  # sid -> state of a stream being received
+        self.finished = set()  # sids already completed, their repairs for others are ignored
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        with contextlib.suppress(AttributeError, OSError):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.bind(self.group)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                             socket.inet_aton(host) + socket.inet_aton(interface or "0.0.0.0"))
+        self.sock.settimeout(0.05)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self) -> None:
+        for session in self.sessions.values():
+            os.close(session['fd'])
+            session['tmp_path'].unlink(missing_ok=True)
+        self.sessions.clear()
+        self.sock.close()
+
+    def receive(self, timeout: float = 60.0):
+        """Yield a result dict per completed file; returns after `timeout` seconds without packets"""
+        last_packet = time.monotonic()
+        while time.monotonic() - last_packet < timeout:
+            try:
+                packet, source = self.sock.recvfrom(65535)
+            except socket.timeout:
+                packet = None
+            now = time.monotonic()
+            if packet:
+                last_packet = now
+                session = self._handle(packet, source, now)
+                if session:
+                    yield self._finish(session)
+            for session in self.sessions.values():
+                self._maybe_nack(session, now)
+
+    def _handle(self, packet: bytes, source: tuple, now: float) -> Optional[dict]:
+        """Apply one packet; returns the session it completed, if any"""
+        kind, _, rest = packet.partition(b' ')
+        if kind == b"MDATA":
+            try:
+                sid, index, crc, body = rest.split(b' ', 3)
+                session = self.sessions.get(sid.decode('ascii'))
+                index = int(index)
+            except (ValueError, UnicodeDecodeError):
+                return None
+            if not session or not 0 <= index < session['chunks'] or session['have'][index]:
+                return None
+            try:
+                data = base64.b64decode(body, validate=True)
+            except ValueError:
+                return None
+            if f"{zlib.crc32(data):08x}" != crc.decode('ascii', 'replace'):
+                METRICS.inc("mcast_corrupt_total")
+                return None
+            os.pwrite(session['fd'], data, index * MCAST_CHUNK)
+            session['have'][index] = 1
+            session['missing'] -= 1
+            session['last'] = now
+            return session if session['missing'] == 0 else None
+        try:
+            fields = rest.decode('utf-8').split(' ', 4)
+        except UnicodeDecodeError:
+            return None
+        if kind == b"MANNOUNCE" and len(fields) == 5:
+            sid = fields[0]
+            if sid in self.finished or sid in self.sessions:
+                return None
+            name = PurePosixPath(fields[4]).name
+            try:
+                size, chunks = int(fields[1]), int(fields[2])
+            except ValueError:
+                return None
+            if (name in ("", ".", "..") or not sid.isalnum() or not re.fullmatch(r"[0-9a-f]{32}", fields[3])
+                    or size < 0 or chunks != -(-size // MCAST_CHUNK)):
+                METRICS.inc("mcast_bad_announce_total")
+                return None
+            try:
+                self.output_dir.mkdir(parents=True, exist_ok=True)
+                disk = os.statvfs(self.output_dir)
+                if size > disk.f_bavail * disk.f_frsize:
+                    logger.warning("Ignoring stream %s: '%s' (%d bytes) does not fit on disk", sid, name, size)
+                    self.finished.add(sid)
+                    return None
+                tmp_path = self.output_dir / f".{name}.{sid}.part"
+                fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            except OSError as e:
+                logger.warning("Cannot receive stream %s: %s", sid, e)
+                return None
+            try:
+                os.ftruncate(fd, size)
+            except OSError as e:
+                os.close(fd)
+                tmp_path.unlink(missing_ok=True)
+                logger.warning("Cannot receive stream %s: %s", sid, e)
+                return None
+            session = {'sid': sid, 'name': name, 'size': size, 'chunks': chunks, 'md5': fields[3],
+                       'source': source, 'fd': fd, 'tmp_path': tmp_path, 'have': bytearray(chunks),
+                       'missing': chunks, 'ended': False, 'last': now, 'next_nack': now,
+                       'nacks': 0, 'start': now}
+            self.sessions[sid] = session
+            return session if chunks == 0 else None
+        if kind == b"MEND" and fields and fields[0] in self.sessions:
+            self.sessions[fields[0]]['ended'] = True
+        return None
+
+    def _maybe_nack(self, session: dict, now: float) -> None:
+        if not (session['ended'] or now - session['last'] > MCAST_STALL) or now < session['next_nack']:
+            return
+        ranges = []
+        length = 0
+        have = session['have']
+        start = have.find(0)
+        while start != -1:
+            end = have.find(1, start)
+            last = (len(have) if end == -1 else end) - 1
+            item = str(start) if last == start else f"{start}-{last}"
+            if length + len(item) + 1 > MCAST_NACK_BYTES:
+                break
+            ranges.append(item)
+            length += len(item) + 1
+            start = -1 if end == -1 else have.find(0, end)
+        self.sock.sendto(f"MNACK {session['sid']} {','.join(ranges)}".encode('utf-8'), session['source'])
+        session['nacks'] += 1
+        session['next_nack'] = now + MCAST_NACK_INTERVAL
+        METRICS.inc("mcast_nacks_total")
+
+    def _finish(self, session: dict) -> dict:
+        """Verify the completed file's MD5 and move it into place"""
+        del self.sessions[session['sid']]
+        self.finished.add(session['sid'])
+        target = self.output_dir / session['name']
+        os.fsync(session['fd'])
+        os.close(session['fd'])
+        result = {"name": session['name'], "stream": session['sid'], "bytes": session['size'],
+                  "nacks": session['nacks'], "seconds": round(time.monotonic() - session['start'], 6)}
+        if calculate_md5(session['tmp_path']) != session['md5']:
+            session['tmp_path'].unlink(missing_ok=True)
+            return {**result, "ok": False, "error": "MD5 mismatch, file removed"}
+        os.replace(session['tmp_path'], target)
+        METRICS.inc("mcast_files_total")
+        return {**result, "ok": True, "path": str(target)}
+
+TREE_REPLIES = ("TREE_READY", "TREE_BUILDING", "TREE_ERR", SERVER_BUSY)
+TREE_POLL = 0.2  # seconds between TREE retries while the server hashes the folder
+TREE_WINDOW = 16  # listing chunks requested (and streamed back) per round trip
+
+class TransferError(Exception):
+    """Raised by AsyncClient when an operation fails."""
+
+class _DatagramChannel(asyncio.DatagramProtocol):
+    """One UDP endpoint with stop-and-wait request/response semantics."""
+
+    def __init__(self, timeout: float, max_retries: int):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.transport = None
+        self.responses = asyncio.Queue()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.responses.put_nowait(data.decode('utf-8'))
+
+    def error_received(self, exc):
+        pass  # e.g. ICMP port unreachable; the request is retried on timeout
+
+    async def request(self, message: str, address=None, timeout: float = None, busy_wait: float = 30.0,
+                      expect: tuple = None) -> str:
+        """Send a message and wait for its response, retrying like sendAndReceive"""
+        timeout = timeout or self.timeout
+        # 丢弃之前重传产生的迟到响应，避免错位
+        while not self.responses.empty():
+            self.responses.get_nowait()
+        payload = message.encode('utf-8')
+        command = message.split(' ', 1)[0].split('\n', 1)[0]
+        attempt = 0
+        start = time.perf_counter()
+        busy_deadline = time.monotonic() + busy_wait
         while True:
+            self.transport.sendto(payload, address)
+            METRICS.inc("packets_out_total")
+            METRICS.inc("bytes_out_total", len(payload))
             try:
-                config = load_sync_config()
-                if not config:
-                    print("No sync pairs configured. Exiting auto-sync mode.")
-                    break
+                deadline = time.monotonic() + timeout
+                while True:
+                    response = await asyncio.wait_for(self.responses.get(), max(0.0, deadline - time.monotonic()))
+                    METRICS.inc("packets_in_total")
+                    METRICS.inc("bytes_in_total", len(response))
+                    if not expect or response.startswith(expect):
+                        break
+                    METRICS.inc("stale_replies_total")
+            except asyncio.TimeoutError:
+                METRICS.inc("retransmits_total")
+                attempt += 1
+                if attempt >= self.max_retries:
+                    raise TransferError(f"Server not responding after {self.max_retries} attempts.")
+                continue
+            if response == SERVER_BUSY and time.monotonic() < busy_deadline:
+                await asyncio.sleep(0.2)
+                continue
+            METRICS.observe("request_seconds", time.perf_counter() - start, command=command)
+            return response
+
+    def send(self, message: str) -> None:
+        """Send a message without waiting; replies are read with receive()"""
+        payload = message.encode('utf-8')
+        self.transport.sendto(payload)
+        METRICS.inc("packets_out_total")
+        METRICS.inc("bytes_out_total", len(payload))
+
+    async def receive(self, timeout: float) -> Optional[str]:
+        """Next datagram, or None if nothing arrives within timeout"""
+        try:
+            response = await asyncio.wait_for(self.responses.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        METRICS.inc("packets_in_total")
+        METRICS.inc("bytes_in_total", len(response))
+        return response
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+class AsyncClient:
+    """asyncio client for the UDP-Localsend server.
+
+    Every operation runs on its own UDP endpoint, so many uploads, downloads and
+    syncs can run concurrently on one event loop. The current server directory
+    set with cd() is replayed on each endpoint.
+
+        async with AsyncClient("localhost", 51234) as client:
+            await client.upload("report.pdf")
+            await client.download("data.csv", "client_files/data.csv")
+    """
 
-                print(f"\n======= Starting New Auto-Sync Run ({time.ctime()}) =======")
-                for item in config:
-                    # 动态地更新实例的路径，然后运行同步周期
-                    self.local_path = Path(item['local_path'])
-                    self.remote_path = item['remote_path']
-                    self.sync_cycle()
-                print(f"======= Auto-Sync Run Finished =======")
-
-                # Countdown to next sync
-                for i in range(self.sync_interval * len(config), 0, -1): # 等待时间可以适当延长
-                    print(f'\rNext run in {i} seconds...  ', end='')
-                    time.sleep(1)
-                print('\r' + ' ' * 60 + '\r', end='')
-                
-                # 退出检测逻辑保持不变
-                import sys, select
-                if sys.stdin in select.select([sys.stdin], [], [], 0)[0]:
-                    _ = sys.stdin.readline()
-                    print("\n[SYNC MODE DEACTIVATED] (检测到Enter) Returning to command menu.")
+    def __init__(self, host: str, port: int = 51234, timeout: float = 1.0, max_retries: int = 5,
+                 max_concurrency: int = 8):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.cwd = ""  # server directory relative to its base dir
+        self._address = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def connect(self) -> None:
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(self.host, self.port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self._address = infos[0][4]
+
+    async def close(self) -> None:
+        self._address = None
+
+    async def _open_channel(self, address=None) -> _DatagramChannel:
+        if self._address is None:
+            await self.connect()
+        loop = asyncio.get_running_loop()
+        _, channel = await loop.create_datagram_endpoint(
+            lambda: _DatagramChannel(self.timeout, self.max_retries),
+            remote_addr=address or self._address)
+        return channel
+
+    async def _open_session(self, cwd: str = None) -> _DatagramChannel:
+        """Open a channel to the main port positioned in the current (or given) directory"""
+        cwd = self.cwd if cwd is None else cwd
+        channel = await self._open_channel()
+        # 总是用绝对路径定位：重用的本地端口可能继承服务器上记录的旧目录
+        response = await channel.request(f"CD /{cwd}")
+        if not response.startswith("CD_OK"):
+            channel.close()
+            raise TransferError(f"Could not enter '{cwd}': {response}")
+        return channel
+
+    async def list(self) -> list:
+        """Return the entries of the current server directory (directories end with '/')"""
+        async with self._semaphore:
+            channel = await self._open_session()
+            try:
+                response = await channel.request("LIST_FILES")
+            finally:
+                channel.close()
+        if not response.startswith("OK"):
+            raise TransferError(f"Could not list files: {response}")
+        return response.split()[1:]
+
+    async def cd(self, path: str) -> str:
+        """Change the server directory and return the new one"""
+        channel = await self._open_session()
+        try:
+            response = await channel.request(f"CD {path}")
+        finally:
+            channel.close()
+        if not response.startswith("CD_OK"):
+            raise TransferError(response)
+        new_cwd = response.split(" Now in /", 1)[1]
+        self.cwd = "" if new_cwd == "." else new_cwd
+        return self.cwd
+
+    async def upload(self, local_path, remote_path: str = None, digest: str = None, cwd: str = None) -> bool:
+        """Upload a file; returns True if content was sent or linked from the server's store"""
+        local_path = Path(local_path)
+        remote_path = remote_path or local_path.name
+        async with self._semaphore:
+            channel = await self._open_session(cwd)
+            try:
+                await self._upload_on(channel, local_path, remote_path, digest)
+            finally:
+                channel.close()
+        return True
+
+    async def _upload_on(self, channel: _DatagramChannel, local_path: Path, remote_path: str,
+                         digest: str = None) -> None:
+        file_size = local_path.stat().st_size
+        dedup = self._address not in _NO_DEDUP
+        if dedup:
+            digest = digest or await asyncio.to_thread(calculate_md5, local_path)
+            response = await channel.request(f"HAVE {digest} {remote_path}")
+            if response == "HAVE_OK":
+                return
+            dedup = _note_have_reply(self._address, response)
+        session = await self._local_session(channel)
+        if session and await asyncio.to_thread(local_upload, session, local_path, remote_path):
+            return
+        if dedup and file_size >= CDC_MIN_FILE_SIZE and await self._chunked_upload_on(
+                channel, local_path, remote_path, digest, file_size):
+            return
+
+        response = await channel.request(f"UPLOAD {remote_path}", expect=UPLOAD_READY_REPLIES)
+        if response != "UPLOAD_READY":
+            raise TransferError(f"Server not ready for upload: {response}")
+        sparse = is_sparse(local_path.stat())
+        response = await channel.request(f"UPLOAD_SIZE {file_size} {'SPARSE' if sparse else 'DENSE'}",
+                                         expect=UPLOAD_SIZE_REPLIES)
+        if response != f"ACK_SIZE {file_size}":
+            raise TransferError(f"Server could not allocate the file: {response}")
+        hash_md5 = None if digest else hashlib.md5()
+        with local_path.open("rb") as f:
+            for offset, length, chunk in iter_extents(f, file_size):
+                message = _extent_message(offset, length, chunk)
+                for _ in range(DATA_RETRIES):
+                    response = await channel.request(message, expect=DATA_REPLIES)
+                    if response == f"ACK_DATA {offset}" or response.startswith("ERR"):
+                        break
+                    METRICS.inc("chunk_resends_total")
+                if response != f"ACK_DATA {offset}":
+                    raise TransferError(f"Failed to get ACK for a chunk: {response}")
+                if hash_md5:
+                    _update_md5_extent(hash_md5, length, chunk)
+        digest = digest or hash_md5.hexdigest()
+        response = await channel.request(f"UPLOAD_DONE {file_size} {digest}", expect=UPLOAD_DONE_REPLIES)
+        if response != "UPLOAD_COMPLETE":
+            raise TransferError(f"Unexpected final response: {response}")
+
+    async def _local_session(self, channel: _DatagramChannel) -> Optional[tuple]:
+        """Same-host transfer token, or None when the server is remote or does not offer it"""
+        if not wants_local_path(self._address):
+            return None
+        return _parse_local_hello(self._address, await channel.request("LOCAL_HELLO", expect=LOCAL_HELLO_REPLIES))
+
+    async def _chunked_upload_on(self, channel: _DatagramChannel, local_path: Path, remote_path: str,
+                                 digest: str, file_size: int) -> bool:
+        """Deduplicated upload; returns False if the server does not support it"""
+        recipe = await asyncio.to_thread(compute_cdc_recipe, local_path)
+        deadline = time.monotonic() + CDC_INDEX_WAIT
+        while True:
+            response = await channel.request(f"CDC_BEGIN {len(recipe)} {file_size} {remote_path}")
+            if response != "CDC_INDEXING" or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(CDC_INDEX_POLL)
+        if response != "CDC_READY":
+            return False
+        needed = []
+        for start in range(0, len(recipe), CDC_RECIPE_BATCH):
+            response = await channel.request(_build_cdc_recipe_message(recipe, start))
+            batch_needed = _parse_cdc_need(response, start)
+            if batch_needed is None:
+                raise TransferError(f"Unexpected recipe response: {response}")
+            needed.extend(batch_needed)
+        with local_path.open("rb") as f:
+            for index in needed:
+                chunk_offset, chunk_length, _ = recipe[index]
+                f.seek(chunk_offset)
+                for piece in range(0, chunk_length, 1024):
+                    body = f.read(min(1024, chunk_length - piece))
+                    message = f"CDC_DATA {index} {piece}\n{base64.b64encode(body).decode('utf-8')}"
+                    for _ in range(DATA_RETRIES):
+                        response = await channel.request(message, expect=CDC_DATA_REPLIES)
+                        if _is_cdc_data_reply(response, index, piece):
+                            break
+                        METRICS.inc("chunk_resends_total")
+                    if response != f"ACK_DATA {index} {piece}":
+                        raise TransferError(f"Failed to get ACK for chunk {index}: {response}")
+        deadline = time.monotonic() + CDC_INDEX_WAIT
+        while True:
+            response = await channel.request(f"CDC_COMMIT {digest}", expect=CDC_COMMIT_REPLIES)
+            if response != "CDC_COMMITTING" or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(CDC_INDEX_POLL)
+        if response != "CDC_DONE":
+            raise TransferError(f"Chunked upload failed: {response}")
+        return True
+
+    async def download(self, remote_name: str, local_path=None, cwd: str = None) -> Path:
+        """Download a file from the current (or given) server directory; returns the local path"""
+        local_path = Path(local_path) if local_path else Path("client_files") / Path(remote_name).name
+        async with self._semaphore:
+            channel = await self._open_session(cwd)
+            try:
+                session = await self._local_session(channel)
+                if session and await asyncio.to_thread(local_download, session, remote_name, local_path):
+                    return local_path
+                deadline = time.monotonic() + 30.0
+                response = await channel.request(f"DOWNLOAD {remote_name}")
+                while response.endswith(" BUSY") and time.monotonic() < deadline:
+                    # 服务器的数据端口都在使用中
+                    await asyncio.sleep(0.2)
+                    response = await channel.request(f"DOWNLOAD {remote_name}")
+            finally:
+                channel.close()
+            if response.endswith(" BUSY"):
+                raise TransferError(f"Server is busy, '{remote_name}' was not downloaded")
+            if not response.startswith("OK"):
+                raise TransferError(f"File '{remote_name}' not found on server")
+            parts = response.split()
+            file_size, data_address = int(parts[-3]), (self._address[0], int(parts[-1]))
+
+            data_channel = await self._open_channel(data_address)
+            try:
+                response = await data_channel.request(f"DOWNLOAD {remote_name}")
+                if response != "DOWNLOAD_READY":
+                    raise TransferError(f"Server not ready for download: {response}")
+                local_path.parent.mkdir(parents=True, exist_ok=True)
+                hash_md5 = hashlib.md5()
+                received = failures = 0
+                # 校验通过后才替换目标文件，失败时原有文件保持不变
+                tmp_path = partial_path(local_path, f"udp{secrets.token_hex(4)}")
+                try:
+                    with tmp_path.open("wb") as f:
+                        f.truncate(file_size)  # 零区不写入，留作空洞
+                        while True:
+                            response = await data_channel.request(f"GET_CHUNK {received}")
+                            if response.startswith("TRANSFER_COMPLETE"):
+                                break
+                            zeros = _parse_zero_reply(response)
+                            if zeros and zeros[0] == received:
+                                failures = 0
+                                update_md5_zeros(hash_md5, zeros[1])
+                                received += zeros[1]
+                                f.seek(received)
+                                continue
+                            chunk = _parse_data_reply(response)
+                            if chunk is None or chunk[0] != received:
+                                failures += 1
+                                METRICS.inc("chunk_resends_total")
+                                if failures > DATA_RETRIES:
+                                    raise TransferError("Invalid data chunk received from server.")
+                                continue
+                            failures = 0
+                            f.write(chunk[1])
+                            hash_md5.update(chunk[1])
+                            received += len(chunk[1])
+                        f.truncate(received)
+                    if not _verify_transfer(response, received, hash_md5.hexdigest()):
+                        raise TransferError(f"Download of '{remote_name}' failed verification: {response}")
+                    os.replace(tmp_path, local_path)
+                finally:
+                    tmp_path.unlink(missing_ok=True)
+            finally:
+                data_channel.close()
+        return local_path
+
+    async def _fetch_tree(self, channel: _DatagramChannel, folder: str) -> tuple:
+        """Fetch the TREE listing of <folder>; returns (folder path from the server root, records)"""
+        # 服务器在后台线程中计算清单，完成前回复 TREE_BUILDING
+        while True:
+            response = await channel.request(f"TREE {folder}", expect=TREE_REPLIES)
+            if response != "TREE_BUILDING":
+                break
+            await asyncio.sleep(TREE_POLL)
+        if not response.startswith("TREE_READY"):
+            raise TransferError(f"Could not list '{folder}': {response}")
+        _, num_chunks, _, root = response.split(' ', 3)
+        num_chunks = int(num_chunks)
+        chunks = {}
+        missing = list(range(num_chunks))
+        attempts = 0
+        while missing:
+            # 一次请求一个窗口，服务器连续发回，丢失的块留到下一轮重新请求
+            window = missing[:TREE_WINDOW]
+            channel.send("GET_TREE_CHUNK " + " ".join(map(str, window)))
+            received = 0
+            while received < len(window):
+                response = await channel.receive(self.timeout)
+                if response is None:
                     break
-            except Exception as e:
-                print(f"\n[ERROR] An error occurred during auto-sync loop: {e}")
-                print(f"Waiting {self.sync_interval} seconds before retrying...")
-                time.sleep(self.sync_interval)
+                header, _, body = response.partition('\n')
+                if response.startswith("ERR"):
+                    raise TransferError(f"Listing of '{folder}' failed: {response}")
+                if not header.startswith("TREE_CHUNK ") or not header[11:].isdigit():
+                    METRICS.inc("stale_replies_total")
+                    continue
+                index = int(header[11:])
+                if index in window and index not in chunks:
+                    chunks[index] = body
+                    received += 1
+            if received == 0:
+                METRICS.inc("retransmits_total")
+                attempts += 1
+                if attempts >= self.max_retries:
+                    raise TransferError(f"Server not responding after {self.max_retries} attempts.")
+            else:
+                attempts = 0
+            missing = [i for i in missing if i not in chunks]
+        with contextlib.suppress(TransferError):
+            await channel.request("TREE_DONE", expect=("TREE_DONE_OK",))
+
+        records = []
+        for i in range(num_chunks):
+            for line in chunks[i].split('\n'):
+                if line.startswith("D "):
+                    records.append(("D", line[2:], None))
+                elif line.startswith("F "):
+                    md5, _, rel_path = line[2:].partition(' ')
+                    records.append(("F", rel_path, md5))
+        root = root.lstrip('/')
+        return ("" if root == "." else root), records
+
+    async def download_folder(self, folder: str, local_dir=None) -> dict:
+        """Mirror a server folder (relative to the current directory) into local_dir.
+
+        The directory tree is created first; files whose local MD5 already matches are
+        skipped and the rest are downloaded concurrently. Returns a summary dict.
+        """
+        async with self._semaphore:
+            channel = await self._open_session()
+            try:
+                root, records = await self._fetch_tree(channel, folder)
+            finally:
+                channel.close()
+        if local_dir is None:
+            local_dir = Path("client_files") / (PurePosixPath(root).name or "server")
+        local_dir = Path(local_dir)
+        real_local_dir = local_dir.resolve()
+
+        def local_target(rel_path: str) -> Optional[Path]:
+            target = local_dir / rel_path
+            # 服务器给出的路径不能把文件写到目标目录之外
+            if '..' in PurePosixPath(rel_path).parts or not str(target.resolve()).startswith(str(real_local_dir)):
+                logger.warning("Skipping unsafe path from server: %s", rel_path)
+                return None
+            return target
+
+        local_dir.mkdir(parents=True, exist_ok=True)
+        directories = [local_target(rel) for kind, rel, _ in records if kind == "D"]
+        for directory in filter(None, directories):
+            directory.mkdir(parents=True, exist_ok=True)
+
+        files = [(rel, md5, local_target(rel)) for kind, rel, md5 in records if kind == "F"]
+        unsafe = [rel for rel, _, target in files if target is None]
+        files = [item for item in files if item[2] is not None]
+
+        def unchanged(md5: str, target: Path) -> bool:
+            return target.is_file() and calculate_md5(target) == md5
+
+        checks = await asyncio.gather(*(asyncio.to_thread(unchanged, md5, target) for _, md5, target in files))
+        queue = [(rel, target) for (rel, _, target), same in zip(files, checks) if not same]
+        results = await asyncio.gather(
+            *(self.download(f"{root}/{rel}" if root else rel, target, cwd="") for rel, target in queue),
+            return_exceptions=True)
+        failed = [rel for (rel, _), result in zip(queue, results) if isinstance(result, Exception)]
+        return {"path": str(local_dir), "dirs": len(directories), "files": len(files) + len(unsafe),
+                "downloaded": len(queue) - len(failed), "skipped": len(files) - len(queue),
+                "failed": failed + unsafe}
+
+    async def publish(self, remote_name: str, cwd: str = None) -> dict:
+        """Have the server stream a file once to its multicast group (see MulticastReceiver)"""
+        channel = await self._open_session(cwd)
+        try:
+            response = await channel.request(f"MCAST_PUBLISH {remote_name}", expect=MCAST_REPLIES)
+        finally:
+            channel.close()
+        if not response.startswith("MCAST_OK"):
+            raise TransferError(f"Could not publish '{remote_name}': {response}")
+        _, stream, group, size, chunks = response.split()
+        return {"stream": stream, "group": group, "bytes": int(size), "chunks": int(chunks)}
+
+    async def stats(self, prometheus: bool = False):
+        """Return the server's metrics (a dict, or Prometheus text if prometheus=True)"""
+        async with self._semaphore:
+            channel = await self._open_channel()
+            try:
+                response = await channel.request("STATS PROM" if prometheus else "STATS")
+            finally:
+                channel.close()
+        return response if prometheus else json.loads(response)
+
+    async def sync(self, local_path, remote_path: str, ignore: list = None, include: list = None) -> dict:
+        """Run one sync cycle of local_path into remote_path; returns a summary dict.
+
+        ignore/include are gitignore-style patterns applied together with <local_path>/.syncignore.
+        """
+        with METRICS.timer("sync_cycle_seconds"):
+            return await self._sync(local_path, remote_path, ignore, include)
+
+    async def _sync(self, local_path, remote_path: str, ignore: list = None, include: list = None) -> dict:
+        local_path = Path(local_path)
+        if not local_path.is_dir():
+            raise TransferError(f"Local directory '{local_path}' not found or is not a directory.")
+        rules = IgnoreRules.for_sync_root(local_path, ignore, include)
+        manifest = await asyncio.to_thread(generate_md5_manifest, str(local_path), rules)
+        payload = manifest_payload(manifest, rules)
+        chunks = [payload[i:i + 1024] for i in range(0, len(payload), 1024)]
+
+        async with self._semaphore:
+            channel = await self._open_session()
+            try:
+                response = await channel.request(f"SYNC_START {remote_path} {len(chunks)}")
+                if response != "SYNC_READY":
+                    raise TransferError(f"Server not ready for sync. Response: {response}")
+                for i, chunk in enumerate(chunks):
+                    response = await channel.request(f"SYNC_CHUNK {i}/{len(chunks)}\n{chunk}")
+                    if response != f"ACK_CHUNK {i}":
+                        raise TransferError(f"Manifest chunk {i} upload failed. ACK not received.")
+                while (response := await channel.request("SYNC_FINISH", expect=SYNC_FINISH_REPLIES)) == "SYNC_PROCESSING":
+                    await asyncio.sleep(SYNC_POLL)
+                files_to_upload = []
+                if response.startswith("NEEDS_FILES_READY"):
+                    num_chunks = int(response.split()[1])
+                    parts = [await channel.request(f"GET_SYNC_CHUNK {i}", timeout=5.0) for i in range(num_chunks)]
+                    files_to_upload = json.loads("".join(parts))['files']
+                elif response != "SYNC_OK_NO_CHANGES":
+                    raise TransferError(f"Unexpected sync response: {response}")
+            finally:
+                channel.close()
+
+        # remote_path 相对于服务器根目录，因此从根目录上传到 <remote_path>/<path>
+        to_upload = [path for path in files_to_upload if (local_path / path).is_file()]
+        remote_root = remote_path.strip('/')
+        results = await asyncio.gather(
+            *(self.upload(local_path / path, f"{remote_root}/{path}" if remote_root else path,
+                          manifest.get(path), cwd="") for path in to_upload),
+            return_exceptions=True)
+        failed = [path for path, result in zip(to_upload, results) if isinstance(result, Exception)]
+        return {"requested": len(files_to_upload), "uploaded": len(to_upload) - len(failed), "failed": failed}
 
 def download_file(filename, server_host, server_info):
     """Handle file download by creating a new data socket and calling the core download function."""
-    _file_size, data_port = server_info
+    file_size, data_port = server_info
     server_data_address = (server_host, data_port)
     local_file_path = Path("client_files") / Path(filename).name
 
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as data_sock:
-        _perform_download(data_sock, server_data_address, filename, local_file_path)
+        _perform_download(data_sock, server_data_address, filename, local_file_path, file_size)
+
+# Non-interactive mode: operations and how many arguments each accepts
+CLI_OPERATIONS = {"upload": (1, 2), "download": (1, 2), "sdownload": (1, 2), "sync": (0, 2), "ls": (0, 0),
+                  "cd": (1, 1), "stats": (0, 0), "publish": (1, 1)}
+BATCH_PARSE_ERROR = "parse-error"  # pseudo operation for a batch line shlex cannot split: args are (line, reason)
+
+def build_cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="client.py",
+        description="Non-interactive UDP-Localsend client. Prints one JSON object per operation.")
+    parser.add_argument("--host", default="localhost", help="server host (default: localhost)")
+    parser.add_argument("--port", type=int, default=51234, help="server port (default: 51234)")
+    parser.add_argument("--jobs", type=int, default=4, help="operations run concurrently (default: 4)")
+    parser.add_argument("--timeout", type=float, default=1.0, help="per-request timeout in seconds")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="logging verbosity on stderr")
+    parser.add_argument("--profile-dir", type=Path,
+                        help="write a cProfile dump of the run (and of each sync manifest) to this directory")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="with --profile-dir, also record tracemalloc allocation growth")
+    subparsers = parser.add_subparsers(dest="op", required=True)
+    upload = subparsers.add_parser("upload", help="upload a file")
+    upload.add_argument("args", nargs="+", metavar="local [remote]")
+    download = subparsers.add_parser("download", help="download a file from the server directory")
+    download.add_argument("args", nargs="+", metavar="remote [local]")
+    sdownload = subparsers.add_parser("sdownload", help="download a server folder recursively")
+    sdownload.add_argument("args", nargs="+", metavar="folder [local]")
+    sync = subparsers.add_parser("sync", help="sync one pair, or every pair in sync_config.json")
+    sync.add_argument("args", nargs="*", metavar="local remote")
+    subparsers.add_parser("ls", help="list the server directory").set_defaults(args=[])
+    subparsers.add_parser("stats", help="show the server's metrics").set_defaults(args=[])
+    cd = subparsers.add_parser("cd", help="change the server directory")
+    cd.add_argument("args", nargs=1, metavar="folder")
+    publish = subparsers.add_parser("publish", help="have the server multicast a file to every mcast-recv")
+    publish.add_argument("args", nargs=1, metavar="remote")
+    mcast_recv = subparsers.add_parser("mcast-recv", help="receive files the server multicasts")
+    mcast_recv.add_argument("args", nargs="?", default="client_files", metavar="local_dir")
+    mcast_recv.add_argument("--group", default=MCAST_GROUP, help=f"group:port to join (default: {MCAST_GROUP})")
+    mcast_recv.add_argument("--interface", default="",
+                            help="address of the interface to join on, e.g. 127.0.0.1 for loopback tests")
+    mcast_recv.add_argument("--count", type=int, default=1, help="files to receive before exiting (default: 1)")
+    mcast_recv.add_argument("--wait", type=float, default=60.0,
+                            help="give up after this many seconds without packets (default: 60)")
+    batch = subparsers.add_parser("batch", help="run operations from a file, one per line ('-' for stdin)")
+    batch.add_argument("args", nargs="?", default="-", metavar="file")
+    return parser
+
+def parse_batch_lines(lines) -> list:
+    """Parse batch lines like 'upload a.txt docs/a.txt' into (line_no, op, args) tuples"""
+    operations = []
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            tokens = shlex.split(line)
+        except ValueError as e:
+            # 例如引号未闭合：记为该行失败，不中断整个批处理
+            operations.append((line_no, BATCH_PARSE_ERROR, [line, str(e)]))
+            continue
+        operations.append((line_no, tokens[0].lower(), tokens[1:]))
+    return operations
+
+async def _run_cli_operation(client: AsyncClient, op: str, args: list) -> dict:
+    """Run one operation and return its result fields"""
+    if op == BATCH_PARSE_ERROR:
+        raise TransferError(f"Cannot parse '{args[0]}': {args[1]}")
+    if op not in CLI_OPERATIONS:
+        raise TransferError(f"Unknown operation '{op}'")
+    min_args, max_args = CLI_OPERATIONS[op]
+    if not min_args <= len(args) <= max_args or (op == "sync" and len(args) == 1):
+        raise TransferError(f"Wrong number of arguments for '{op}'")
+
+    if op == "upload":
+        local_path = Path(args[0])
+        await client.upload(local_path, args[1] if len(args) > 1 else local_path.name)
+        return {"bytes": local_path.stat().st_size}
+    if op == "download":
+        local_path = await client.download(args[0], args[1] if len(args) > 1 else None)
+        return {"bytes": local_path.stat().st_size, "path": str(local_path)}
+    if op == "sdownload":
+        summary = await client.download_folder(args[0], args[1] if len(args) > 1 else None)
+        if summary['failed']:
+            raise TransferError(f"{len(summary['failed'])} file(s) failed to download")
+        return summary
+    if op == "sync":
+        pairs = [{"local_path": args[0], "remote_path": args[1]}] if args else load_sync_config()
+        # 各同步对并发运行，并发量由 AsyncClient 的 max_concurrency (--jobs) 限制
+        summaries = await asyncio.gather(
+            *(client.sync(item['local_path'], item['remote_path'], item.get('ignore'), item.get('include'))
+              for item in pairs), return_exceptions=True)
+        results = []
+        for item, summary in zip(pairs, summaries):
+            if isinstance(summary, Exception):
+                summary = {"error": str(summary), "failed": [item['local_path']]}
+            results.append({"local_path": item['local_path'], "remote_path": item['remote_path'], **summary})
+        failed = [r for r in results if r['failed']]
+        if failed:
+            raise TransferError(f"{sum(len(r['failed']) for r in failed)} file(s) failed to sync")
+        return {"pairs": results}
+    if op == "ls":
+        return {"entries": await client.list()}
+    if op == "stats":
+        return {"server": await client.stats()}
+    if op == "publish":
+        return await client.publish(args[0])
+    return {"cwd": await client.cd(args[0])}
+
+async def run_batch(client: AsyncClient, operations: list, jobs: int, emit) -> tuple:
+    """Run (line_no, op, args) operations with up to `jobs` in flight; cd waits for earlier operations"""
+    semaphore = asyncio.Semaphore(max(1, jobs))
+    pending = set()
+    counts = {"ok": 0, "failed": 0}
+
+    async def run_one(line_no, op, args):
+        async with semaphore:
+            record = {"line": line_no, "op": op, "args": args}
+            start = time.perf_counter()
+            try:
+                record.update(await _run_cli_operation(client, op, args))
+                record["ok"] = True
+            except Exception as e:
+                record["ok"] = False
+                record["error"] = str(e)
+            record["seconds"] = round(time.perf_counter() - start, 6)
+            counts["ok" if record["ok"] else "failed"] += 1
+            emit(record)
+
+    for line_no, op, args in operations:
+        if op == "cd" and pending:
+            # 目录切换只影响之后的操作
+            await asyncio.gather(*pending)
+            pending.clear()
+        task = asyncio.ensure_future(run_one(line_no, op, args))
+        pending.add(task)
+        if op == "cd":
+            await task
+            pending.clear()
+    if pending:
+        await asyncio.gather(*pending)
+    return counts["ok"], counts["failed"]
+
+def run_cli(argv: list) -> int:
+    """Entry point for 'client.py <upload|download|sync|ls|cd|publish|batch|mcast-recv> ...'"""
+    args = build_cli_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    if args.op == "batch":
+        if args.args == "-":
+            operations = parse_batch_lines(sys.stdin)
+        else:
+            with open(args.args, 'r', encoding='utf-8') as f:
+                operations = parse_batch_lines(f)
+    else:
+        operations = [(0, args.op, args.args)]
+
+    json_out = sys.stdout
+
+    def emit(record: dict) -> None:
+        json_out.write(json.dumps(record) + "\n")
+        json_out.flush()
+
+    if args.op == "mcast-recv":
+        return run_mcast_recv(args, emit)
+
+    async def run() -> tuple:
+        async with AsyncClient(args.host, args.port, timeout=args.timeout, max_concurrency=args.jobs) as client:
+            return await run_batch(client, operations, args.jobs, emit)
+
+    if args.profile_dir:
+        PROFILER.enable(args.profile_dir, memory=args.profile_memory)
+    start = time.perf_counter()
+    # 人类可读的输出全部转到 stderr，stdout 只保留 JSON 行
+    with contextlib.redirect_stdout(sys.stderr), PROFILER.section("cli", args.op):
+        ok, failed = asyncio.run(run())
+    emit({"op": "summary", "ok": ok, "failed": failed, "seconds": round(time.perf_counter() - start, 6),
+          "metrics": METRICS.snapshot()})
+    return 0 if failed == 0 else 1
+
+def run_mcast_recv(args, emit) -> int:
+    """'client.py mcast-recv': one JSON line per received file, then a summary"""
+    start = time.perf_counter()
+    counts = {"ok": 0, "failed": 0}
+    with MulticastReceiver(args.group, args.interface, args.args) as receiver:
+        for result in receiver.receive(args.wait):
+            counts["ok" if result["ok"] else "failed"] += 1
+            emit({"op": "mcast-recv", **result})
+            if counts["ok"] + counts["failed"] >= args.count:
+                break
+    missing = args.count - counts["ok"] - counts["failed"]
+    emit({"op": "summary", "ok": counts["ok"], "failed": counts["failed"] + missing,
+          "seconds": round(time.perf_counter() - start, 6), "metrics": METRICS.snapshot()})
+    return 0 if counts["failed"] + missing == 0 else 1
 
 def parse_command_line_args():
     """
@@ -450,18 +1832,22 @@ def display_command_menu():
     *！COMMAND MENU ! ^^^^^check the available entries on server^^^^
     ********************************************
     * sync list                    - Show all configured sync pairs
-    * sync add <local> <remote>    - Add a new folder pair to sync 
+    * sync add <local> <remote> [ignore...] - Add a new folder pair to sync 
     [WARNING: Never map different local folders (local_path) to a single remote folder (remote_path)]
     * sync remove <id>             - Remove a sync pair by its ID
+    * sync interval <id> <seconds> - Set how often a pair syncs in auto mode
     * sync run                     - Run a one-time sync for all pairs
     * sync auto                    - Start continuous automatic syncing
     ********************************************
     * <filename>                   - Download a file by entering its name
     * all                          - Download all files in the current directory
+    * sdownload <folder> [local]   - Download an entire folder (skips files that are already up to date)
     * upload <filename> or <path>  - Upload a file to the server
     * supload <folder> or <path>   - Upload an entire folder to the server
     * cd <folder>                  - Change to the specified directory (e.g., cd my_files)
     * cd ..                        - Go back to the parent directory
+    * publish <filename>           - Multicast a file to every 'client.py mcast-recv' on the network
+    * stats                        - Show server metrics
     * kill                         - kill every files on server
     * (press enter)                - Exit the client
 
@@ -483,15 +1869,22 @@ def handle_sync_subcommands(sock, server_address, args):
         print("\n--- Configured Sync Pairs ---")
         for item in sorted(config, key=lambda x: x['id']):
             print(f"  ID: {item['id']:<3} Local: '{item['local_path']}'  ==>  Remote: '{item['remote_path']}'")
+            if 'interval' in item:
+                print(f"         Auto-sync interval: {item['interval']:g}s")
+            if item.get('ignore') or item.get('include'):
+                print(f"         Ignore: {item.get('ignore') or []}  Include: {item.get('include') or []}")
         print("-----------------------------")
 
-    elif subcommand == 'add' and len(args) == 3:
+    elif subcommand == 'add' and len(args) >= 3:
         local_path, remote_path = args[1], args[2]
         if not Path(local_path).is_dir():
             print(f"\n[ERROR] Local path '{local_path}' is not a valid directory.")
             return
         new_id = max([item['id'] for item in config] + [0]) + 1
-        config.append({"id": new_id, "local_path": local_path, "remote_path": remote_path})
+        new_item = {"id": new_id, "local_path": local_path, "remote_path": remote_path}
+        if len(args) > 3:
+            new_item["ignore"] = args[3:]  # sync add <local> <remote> node_modules/ *.tmp ...
+        config.append(new_item)
         save_sync_config(config)
         print(f"\n[SUCCESS] Added sync pair (ID: {new_id}).")
 
@@ -507,25 +1900,38 @@ def handle_sync_subcommands(sock, server_address, args):
         except ValueError:
             print("\n[ERROR] Please provide a valid numeric ID to remove.")
 
+    elif subcommand == 'interval' and len(args) == 3:
+        try:
+            pair_id, seconds = int(args[1]), float(args[2])
+        except ValueError:
+            print("\n[ERROR] Usage: sync interval <id> <seconds>")
+            return
+        item = next((item for item in config if item['id'] == pair_id), None)
+        if item is None or seconds <= 0:
+            print(f"\n[ERROR] No sync pair found with ID: {pair_id}" if item is None else "\n[ERROR] Interval must be positive.")
+            return
+        item['interval'] = seconds
+        save_sync_config(config)
+        print(f"\n[SUCCESS] Sync pair {pair_id} now syncs every {seconds:g} seconds in auto mode.")
+
     elif subcommand == 'run':
         if not config:
             print("\nNo sync pairs to run.")
             return
-        print("\nStarting manual sync run...")
-        for item in config:
-            # 为每个同步任务创建一个临时的 SyncManager 实例并运行
-            sync_manager = SyncManager(sock, server_address, item['local_path'], item['remote_path'])
-            sync_manager.sync_cycle()
+        print(f"\nStarting manual sync run ({len(config)} pair(s), up to {SYNC_WORKERS} at a time)...")
+        # 每个同步对在自己的线程和 socket 上运行
+        failed = SyncScheduler(server_address).run_once(config)
+        print(f"\nManual sync run finished: {len(config) - failed} ok, {failed} failed.")
 
     elif subcommand == 'auto':
-        # 创建一个 SyncManager 实例来启动自动同步模式
-        # 初始路径不重要，因为会在循环中被覆盖
-        sync_manager = SyncManager(sock, server_address, "", "")
-        sync_manager.start_sync_mode()
+        print("\n[AUTO SYNC MODE ACTIVATED]")
+        print(f"Each pair syncs on its own schedule (default every {SYNC_INTERVAL:g}s), up to {SYNC_WORKERS} at a time.")
+        print("按下Enter键退出sync模式。")
+        SyncScheduler(server_address).run_auto()
         
     else:
         print(f"\n[ERROR] Unknown sync subcommand or incorrect arguments: '{' '.join(args)}'")
-        print("Usage: sync <list|add|remove|run|auto>")
+        print("Usage: sync <list|add|remove|interval|run|auto>")
 
 def handle_command(sock, server_address, command, files, server_host):
     if not command:
@@ -545,6 +1951,12 @@ def handle_command(sock, server_address, command, files, server_host):
         handle_sync_subcommands(sock, server_address, parts[1:])
     elif base_command == 'kill':
         handle_kill_command(sock, server_address)
+    elif base_command == 'stats':
+        handle_stats_command(sock, server_address)
+    elif base_command == 'publish' and len(parts) > 1:
+        handle_publish_command(sock, server_address, command.split(' ', 1)[1])
+    elif base_command == 'sdownload' and len(parts) > 1:
+        handle_super_download(sock, server_address, parts[1], parts[2] if len(parts) > 2 else None)
     elif base_command == 'all':
         handle_all_command(sock, server_address, files, server_host)
     else:
@@ -561,6 +1973,39 @@ def handle_cd_command(sock, server_address, command):
     except Exception as e:
         print(f"\n[ERROR] Failed to send cd command: {str(e)}")
 
+def handle_stats_command(sock, server_address):
+    """Handle stats command: show the server's counters and latency histograms."""
+    try:
+        response_str, _ = sendAndReceive(sock, "STATS", server_address)
+        stats = json.loads(response_str)
+    except Exception as e:
+        print(f"\n[ERROR] Failed to get server stats: {str(e)}")
+        return
+    print("\n--- Server Counters ---")
+    for name, value in sorted(stats['counters'].items()):
+        print(f"  {name:<45} {value:g}")
+    if stats.get('gauges'):
+        print("--- Server Gauges ---")
+        for name, value in sorted(stats['gauges'].items()):
+            print(f"  {name:<45} {value:g}")
+    print("--- Server Latencies (seconds) ---")
+    for name, hist in sorted(stats['histograms'].items()):
+        print(f"  {name:<45} count={hist['count']} sum={hist['sum']:.3f} p50<={hist['p50']} p99<={hist['p99']}")
+
+def handle_publish_command(sock, server_address, filename):
+    """Handle publish command: the server multicasts the file once to all receivers."""
+    try:
+        response_str, _ = sendAndReceive(sock, f"MCAST_PUBLISH {filename}", server_address, expect=MCAST_REPLIES)
+    except Exception as e:
+        print(f"\n[ERROR] Failed to publish: {str(e)}")
+        return
+    if response_str.startswith("MCAST_OK"):
+        _, stream, group, size, _ = response_str.split()
+        print(f"\n[SUCCESS] Streaming '{filename}' ({size} bytes) to {group} as stream {stream}.")
+        print(f"Receivers run: python3 client.py mcast-recv --group {group}")
+    else:
+        print(f"\n[ERROR] Server could not publish '{filename}': {response_str}")
+
 def handle_kill_command(sock, server_address):
     """Handle kill command to delete all server files."""
     try:
@@ -574,6 +2019,24 @@ def handle_kill_command(sock, server_address):
     except Exception as e:
         print(f"\n[ERROR] Failed to send kill command: {str(e)}")
 
+def _try_local_download(sock, server_address, filename) -> bool:
+    """Download through the same-host fast path if the server runs on this machine"""
+    local_file_path = Path("client_files") / Path(filename).name
+    session = _local_session(sock, server_address)
+    if session and local_download(session, filename, local_file_path):
+        print(f"\n[SUCCESS] File '{filename}' downloaded successfully to '{local_file_path}' (same host)!")
+        return True
+    return False
+
+def _request_download(sock, server_address, filename, busy_wait=30.0):
+    """Send DOWNLOAD, waiting while every server data port is busy ("ERR <name> BUSY")"""
+    deadline = time.monotonic() + busy_wait
+    while True:
+        response_str, _ = sendAndReceive(sock, f"DOWNLOAD {filename}", server_address)
+        if not (response_str.startswith("ERR") and response_str.endswith(" BUSY")) or time.monotonic() > deadline:
+            return response_str
+        time.sleep(0.2)
+
 def handle_all_command(sock, server_address, files, server_host):
     """Handle download all files command."""
     if not files:
@@ -584,13 +2047,16 @@ def handle_all_command(sock, server_address, files, server_host):
         if file_to_download.endswith('/'):
             continue
             
-        message = f"DOWNLOAD {file_to_download}"
         try:
-            response_str, _ = sendAndReceive(sock, message, server_address)
+            if _try_local_download(sock, server_address, file_to_download):
+                continue
+            response_str = _request_download(sock, server_address, file_to_download)
             if response_str.startswith("OK"):
                 parts = response_str.split()
                 server_info = (int(parts[3]), int(parts[5]))
                 download_file(parts[1], server_host, server_info)
+            elif response_str.endswith(" BUSY"):
+                print(f"Error: Server is busy, '{file_to_download}' was not downloaded")
             elif response_str.startswith("ERR"):
                 print(f"Error: File '{file_to_download}' not found on server")
         except Exception as e:
@@ -598,15 +2064,38 @@ def handle_all_command(sock, server_address, files, server_host):
             continue
     print("\nBatch download completed.")
 
+def handle_super_download(sock, server_address, folder, local_dir=None):
+    """Handle recursive folder download command."""
+    try:
+        # "CD ." 不改变目录，只用来取得当前的服务器目录
+        response_str, _ = sendAndReceive(sock, "CD .", server_address)
+        if not response_str.startswith("CD_OK"):
+            print(f"Error: {response_str}")
+            return
+        cwd = response_str.split(" Now in /", 1)[1]
+        client = AsyncClient(server_address[0], server_address[1])
+        client.cwd = "" if cwd == "." else cwd
+        summary = asyncio.run(client.download_folder(folder, local_dir))
+    except Exception as e:
+        print(f"Error during folder download: {str(e)}")
+        return
+    print(f"\nFolder download completed into {summary['path']}: {summary['downloaded']} downloaded, "
+          f"{summary['skipped']} already up to date, {len(summary['failed'])} failed.")
+    for rel_path in summary['failed']:
+        print(f"  [FAILED] {rel_path}")
+
 def handle_single_download(sock, server_address, filename, server_host):
     """Handle single file download command."""
-    message = f"DOWNLOAD {filename}"
     try:
-        response_str, _ = sendAndReceive(sock, message, server_address)
+        if _try_local_download(sock, server_address, filename):
+            return
+        response_str = _request_download(sock, server_address, filename)
         if response_str.startswith("OK"):
             parts = response_str.split()
             server_info = (int(parts[3]), int(parts[5]))
             download_file(parts[1], server_host, server_info)
+        elif response_str.endswith(" BUSY"):
+            print("Error: Server is busy, try again later")
         elif response_str.startswith("ERR"):
             print("Error: File not found on server")
     except Exception as e:
@@ -614,6 +2103,12 @@ def handle_single_download(sock, server_address, filename, server_host):
 
 def main():
     """Main function to run the client."""
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    if os.environ.get("UDP_LOCALSEND_PROFILE_DIR"):
+        # 交互模式下通过环境变量开启性能分析，每个同步周期写一份 dump
+        PROFILER.enable(Path(os.environ["UDP_LOCALSEND_PROFILE_DIR"]))
+    # Create client_files directory at program start
+    Path("client_files").mkdir(exist_ok=True)
     server_host, server_port = get_server_address()
     server_address = (server_host, server_port)
     client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -634,4 +2129,7 @@ def main():
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and (sys.argv[1] in CLI_OPERATIONS or sys.argv[1] in ("batch", "mcast-recv", "-h", "--help")
+                              or sys.argv[1].startswith("--")):
+        sys.exit(run_cli(sys.argv[1:]))
     main()
\ No newline at end of file
@@ -0,0 +1,510 @@
+"""Helpers shared by server.py and client.py: metrics, profiling, chunking and the local fast path"""
+import os
+import bisect
+import hashlib
+import json
+import logging
+import errno
+import fcntl
+import functools
+import contextlib
+import cProfile
+import tracemalloc
+import itertools
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger("udp_localsend.common")
+
+class Metrics:
+    """Thread-safe counters and histograms, exportable as JSON or Prometheus text"""
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {"buckets": [0] * (len(self.BUCKETS) + 1), "count": 0, "sum": 0.0}
+            hist["buckets"][bisect.bisect_left(self.BUCKETS, value)] += 1
+            hist["count"] += 1
+            hist["sum"] += value
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _series(name: str, labels: tuple) -> str:
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def _quantile(self, hist: dict, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile (None if above the last bucket)"""
+        target = q * hist["count"]
+        seen = 0
+        for bound, count in zip(self.BUCKETS, hist["buckets"]):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = {self._series(n, l): v for (n, l), v in self._counters.items()}
+            gauges = {self._series(n, l): v for (n, l), v in self._gauges.items()}
+            histograms = {
+                self._series(n, l): {"count": h["count"], "sum": round(h["sum"], 6),
+                                     "p50": self._quantile(h, 0.5), "p99": self._quantile(h, 0.99)}
+                for (n, l), h in self._histograms.items()
+            }
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"{self.prefix}_{self._series(name, labels)} {value}")
+            for (name, labels), value in sorted(self._gauges.items()):
+                lines.append(f"{self.prefix}_{self._series(name, labels)} {value}")
+            for (name, labels), hist in sorted(self._histograms.items()):
+                full = f"{self.prefix}_{name}"
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ("+Inf",), hist["buckets"]):
+                    cumulative += count
+                    lines.append(f"{self._series(full + '_bucket', labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{self._series(full + '_sum', labels)} {hist['sum']}")
+                lines.append(f"{self._series(full + '_count', labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: Path) -> None:
+        """Write the metrics atomically, as Prometheus text for *.prom files and JSON otherwise"""
+        text = self.to_prometheus() if path.suffix == ".prom" else json.dumps(self.snapshot(), indent=2)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(text, encoding='utf-8')
+        os.replace(tmp_path, path)
+
+METRICS = Metrics("udp_localsend")  # each script sets its own prefix
+
+_NO_PROFILE = contextlib.nullcontext()
+
+class Profiler:
+    """On-demand cProfile and tracemalloc capture, written as dumps under output_dir.
+
+    Session sections (a sync manifest, a download) get one dump each; aggregate
+    sections accumulate per label until flush(). Time is attributed to the innermost
+    active section on a thread. When disabled, section() is a flag check.
+    """
+    MEMORY_TOP = 30  # allocation sites listed per memory dump
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.output_dir: Optional[Path] = None
+        self.dumps = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._aggregate = {}  # "name-label" -> cProfile.Profile
+        self._seq = itertools.count(1)
+
+    def enable(self, output_dir: Path, memory: bool = False) -> None:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        self.output_dir = output_dir
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+        self.memory = memory
+        self.enabled = True
+
+    def disable(self) -> list:
+        """Stop capturing; returns the files written by the final flush"""
+        self.enabled = False
+        written = self.flush()
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.memory = False
+        return written
+
+    def section(self, name: str, label: str = "", aggregate: bool = False):
+        if not self.enabled:
+            return _NO_PROFILE
+        return self._profiled(name, label, aggregate)
+
+    @contextlib.contextmanager
+    def _profiled(self, name: str, label: str, aggregate: bool):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        if aggregate:
+            with self._lock:
+                profile = self._aggregate.setdefault(f"{name}-{label}", cProfile.Profile())
+        else:
+            profile = cProfile.Profile()
+        snapshot = tracemalloc.take_snapshot() if self.memory and not aggregate and tracemalloc.is_tracing() else None
+        outer = stack[-1] if stack else None
+        if outer:
+            outer.disable()
+        try:
+            profile.enable()
+            stack.append(profile)
+        except ValueError:
+            # Python 3.12+ allows one active profiler per interpreter
+            METRICS.inc("profile_skipped_total")
+            profile = None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                stack.pop()
+                if not aggregate:
+                    # written before the outer section resumes, so it does not count the dump itself
+                    self._write(name, label, profile, snapshot, time.perf_counter() - start)
+            if outer:
+                outer.enable()
+
+    def _path(self, name: str, label: str, suffix: str) -> Path:
+        safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", f"{name}-{label}" if label else name)[:80]
+        return self.output_dir / f"{time.strftime('%Y%m%d-%H%M%S')}-{next(self._seq):04d}-{safe}{suffix}"
+
+    def _write(self, name: str, label: str, profile: cProfile.Profile, snapshot, seconds: float) -> list:
+        written = []
+        try:
+            path = self._path(name, label, ".prof")
+            profile.dump_stats(path)
+            written.append(path)
+            if snapshot is not None:
+                stats = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+                mem_path = self._path(name, label, ".mem.txt")
+                lines = [f"# {name} {label}: {seconds:.3f}s, allocation growth by line"]
+                mem_path.write_text("\n".join(lines + [str(stat) for stat in stats[:self.MEMORY_TOP]]) + "\n",
+                                    encoding='utf-8')
+                written.append(mem_path)
+        except OSError as e:
+            logger.warning("[Profile] Failed to write profile for %s %s: %s", name, label, e)
+        with self._lock:
+            self.dumps += len(written)
+        METRICS.inc("profile_dumps_total", len(written))
+        logger.info("[Profile] %s %s took %.3fs -> %s", name, label, seconds, ', '.join(map(str, written)))
+        return written
+
+    def flush(self) -> list:
+        """Write and reset the aggregate profiles, plus a snapshot of live allocations"""
+        with self._lock:
+            aggregate, self._aggregate = self._aggregate, {}
+        written = []
+        if self.output_dir is None:
+            return written
+        for key, profile in sorted(aggregate.items()):
+            try:
+                path = self._path("total", key, ".prof")
+                profile.dump_stats(path)
+                written.append(path)
+            except (OSError, TypeError) as e:  # TypeError: profile never collected any stats
+                logger.debug("[Profile] Skipping %s: %s", key, e)
+        if self.memory and tracemalloc.is_tracing():
+            path = self._path("total", "memory", ".mem.txt")
+            stats = tracemalloc.take_snapshot().statistics("lineno")
+            path.write_text("\n".join(str(stat) for stat in stats[:self.MEMORY_TOP]) + "\n", encoding='utf-8')
+            written.append(path)
+        with self._lock:
+            self.dumps += len(written)
+        METRICS.inc("profile_dumps_total", len(written))
+        return written
+
+    def status(self) -> dict:
+        return {"enabled": self.enabled, "memory": self.memory,
+                "dir": str(self.output_dir) if self.output_dir else None, "dumps": self.dumps}
+
+PROFILER = Profiler()
+
+# Content-defined chunking parameters; server and client must agree so boundaries line up
+CDC_MIN_SIZE = 16 * 1024
+CDC_AVG_SIZE = 64 * 1024
+CDC_MAX_SIZE = 256 * 1024
+CDC_MIN_FILE_SIZE = 1024 * 1024  # smaller files are always uploaded whole
+_CDC_GEAR = [int.from_bytes(hashlib.md5(bytes([i])).digest()[:8], 'little') for i in range(256)]
+_CDC_MASK_S = ((1 << 18) - 1) << 46  # stricter mask before the average size (FastCDC normalisation)
+_CDC_MASK_L = ((1 << 14) - 1) << 50  # looser mask after it
+
+def cdc_chunks(data) -> list:
+    """Split a bytes-like object into content-defined chunks, returning (offset, length) pairs"""
+    chunks = []
+    gear = _CDC_GEAR
+    n = len(data)
+    start = 0
+    while start < n:
+        remaining = n - start
+        if remaining <= CDC_MIN_SIZE:
+            chunks.append((start, remaining))
+            break
+        end = start + min(remaining, CDC_MAX_SIZE)
+        normal = start + min(remaining, CDC_AVG_SIZE)
+        cut = end
+        h = 0
+        i = start + CDC_MIN_SIZE
+        while i < normal:
+            h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+            i += 1
+            if not h & _CDC_MASK_S:
+                cut = i
+                break
+        else:
+            while i < end:
+                h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+                i += 1
+                if not h & _CDC_MASK_L:
+                    cut = i
+                    break
+        chunks.append((start, cut - start))
+        start = cut
+    return chunks
+
+ZERO_BLOCK = bytes(1024 * 1024)
+
+def is_zero_block(data) -> bool:
+    return data.count(0) == len(data)
+
+def update_md5_zeros(hash_md5, length: int) -> None:
+    """Feed `length` zero bytes into a running digest"""
+    zeros = memoryview(ZERO_BLOCK)
+    while length > 0:
+        step = min(length, len(ZERO_BLOCK))
+        hash_md5.update(zeros[:step])
+        length -= step
+
+SYNCIGNORE_FILE = ".syncignore"
+
+def _translate_ignore_glob(glob: str) -> str:
+    """Regex for one gitignore-style glob: * and ? stay within a path segment, ** crosses segments"""
+    out = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif glob.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif glob[i] == "*":
+            out.append("[^/]*")
+            i += 1
+        elif glob[i] == "?":
+            out.append("[^/]")
+            i += 1
+        elif glob[i] == "[" and glob.find("]", i + 2) != -1:
+            end = glob.find("]", i + 2)
+            body = glob[i + 1:end]
+            out.append("[" + ("^" + body[1:] if body.startswith("!") else body).replace("\\", "\\\\") + "]")
+            i = end + 1
+        elif glob[i] == "\\" and i + 1 < len(glob):
+            out.append(re.escape(glob[i + 1]))
+            i += 2
+        else:
+            out.append(re.escape(glob[i]))
+            i += 1
+    return "".join(out)
+
+class IgnoreRules:
+    """gitignore-style exclude rules for a sync root, compiled once.
+
+    Supports '#' comments, '!' re-includes, a trailing '/' for directories only, and
+    '*', '?', '[...]' and '**'. A pattern without a '/' (other than a trailing one)
+    matches at any depth; otherwise it is anchored at the root. The last matching
+    pattern wins. An ignored directory is not descended into, so nothing below it can
+    be re-included.
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = []  # the patterns in effect, as sent to the server
+        self._rules = []    # (regex, negate, directories only)
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern: str) -> None:
+        line = pattern.strip()
+        if not line or line.startswith("#"):
+            return
+        body = line
+        negate = body.startswith("!")
+        if negate:
+            body = body[1:]
+        elif body.startswith(("\\!", "\\#")):
+            body = body[1:]
+        dir_only = body.endswith("/")
+        body = body.rstrip("/")
+        if not body:
+            return
+        anchored = "/" in body
+        regex = ("" if anchored else "(?:.*/)?") + _translate_ignore_glob(body.lstrip("/"))
+        try:
+            self._rules.append((re.compile(regex, re.DOTALL), negate, dir_only))
+        except re.error as e:
+            logger.warning("Ignoring invalid ignore pattern %r: %s", line, e)
+            return
+        self.patterns.append(line)
+
+    def __bool__(self) -> bool:
+        return bool(self._rules)
+
+    def ignored(self, rel_path: str, is_dir: bool) -> bool:
+        """Whether a path relative to the sync root ('/'-separated) is excluded"""
+        for regex, negate, dir_only in reversed(self._rules):
+            if (is_dir or not dir_only) and regex.fullmatch(rel_path):
+                return not negate
+        return False
+
+    @classmethod
+    def for_sync_root(cls, root: Path, ignore=None, include=None) -> "IgnoreRules":
+        """Rules of one sync pair: its 'ignore' list, then <root>/.syncignore, then its 'include' list"""
+        patterns = list(ignore or [])
+        try:
+            patterns += (Path(root) / SYNCIGNORE_FILE).read_text(encoding='utf-8').splitlines()
+        except FileNotFoundError:
+            pass
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"[WARNING] Could not read {SYNCIGNORE_FILE} in '{root}': {e}")
+        patterns += [f"!{pattern}" for pattern in include or []]
+        return cls(patterns)
+
+WALK_WORKERS = 8  # threads scanning subdirectories of wide trees in parallel
+
+class TreeEntry(NamedTuple):
+    """One entry found by walk_tree; st_size/st_mtime_ns are 0 for directories"""
+    rel_path: str      # '/'-separated, relative to the walk root
+    path: str          # absolute (or root-relative) filesystem path
+    is_dir: bool
+    st_size: int
+    st_mtime_ns: int
+
+def _scan_directory(directory: str, prefix: str, ignore, skip) -> tuple:
+    """List one directory: (entries, subdirectories to descend into)"""
+    entries, subdirs = [], []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                rel_path = prefix + entry.name
+                try:
+                    # DirEntry 的类型来自 readdir，无需额外 stat；只有文件才 stat 一次取大小和 mtime
+                    is_dir = entry.is_dir()
+                    if not is_dir and not entry.is_file():
+                        continue
+                    if (skip and skip(rel_path, is_dir)) or (ignore and ignore.ignored(rel_path, is_dir)):
+                        continue
+                    if is_dir:
+                        entries.append(TreeEntry(rel_path, entry.path, True, 0, 0))
+                        if not entry.is_symlink():
+                            subdirs.append((entry.path, rel_path + "/"))
+                    else:
+                        st = entry.stat()
+                        entries.append(TreeEntry(rel_path, entry.path, False, st.st_size, st.st_mtime_ns))
+                except OSError as e:
+                    logger.debug("Skipping %s: %s", entry.path, e)
+    except OSError as e:
+        logger.debug("Cannot scan %s: %s", directory, e)
+    return entries, subdirs
+
+def walk_tree(root, ignore=None, skip=None, recursive: bool = True, workers: int = WALK_WORKERS):
+    """Yield a TreeEntry for every directory and regular file under root, in no particular order.
+
+    Built on os.scandir, so each entry costs at most one stat. Subdirectories are scanned
+    in parallel on up to `workers` threads. Directories rejected by `ignore` (IgnoreRules)
+    or by skip(rel_path, is_dir) are not descended into. Symlinked directories are
+    listed but not followed.
+    """
+    entries, pending = _scan_directory(os.fspath(root), "", ignore, skip)
+    yield from entries
+    if not recursive or not pending:
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_scan_directory, path, prefix, ignore, skip) for path, prefix in pending}
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                entries, subdirs = future.result()
+                futures |= {pool.submit(_scan_directory, path, prefix, ignore, skip) for path, prefix in subdirs}
+                yield from entries
+
+PARTIAL_SUFFIX = ".part"  # transfers in progress: ".<name>.<tag>.part" next to their target
+
+def partial_path(target_path: Path, tag: str) -> Path:
+    """Temp file a transfer streams into before it is renamed over target_path"""
+    return target_path.with_name(f".{target_path.name}.{tag}{PARTIAL_SUFFIX}")
+
+def is_partial_name(name: str) -> bool:
+    return name.startswith(".") and name.endswith(PARTIAL_SUFFIX)
+
+FICLONE = 0x40049409  # Linux ioctl for reflink copies
+COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY}
+
+@functools.lru_cache(maxsize=64)
+def is_local_address(host: str) -> bool:
+    """True if host is an address of this machine, i.e. a socket can be bound to it"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind((host, 0))
+        return True
+    except OSError:
+        return False
+
+def copy_file_data(src_fd: int, dst_fd: int, size: int) -> str:
+    """Copy the first `size` bytes of one regular file into another; returns the method used.
+
+    A reflink shares the blocks on btrfs/XFS, copy_file_range copies inside the kernel (and
+    lets NFS/CIFS copy on the server), and a pread/pwrite loop covers everything else.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError:
+        pass  # 不支持 reflink 的文件系统，或不在同一文件系统
+    else:
+        if os.fstat(dst_fd).st_size != size:
+            raise OSError(errno.EIO, "source changed during the copy")
+        return "reflink"
+    copied = 0
+    method = "copy_file_range"
+    try:
+        while copied < size:
+            n = os.copy_file_range(src_fd, dst_fd, size - copied, copied, copied)
+            if n == 0:
+                break
+            copied += n
+    except OSError as e:
+        if e.errno not in COPY_FALLBACK_ERRNOS:
+            raise
+        method = "read_write"
+        while copied < size:
+            data = os.pread(src_fd, min(1024 * 1024, size - copied), copied)
+            if not data:
+                break
+            copied += os.pwrite(dst_fd, data, copied)
+    if copied != size:
+        raise OSError(errno.EIO, f"short copy ({copied} of {size} bytes)")
+    return method
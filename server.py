@@ -7,54 +7,119 @@ import sys  # Added for command line argument handling
 import logging
 import hashlib  # Added for MD5 calculation
 import json    # Added for manifest handling
-from dataclasses import dataclass
+import argparse
+import errno
+import fcntl
+import filecmp
+import mmap
+import contextlib
+import itertools
+import signal
+import sqlite3
+import queue
+import select
+import secrets
+import stat
+import tempfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from typing import Optional, Set, Dict
 import time
 from pathlib import Path
 
+from localsend_common import (
+    METRICS, PROFILER, CDC_MIN_SIZE, CDC_MAX_SIZE, CDC_MIN_FILE_SIZE, cdc_chunks, FICLONE,
+    partial_path, is_partial_name, is_zero_block, update_md5_zeros, IgnoreRules, walk_tree,
+    is_local_address, copy_file_data,
+)
+
+logger = logging.getLogger("udp_localsend.server")
+METRICS.prefix = "udp_localsend_server"
+
 def calculate_md5(file_path: Path) -> Optional[str]:
     """A standalone helper function to calculate MD5 hash of a single file"""
     hash_md5 = hashlib.md5()
     try:
+        start = time.perf_counter()
+        size = 0
         with file_path.open("rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+            for chunk in iter(lambda: f.read(65536), b""):
                 hash_md5.update(chunk)
+                size += len(chunk)
+        METRICS.inc("hash_bytes_total", size)
+        METRICS.inc("hash_seconds_total", time.perf_counter() - start)
         result = hash_md5.hexdigest()
-        print(f"Debug: Calculated MD5 for {file_path}: {result}")
+        logger.debug("Calculated MD5 for %s: %s", file_path, result)
         return result
     except IOError as e:
-        print(f"Error calculating MD5 for {file_path}: {e}")
+        logger.warning("Error calculating MD5 for %s: %s", file_path, e)
         return None
     except Exception as e:
-        print(f"Unexpected error calculating MD5 for {file_path}: {e}")
+        logger.warning("Unexpected error calculating MD5 for %s: %s", file_path, e)
         return None
 
-def generate_md5_manifest(directory: Path) -> Dict[str, str]:
-    """Generate MD5 manifest for all files in directory"""
+# Server-internal entries under base_dir that are never shown to clients
+RESERVED_NAMES = {".objects", ".trash"}
+
+def is_reserved_path(path: Path, base_dir: Path) -> bool:
+    """Return True if path lives inside one of the reserved entries of base_dir"""
+    try:
+        rel_parts = path.resolve().relative_to(base_dir.resolve()).parts
+    except ValueError:
+        return False
+    return bool(rel_parts) and rel_parts[0] in RESERVED_NAMES
+
+ZERO_SCAN_SIZE = 64 * 1024  # bytes examined per step when extending a run of zeros
+
+def fsync_directory(path: Path) -> None:
+    """Make a rename inside path durable"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def generate_md5_manifest(directory: Path, base_dir: Optional[Path] = None, state=None,
+                          ignore: Optional[IgnoreRules] = None) -> Dict[str, str]:
+    """Generate MD5 manifest for all files in directory; state, if given, supplies cached digests"""
+    with PROFILER.section("manifest", directory.name):
+        return _generate_md5_manifest(directory, base_dir, state, ignore)
+
+def _generate_md5_manifest(directory: Path, base_dir: Optional[Path], state,
+                           ignore: Optional[IgnoreRules]) -> Dict[str, str]:
     manifest = {}
+    start = time.perf_counter()
+    if base_dir is not None and is_reserved_path(directory, base_dir):
+        return manifest
+    # 保留目录 (.objects) 只会出现在服务器根目录的第一层
+    reserved = RESERVED_NAMES if base_dir is not None and directory.resolve() == base_dir.resolve() else ()
+
+    def skip(rel_path: str, is_dir: bool) -> bool:
+        # 正在上传的临时文件和保留目录不进入清单
+        return rel_path in reserved or (not is_dir and is_partial_name(rel_path.rpartition('/')[2]))
+
     try:
-        # 使用 rglob 递归扫描所有文件
-        for item in directory.rglob('*'):
+        # 被忽略的目录在遍历时直接跳过，不再进入
+        for entry in walk_tree(directory, ignore, skip):
+            if entry.is_dir:
+                manifest[entry.rel_path] = "__DIR__"
+                logger.debug("Added directory to manifest: %s", entry.rel_path)
+                continue
             try:
-                # 获取相对于基础目录的路径
-                rel_path = item.relative_to(directory)
-                # 转换为字符串并统一使用正斜杠
-                rel_path_str = str(rel_path).replace('\\', '/')
-                
-                if item.is_dir():
-                    manifest[rel_path_str] = "__DIR__"
-                    print(f"Debug: Added directory to manifest: {rel_path_str}")
-                elif item.is_file():
-                    md5 = calculate_md5(item)
-                    manifest[rel_path_str] = md5
-                    print(f"Debug: Added file to manifest: {rel_path_str} (MD5: {md5})")
+                item = Path(entry.path)
+                md5 = state.file_md5(item, entry) if state else calculate_md5(item)
+                manifest[entry.rel_path] = md5
+                logger.debug("Added file to manifest: %s (MD5: %s)", entry.rel_path, md5)
             except Exception as e:
-                print(f"Debug: Error processing {item}: {e}")
+                logger.debug("Error processing %s: %s", entry.path, e)
                 continue
     except Exception as e:
-        print(f"Debug: Error scanning directory {directory}: {e}")
+        logger.warning("Error scanning directory %s: %s", directory, e)
     
-    print(f"Debug: Generated manifest with {len(manifest)} items")
+    METRICS.observe("manifest_seconds", time.perf_counter() - start)
+    logger.debug("Generated manifest with %d items", len(manifest))
     return manifest
 
 @dataclass
@@ -67,172 +132,2159 @@ class ServerConfig:
     buffer_size: int = 8192
     data_buffer_size: int = 2048
     upload_buffer_size: int = 4096
+    dedup: bool = False  # Content-addressed object store under base_dir/.objects
+    log_level: str = "INFO"
+    metrics_file: Optional[Path] = None  # periodic dump; *.prom for Prometheus text, JSON otherwise
+    metrics_interval: float = 60.0
+    profile: bool = False  # start with cProfile capture on (see PROFILE command)
+    profile_memory: bool = False  # also take tracemalloc snapshots
+    profile_dir: Path = Path("profiles")
+    workers: int = 1  # >1: prefork processes sharing the port via SO_REUSEPORT
+    worker_id: int = 0
+    worker_data_ports: int = 100  # data port range reserved for each worker
+    data_ports: int = 16  # pre-bound download sockets (and transfer threads) per worker
+    transfer_timeout: float = 30.0  # a download waiting this long for its client is abandoned
+    cache_budget_bytes: int = 256 * 1024 * 1024  # download read cache per worker, 0 disables it
+    state_db: Path = Path("server_state.sqlite3").resolve()  # shared state in worker mode
+    session_ttl: float = 1800.0  # upload, sync and folder sessions idle this long are dropped
+    max_sessions: int = 10000  # per session table; the least recently used session is evicted beyond this
+    client_rate_limit: int = 0  # bulk bytes per second per client host (uploads and downloads), 0 = unlimited
+    client_rate_limits: Dict[str, int] = field(default_factory=dict)  # per-host overrides of client_rate_limit
+    client_weights: Dict[str, float] = field(default_factory=dict)  # share of upload bandwidth per host, default 1
+    local_transfers: bool = True  # offer same-host clients file descriptor passing over a Unix socket
+    local_socket: Optional[Path] = None  # default: <tmpdir>/udp-localsend-<port>.sock
+    mcast_group: str = "239.255.77.77"  # group MCAST_PUBLISH streams to (administratively scoped)
+    mcast_port: int = 51233
+    mcast_interface: str = ""  # address of the outgoing interface, empty lets the kernel choose
+    mcast_ttl: int = 1  # 1 keeps the stream on the local network
+    mcast_rate: int = 8 * 1024 * 1024  # bytes per second of each multicast stream, 0 = unpaced
+
+    @property
+    def objects_dir(self) -> Path:
+        return self.base_dir / ".objects"
+
+    @property
+    def trash_dir(self) -> Path:
+        return self.base_dir / ".trash"
+
+    @property
+    def local_socket_path(self) -> Path:
+        path = self.local_socket or Path(tempfile.gettempdir()) / f"udp-localsend-{self.default_port}.sock"
+        # 每个 worker 有自己的令牌表，因此也有自己的套接字
+        return path.with_name(f"{path.name}.worker{self.worker_id}") if self.workers > 1 else path
 
     @classmethod
     def from_args(cls) -> 'ServerConfig':
         """Create config from command line arguments, using the class's default port."""
-        if len(sys.argv) == 1:
+        parser = argparse.ArgumentParser(description="UDP-Localsend file server")
+        parser.add_argument("port", nargs="?", help="UDP port to listen on")
+        parser.add_argument("--dedup", action="store_true",
+                            help="store uploads in a content-addressed object store and link duplicates")
+        parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                            help="logging verbosity (DEBUG shows per-file and per-request detail)")
+        parser.add_argument("--metrics-file", type=Path,
+                            help="periodically dump metrics to this file (Prometheus text if it ends in .prom)")
+        parser.add_argument("--metrics-interval", type=float, default=60.0,
+                            help="seconds between metrics dumps (default: 60)")
+        parser.add_argument("--profile", action="store_true",
+                            help="capture cProfile dumps per sync/download and per command from startup")
+        parser.add_argument("--profile-memory", action="store_true",
+                            help="with profiling, also record tracemalloc allocation snapshots")
+        parser.add_argument("--profile-dir", type=Path, default=Path("profiles"),
+                            help="where profile dumps are written (default: ./profiles)")
+        parser.add_argument("--cache-mb", type=int, default=256,
+                            help="memory budget of the download read cache in MiB, 0 to disable (default: 256)")
+        parser.add_argument("--data-ports", type=int, default=16,
+                            help="pre-bound download data ports, i.e. concurrent downloads per worker (default: 16)")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="number of server processes sharing the port via SO_REUSEPORT (default: 1)")
+        parser.add_argument("--state-db", type=Path, default=Path("server_state.sqlite3"),
+                            help="SQLite file for state shared between workers (default: ./server_state.sqlite3)")
+        parser.add_argument("--session-ttl", type=float, default=1800.0,
+                            help="seconds before an idle upload/sync/folder session is dropped (default: 1800)")
+        parser.add_argument("--max-sessions", type=int, default=10000,
+                            help="sessions kept per table before the least recently used is evicted (default: 10000)")
+        parser.add_argument("--client-rate-kib", type=int, default=0,
+                            help="limit each client host's transfers to this many KiB/s, 0 for no limit (default: 0)")
+        parser.add_argument("--client-rate", action="append", default=[], metavar="HOST=KIB",
+                            help="rate limit in KiB/s for one client host, overriding --client-rate-kib (repeatable)")
+        parser.add_argument("--client-weight", action="append", default=[], metavar="HOST=WEIGHT",
+                            help="relative share of upload bandwidth for one client host, default 1 (repeatable)")
+        parser.add_argument("--local-socket", type=Path,
+                            help="Unix socket for same-host transfers (default: <tmpdir>/udp-localsend-<port>.sock)")
+        parser.add_argument("--no-local", action="store_true",
+                            help="do not offer the same-host fast path; every transfer goes over UDP")
+        parser.add_argument("--mcast-group", default="239.255.77.77",
+                            help="multicast group for MCAST_PUBLISH (default: 239.255.77.77)")
+        parser.add_argument("--mcast-port", type=int, default=51233, help="multicast port (default: 51233)")
+        parser.add_argument("--mcast-interface", default="",
+                            help="address of the interface multicast is sent on, e.g. 127.0.0.1 for loopback tests")
+        parser.add_argument("--mcast-ttl", type=int, default=1, help="multicast TTL in hops (default: 1)")
+        parser.add_argument("--mcast-rate-kib", type=int, default=8192,
+                            help="send rate of each multicast stream in KiB/s, 0 for unpaced (default: 8192)")
+        args = parser.parse_args()
+        if args.workers < 1:
+            print(f"[ERROR] Invalid worker count '{args.workers}'.", file=sys.stderr)
+            sys.exit(1)
+        try:
+            client_rates = {host: int(kib) * 1024 for host, kib in
+                            (item.split('=', 1) for item in args.client_rate)}
+            client_weights = {host: float(weight) for host, weight in
+                              (item.split('=', 1) for item in args.client_weight)}
+        except ValueError:
+            print("[ERROR] --client-rate and --client-weight take HOST=NUMBER.", file=sys.stderr)
+            sys.exit(1)
+        if any(weight < MIN_CLIENT_WEIGHT for weight in client_weights.values()):
+            print(f"[ERROR] Client weights must be at least {MIN_CLIENT_WEIGHT}.", file=sys.stderr)
+            sys.exit(1)
+        if args.session_ttl <= 0 or args.max_sessions < 1:
+            print("[ERROR] --session-ttl and --max-sessions must be positive.", file=sys.stderr)
+            sys.exit(1)
+        if not 1 <= args.data_ports <= cls.worker_data_ports:
+            print(f"[ERROR] --data-ports must be between 1 and {cls.worker_data_ports}.", file=sys.stderr)
+            sys.exit(1)
+
+        options = {"dedup": args.dedup, "log_level": args.log_level,
+                   "metrics_file": args.metrics_file, "metrics_interval": args.metrics_interval,
+                   "profile": args.profile, "profile_memory": args.profile_memory,
+                   "profile_dir": args.profile_dir, "workers": args.workers, "data_ports": args.data_ports,
+                   "cache_budget_bytes": max(0, args.cache_mb) * 1024 * 1024,
+                   "state_db": args.state_db.resolve(),
+                   "session_ttl": args.session_ttl, "max_sessions": args.max_sessions,
+                   "client_rate_limit": max(0, args.client_rate_kib) * 1024, "client_rate_limits": client_rates,
+                   "client_weights": client_weights, "local_transfers": not args.no_local,
+                   "local_socket": args.local_socket.resolve() if args.local_socket else None,
+                   "mcast_group": args.mcast_group, "mcast_port": args.mcast_port,
+                   "mcast_interface": args.mcast_interface, "mcast_ttl": args.mcast_ttl,
+                   "mcast_rate": max(0, args.mcast_rate_kib) * 1024}
+        if args.port is None:
             # 直接使用类中定义的默认端口
             print(f"[INFO] No port provided. Using default port: {cls.default_port}")
-            return cls()  # 无需传入参数，它会使用数据类中定义的默认值
-        elif len(sys.argv) == 2:
+            return cls(**options)  # 其余使用数据类中定义的默认值
+        try:
+            port = int(args.port)
+        except ValueError:
+            # 将错误信息输出到标准错误流，这是更好的实践
+            print(f"[ERROR] Invalid port '{args.port}'. Port must be a number.", file=sys.stderr)
+            sys.exit(1)
+        print(f"[INFO] Port specified by user: {port}")
+        # 创建实例时覆盖默认端口
+        return cls(default_port=port, **options)
+
+CLIENT_PATH_TTL = 24 * 3600.0  # a client's cd directory is forgotten after a day without requests
+CLIENT_PATH_CACHE_TTL = 5.0  # with --workers, a worker re-reads a client's cd directory from SQLite this often
+MD5_CACHE_TTL = 7 * 24 * 3600.0  # a cached file digest not used for a week is forgotten
+MD5_CACHE_ENTRIES = 200000  # cached file digests per process, and rows in the shared SQLite cache
+MD5_CACHE_SWEEP_INTERVAL = 600.0  # with --workers, seconds between prunes of the SQLite digest cache
+COMPLETED_UPLOAD_TTL = 60.0  # replies kept for retransmitted UPLOAD_DONE requests
+SESSION_SWEEP_INTERVAL = 5.0  # seconds between sweeps of the session tables
+OBJECT_PRUNE_INTERVAL = 600.0  # seconds between scans of the object store for unreferenced objects
+
+def _approx_size(obj, _depth: int = 0) -> int:
+    """Rough deep size of a session value; containers are followed a few levels down"""
+    size = sys.getsizeof(obj)
+    if _depth < 4:
+        if isinstance(obj, dict):
+            size += sum(_approx_size(k, _depth + 1) + _approx_size(v, _depth + 1) for k, v in obj.items())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            size += sum(_approx_size(item, _depth + 1) for item in obj)
+    return size
+
+class SessionTable:
+    """Per-client sessions with an idle TTL and a cap on their number.
+
+    An entry idle for longer than ttl seconds is dropped when it is next looked up or
+    by sweep(); inserting beyond max_sessions evicts the least recently used entry.
+    on_evict(key, value) runs for entries dropped either way, but not for pop().
+    Only used from the main loop, so it takes no lock.
+    """
+
+    def __init__(self, name: str, ttl: float, max_sessions: int, on_evict=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.on_evict = on_evict
+        self._entries = OrderedDict()  # key -> (last use, value), least recently used first
+
+    def _evict(self, key, reason: str) -> None:
+        _, value = self._entries.pop(key)
+        METRICS.inc("sessions_evicted_total", table=self.name, reason=reason)
+        logger.debug("[Session] Dropped %s session of %s (%s)", self.name, key, reason)
+        if self.on_evict:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logger.warning("[Session] Cleanup of %s session %s failed: %s", self.name, key, e)
+
+    def _live(self, key) -> bool:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        if time.monotonic() - entry[0] > self.ttl:
+            self._evict(key, "ttl")
+            return False
+        return True
+
+    def get(self, key, default=None):
+        if not self._live(key):
+            return default
+        value = self._entries[key][1]
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        return value
+
+    def __getitem__(self, key):
+        if not self._live(key):
+            raise KeyError(key)
+        return self.get(key)
+
+    def __setitem__(self, key, value) -> None:
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_sessions:
+            self._evict(next(iter(self._entries)), "lru")
+
+    def __contains__(self, key) -> bool:
+        return self._live(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def values(self) -> list:
+        """Every value not yet evicted, including idle ones the next sweep would drop"""
+        return [value for _, value in self._entries.values()]
+
+    def sweep(self) -> int:
+        """Drop every entry idle for longer than the TTL; returns how many were dropped"""
+        deadline = time.monotonic() - self.ttl
+        expired = []
+        for key, (last_used, _) in self._entries.items():  # 按最近使用时间排序，遇到未过期的即可停止
+            if last_used > deadline:
+                break
+            expired.append(key)
+        for key in expired:
+            self._evict(key, "ttl")
+        return len(expired)
+
+    def memory_bytes(self) -> int:
+        """Approximate memory held by the table's keys and values"""
+        return sys.getsizeof(self._entries) + sum(_approx_size(key) + _approx_size(value)
+                                                  for key, (_, value) in self._entries.items())
+
+def _paths_overlap(a: str, b: str) -> bool:
+    """True if one of two resolved directories is the other or inside it"""
+    return a == b or a.startswith(b.rstrip(os.sep) + os.sep) or b.startswith(a.rstrip(os.sep) + os.sep)
+
+def sync_owner(client_addr: tuple) -> str:
+    """Key a client's sync lock is held under"""
+    return f"{client_addr[0]}:{client_addr[1]}"
+
+class LocalState:
+    """State of a single server process: client working directories, the sync locks and an MD5 cache"""
+    SYNC_LOCK_TTL = 600.0  # a sync lock whose owner vanished expires after this many seconds
+
+    def __init__(self, max_sessions: int = 10000):
+        self.client_paths = SessionTable("client_paths", CLIENT_PATH_TTL, max_sessions)
+        self.sync_locks = {}  # resolved remote directory -> (owner, expires)
+        self.md5_cache = SessionTable("md5_cache", MD5_CACHE_TTL, MD5_CACHE_ENTRIES)  # path -> (size, mtime_ns, md5)
+        self._md5_lock = threading.Lock()  # 清单在 TREE 构建线程中计算，本地传输线程也会写入
+
+    def get_client_path(self, client_addr: tuple, default: Path) -> Path:
+        return self.client_paths.get(client_addr, default)
+
+    def set_client_path(self, client_addr: tuple, path: Path) -> None:
+        self.client_paths[client_addr] = path
+
+    def sweep(self) -> None:
+        """Forget the directories of clients idle for CLIENT_PATH_TTL and digests unused for MD5_CACHE_TTL"""
+        self.client_paths.sweep()
+        with self._md5_lock:
+            self.md5_cache.sweep()
+
+    def is_syncing(self) -> bool:
+        now = time.time()
+        return any(expires > now for _, expires in self.sync_locks.values())
+
+    def try_lock_sync(self, owner: str, path: str) -> bool:
+        """Lock the remote directory <path> for a sync; the current owner may take it again.
+
+        Syncs into directories that do not contain each other run concurrently.
+        """
+        now = time.time()
+        for locked, (lock_owner, expires) in list(self.sync_locks.items()):
+            if expires <= now:
+                del self.sync_locks[locked]
+            elif lock_owner != owner and _paths_overlap(locked, path):
+                return False
+        self.sync_locks[path] = (owner, now + self.SYNC_LOCK_TTL)
+        return True
+
+    def unlock_sync(self, owner: str) -> None:
+        for locked, (lock_owner, _) in list(self.sync_locks.items()):
+            if lock_owner == owner:
+                del self.sync_locks[locked]
+
+    def is_locked(self, path: str, owner: str) -> bool:
+        """True if a sync of another owner holds a directory that overlaps <path> (resolved)"""
+        now = time.time()
+        return any(expires > now and lock_owner != owner and _paths_overlap(locked, path)
+                   for locked, (lock_owner, expires) in list(self.sync_locks.items()))
+
+    def cached_md5(self, path: Path, st: os.stat_result) -> Optional[str]:
+        with self._md5_lock:
+            entry = self.md5_cache.get(str(path))
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def store_md5(self, path: Path, st: os.stat_result, md5: str) -> None:
+        with self._md5_lock:
+            self.md5_cache[str(path)] = (st.st_size, st.st_mtime_ns, md5)
+
+    def file_md5(self, path: Path, st=None) -> Optional[str]:
+        """MD5 of a file, reusing the cached digest while size and mtime are unchanged.
+
+        st may be any object with st_size and st_mtime_ns (a stat result or a TreeEntry).
+        """
+        try:
+            st = st or path.stat()
+        except OSError:
+            return None
+        md5 = self.cached_md5(path, st)
+        if md5:
+            METRICS.inc("hash_cache_hits_total")
+            return md5
+        md5 = calculate_md5(path)
+        if md5:
+            self.store_md5(path, st, md5)
+        return md5
+
+class SharedState(LocalState):
+    """LocalState kept in an SQLite file so that all worker processes see the same values"""
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS client_paths (addr TEXT PRIMARY KEY, path TEXT NOT NULL, used REAL)",
+        "CREATE TABLE IF NOT EXISTS sync_locks (path TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS md5_cache (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, md5 TEXT, used REAL)",
+    )
+
+    def __init__(self, db_path: Path, max_sessions: int = 10000):
+        super().__init__(max_sessions)
+        self.db_path = db_path
+        self.max_sessions = max_sessions
+        # 每个进程在 fork 之后各自打开连接；下载线程不访问状态，但仍加锁保护
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(db_path), timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self._db.execute(statement)
+        with contextlib.suppress(sqlite3.OperationalError):
+            self._db.execute("ALTER TABLE client_paths ADD COLUMN used REAL")  # 旧版本创建的数据库
+        with contextlib.suppress(sqlite3.OperationalError):
+            self._db.execute("ALTER TABLE md5_cache ADD COLUMN used REAL")
+        self._db.execute("CREATE INDEX IF NOT EXISTS md5_cache_used ON md5_cache (used)")
+        self._next_md5_sweep = 0.0
+        # 进程内缓存 addr -> (path 或 None, 读取时间)，避免每个数据报都查询一次数据库。
+        # 同一客户端地址由内核固定分给同一 worker，worker 重启后分配才可能改变，所以缓存只保留很短时间
+        self.client_paths = SessionTable("client_path_cache", CLIENT_PATH_CACHE_TTL, max_sessions)
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def get_client_path(self, client_addr: tuple, default: Path) -> Path:
+        cached = self.client_paths.get(client_addr)
+        if cached and time.monotonic() - cached[1] < CLIENT_PATH_CACHE_TTL:
+            return cached[0] or default
+        rows = self._query("SELECT path FROM client_paths WHERE addr = ?", (f"{client_addr[0]}:{client_addr[1]}",))
+        path = Path(rows[0][0]) if rows else None
+        self.client_paths[client_addr] = (path, time.monotonic())
+        return path or default
+
+    def set_client_path(self, client_addr: tuple, path: Path) -> None:
+        self._query("INSERT OR REPLACE INTO client_paths VALUES (?, ?, ?)",
+                    (f"{client_addr[0]}:{client_addr[1]}", str(path), time.time()))
+        self.client_paths[client_addr] = (path, time.monotonic())
+
+    def sweep(self) -> None:
+        """Forget directories set more than CLIENT_PATH_TTL ago, and the oldest beyond max_sessions"""
+        self.client_paths.sweep()
+        self._query("DELETE FROM client_paths WHERE used IS NULL OR used < ?", (time.time() - CLIENT_PATH_TTL,))
+        self._query("DELETE FROM client_paths WHERE addr NOT IN "
+                    "(SELECT addr FROM client_paths ORDER BY used DESC LIMIT ?)", (self.max_sessions,))
+        if time.monotonic() >= self._next_md5_sweep:
+            # 摘要缓存可能很大，不必每次都清理；超出 MD5_CACHE_ENTRIES 的部分按最近使用时间删除
+            self._next_md5_sweep = time.monotonic() + MD5_CACHE_SWEEP_INTERVAL
+            self._query("DELETE FROM md5_cache WHERE used IS NULL OR used < ?", (time.time() - MD5_CACHE_TTL,))
+            self._query("DELETE FROM md5_cache WHERE used <= "
+                        "(SELECT used FROM md5_cache ORDER BY used DESC LIMIT 1 OFFSET ?)", (MD5_CACHE_ENTRIES,))
+
+    def is_syncing(self) -> bool:
+        return bool(self._query("SELECT 1 FROM sync_locks WHERE expires > ? LIMIT 1", (time.time(),)))
+
+    def try_lock_sync(self, owner: str, path: str) -> bool:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                self._db.execute("DELETE FROM sync_locks WHERE expires <= ?", (now,))
+                rows = self._db.execute("SELECT path FROM sync_locks WHERE owner != ?", (owner,)).fetchall()
+                if any(_paths_overlap(locked, path) for (locked,) in rows):
+                    return False
+                self._db.execute("INSERT OR REPLACE INTO sync_locks VALUES (?, ?, ?)",
+                                 (path, owner, now + self.SYNC_LOCK_TTL))
+                return True
+            finally:
+                self._db.execute("COMMIT")
+
+    def unlock_sync(self, owner: str) -> None:
+        self._query("DELETE FROM sync_locks WHERE owner = ?", (owner,))
+
+    def is_locked(self, path: str, owner: str) -> bool:
+        rows = self._query("SELECT path FROM sync_locks WHERE expires > ? AND owner != ?", (time.time(), owner))
+        return any(_paths_overlap(locked, path) for (locked,) in rows)
+
+    def cached_md5(self, path: Path, st: os.stat_result) -> Optional[str]:
+        rows = self._query("SELECT md5, used FROM md5_cache WHERE path = ? AND size = ? AND mtime_ns = ?",
+                           (str(path), st.st_size, st.st_mtime_ns))
+        if not rows:
+            return None
+        md5, used = rows[0]
+        now = time.time()
+        if used is None or used < now - MD5_CACHE_TTL / 2:
+            # 命中时只偶尔刷新使用时间，避免每次读取都写数据库
+            self._query("UPDATE md5_cache SET used = ? WHERE path = ?", (now, str(path)))
+        return md5
+
+    def store_md5(self, path: Path, st: os.stat_result, md5: str) -> None:
+        self._query("INSERT OR REPLACE INTO md5_cache (path, size, mtime_ns, md5, used) VALUES (?, ?, ?, ?, ?)",
+                    (str(path), st.st_size, st.st_mtime_ns, md5, time.time()))
+
+class ObjectStore:
+    """Content-addressed store of file bodies keyed by MD5 digest.
+
+    User-visible files are hardlinked (or reflinked/copied as a fallback) to the
+    objects, so identical content synced into many places is stored once. A new
+    file is only linked to an existing object after comparing their bytes, an
+    object is re-hashed before it is linked anywhere if it changed since it was
+    last verified, and objects no user-visible file links to any more are pruned
+    in the background.
+    """
+
+    def __init__(self, config: ServerConfig):
+        self.config = config
+        self.root = config.objects_dir
+        self._pruner = ThreadPoolExecutor(max_workers=1, thread_name_prefix="object-prune")
+        self._pruning = None  # Future of the running prune()
+        self._next_prune = time.monotonic() + OBJECT_PRUNE_INTERVAL
+        self._verified = {}  # digest -> (st_ino, st_size, st_mtime_ns) of the object when its bytes last matched
+
+    def object_path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    @staticmethod
+    def is_valid_digest(digest: str) -> bool:
+        return len(digest) == 32 and all(c in "0123456789abcdef" for c in digest)
+
+    def has(self, digest: str) -> bool:
+        return self.is_valid_digest(digest) and self.object_path(digest).is_file()
+
+    def ingest(self, file_path: Path, digest: Optional[str] = None) -> Optional[str]:
+        """Add a freshly written file to the store, deduplicating it against existing objects."""
+        digest = digest or calculate_md5(file_path)
+        if not digest:
+            return None
+        obj_path = self.object_path(digest)
+        try:
+            # MD5 相同不代表内容相同：逐字节比较，对象完好却不同就是碰撞，新文件不链接
+            if obj_path.is_file() and not self._same_bytes(obj_path, file_path) and self._verify(digest):
+                logger.warning("  [Store] %s has digest %s but differs from the stored object, not linking",
+                               file_path, digest)
+                return None
+            if obj_path.is_file():
+                # Same content already stored: replace the new copy with a link to it
+                self._verified[digest] = self._signature(obj_path)
+                self.link_into(digest, file_path)
+            else:
+                obj_path.parent.mkdir(parents=True, exist_ok=True)
+                self._clone(file_path, obj_path)
+                self._verified[digest] = self._signature(obj_path)
+            return digest
+        except OSError as e:
+            logger.warning("  [Store] Failed to ingest %s: %s", file_path, e)
+            return None
+
+    def link_into(self, digest: str, target_path: Path) -> bool:
+        """Materialise object `digest` at target_path, atomically replacing any existing file."""
+        obj_path = self.object_path(digest)
+        if not obj_path.is_file() or not self._verify(digest):
+            return False
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target_path.with_name(f".{target_path.name}.{os.getpid()}.link")
+        try:
+            tmp_path.unlink(missing_ok=True)
+            self._clone(obj_path, tmp_path)
+            os.replace(tmp_path, target_path)
+            return True
+        except OSError as e:
+            logger.warning("  [Store] Failed to link %s -> %s: %s", digest, target_path, e)
+            tmp_path.unlink(missing_ok=True)
+            return False
+
+    @staticmethod
+    def _signature(path: Path) -> tuple:
+        st = path.stat()
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    @staticmethod
+    def _same_bytes(path: Path, other: Path) -> bool:
+        return os.path.samefile(path, other) or filecmp.cmp(path, other, shallow=False)
+
+    def _verify(self, digest: str) -> bool:
+        """True if object `digest` still hashes to digest; a changed object is removed from the store.
+
+        Objects share their inode with user-visible files, so editing such a file in
+        place changes the object too. Hashing is skipped while the object's inode,
+        size and mtime are those seen at the last successful check.
+        """
+        obj_path = self.object_path(digest)
+        try:
+            signature = self._signature(obj_path)
+        except OSError:
+            return False
+        if self._verified.get(digest) == signature:
+            return True
+        if calculate_md5(obj_path) == digest:
+            self._verified[digest] = signature
+            return True
+        logger.warning("  [Store] Object %s no longer matches its digest, removing it from the store", digest)
+        self._verified.pop(digest, None)
+        obj_path.unlink(missing_ok=True)
+        return False
+
+    def sweep(self) -> None:
+        """Start a background prune() every OBJECT_PRUNE_INTERVAL seconds"""
+        if time.monotonic() < self._next_prune or (self._pruning and not self._pruning.done()):
+            return
+        self._next_prune = time.monotonic() + OBJECT_PRUNE_INTERVAL
+        self._pruning = self._pruner.submit(self.prune)
+
+    def prune(self) -> int:
+        """Delete objects that no user-visible file links to (st_nlink == 1); returns the number deleted"""
+        removed = 0
+        for obj_path in self.root.glob("??/*"):
+            if not self.is_valid_digest(obj_path.name):
+                continue
             try:
-                port = int(sys.argv[1])
-                print(f"[INFO] Port specified by user: {port}")
-                # 创建实例时覆盖默认端口
-                return cls(default_port=port)
-            except ValueError:
-                # 将错误信息输出到标准错误流，这是更好的实践
-                print(f"[ERROR] Invalid port '{sys.argv[1]}'. Port must be a number.", file=sys.stderr)
-                sys.exit(1)
+                if obj_path.stat().st_nlink == 1:
+                    obj_path.unlink()
+                    self._verified.pop(obj_path.name, None)
+                    removed += 1
+            except OSError:
+                continue  # 另一个 worker 刚删除了它
+        if removed:
+            METRICS.inc("objects_pruned_total", removed)
+            logger.info("[Store] Pruned %d unreferenced object(s)", removed)
+        return removed
+
+    def _clone(self, src: Path, dst: Path) -> None:
+        """Hardlink src to dst, falling back to a reflink and finally a plain copy."""
+        try:
+            os.link(src, dst)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+        try:
+            with src.open('rb') as fsrc, dst.open('wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            dst.unlink(missing_ok=True)
+        shutil.copyfile(src, dst)
+
+class ChunkStore:
+    """Index of content-defined chunks keyed by SHA-256 digest.
+
+    Uploaded chunks are kept as files under .objects/chunks until no open upload
+    needs them; chunks of files that already exist on the server (including files
+    reassembled from chunks) are indexed by reference (path, offset, length) and
+    re-verified before use.
+    """
+    def __init__(self, config: ServerConfig):
+        self.config = config
+        # 块文件只在上传会话期间存在，会话计数在进程内，因此每个 worker 使用自己的目录
+        self.root = config.objects_dir / "chunks"
+        if config.workers > 1:
+            self.root /= f"worker{config.worker_id}"
+        self.refs = {}  # digest -> (path, offset, length)
+        self.indexed_files = {}  # path -> (size, mtime_ns) already chunked by reference
+        self._lock = threading.Lock()  # index_file() runs on the indexing thread
+
+    def chunk_path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def has(self, digest: str) -> bool:
+        if self.chunk_path(digest).is_file():
+            return True
+        return self.read(digest) is not None
+
+    def put(self, digest: str, data: bytes) -> None:
+        path = self.chunk_path(digest)
+        if path.is_file():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with tmp_path.open('wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def read(self, digest: str) -> Optional[bytes]:
+        """Return the chunk body, or None if it is unknown or its reference went stale"""
+        path = self.chunk_path(digest)
+        try:
+            return path.read_bytes()
+        except OSError:
+            pass
+        ref = self.refs.get(digest)
+        if not ref:
+            return None
+        ref_path, offset, length = ref
+        try:
+            with ref_path.open('rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+        except OSError:
+            data = b""
+        if len(data) == length and hashlib.sha256(data).hexdigest() == digest:
+            return data
+        with self._lock:
+            if self.refs.get(digest) == ref:
+                del self.refs[digest]
+        return None
+
+    def remove(self, digest: str) -> None:
+        """Delete a stored chunk file; its content stays reachable through any reference"""
+        self.chunk_path(digest).unlink(missing_ok=True)
+
+    def needs_index(self, file_path: Path) -> bool:
+        try:
+            st = file_path.stat()
+        except OSError:
+            return False
+        return st.st_size >= CDC_MIN_FILE_SIZE and self.indexed_files.get(file_path) != (st.st_size, st.st_mtime_ns)
+
+    def index_file(self, file_path: Path) -> int:
+        """Chunk an existing server file and index its chunks by reference.
+
+        Hashes the whole file, so it runs on a worker thread rather than the main loop.
+        """
+        if not self.needs_index(file_path):
+            return 0
+        try:
+            st = file_path.stat()
+            refs = {}
+            with file_path.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset, length in cdc_chunks(data):
+                    digest = hashlib.sha256(data[offset:offset + length]).hexdigest()
+                    refs.setdefault(digest, (file_path, offset, length))
+        except (OSError, ValueError) as e:
+            logger.warning("[Chunk] Failed to index '%s': %s", file_path, e)
+            return 0
+        self.add_refs(file_path, st, refs)
+        return len(refs)
+
+    def add_refs(self, file_path: Path, st: os.stat_result, refs: dict) -> None:
+        """Index the chunks of file_path (digest -> (path, offset, length)) as of stat st"""
+        with self._lock:
+            for digest, ref in refs.items():
+                self.refs.setdefault(digest, ref)
+            self.indexed_files[file_path] = (st.st_size, st.st_mtime_ns)
+
+    def prune(self) -> int:
+        """Forget indexed files that changed or vanished, and the references into them"""
+        stale = set()
+        for file_path, signature in list(self.indexed_files.items()):
+            try:
+                st = file_path.stat()
+            except OSError:
+                st = None
+            if st is None or (st.st_size, st.st_mtime_ns) != signature:
+                stale.add(file_path)
+        if stale:
+            with self._lock:
+                for file_path in stale:
+                    self.indexed_files.pop(file_path, None)
+                self.refs = {digest: ref for digest, ref in self.refs.items() if ref[0] not in stale}
+        return len(stale)
+
+class ChunkUploadHandler:
+    """Handles deduplicated uploads: the client offers a chunk recipe and only sends unknown chunks."""
+    def __init__(self, config: ServerConfig, chunk_store: ChunkStore, object_store: ObjectStore,
+                 state: Optional[LocalState] = None):
+        self.config = config
+        self.chunk_store = chunk_store
+        self.object_store = object_store
+        self.state = state
+        self.sessions = SessionTable("cdc_uploads", config.session_ttl, config.max_sessions,
+                                     on_evict=lambda addr, session: self._release(session))  # client_addr -> upload session
+        self._indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cdc-index")
+        self._indexing = {}  # path -> Future of the index_file() run on the indexer thread
+        self._stored_users = {}  # digest of a stored chunk file -> number of open sessions using it
+
+    def begin(self, client_addr: tuple, target_path: Path, num_chunks: int, file_size: int) -> str:
+        """Open (or re-confirm) a session; CDC_INDEXING means the target is still being indexed"""
+        if file_size < 0 or not 0 <= num_chunks <= file_size // CDC_MIN_SIZE + 1:
+            return "ERR_INVALID_CDC_COMMAND"  # 除最后一块外每块至少 CDC_MIN_SIZE 字节
+        session = self.sessions.get(client_addr)
+        if session and (session['target_path'], len(session['recipe']), session['size']) == (target_path, num_chunks, file_size):
+            METRICS.inc("duplicate_requests_total")
         else:
-            print("[ERROR] Too many arguments. Usage: python3 server.py [port]", file=sys.stderr)
-            sys.exit(1)
+            if session:
+                self._release(self.sessions.pop(client_addr))
+            try:
+                free = shutil.disk_usage(self.config.base_dir).free
+            except OSError:
+                free = file_size
+            if file_size > free:
+                return "CDC_ERR NO_SPACE"
+            if self.chunk_store.needs_index(target_path) and target_path not in self._indexing:
+                self._indexing[target_path] = self._indexer.submit(self.chunk_store.index_file, target_path)
+            self.sessions[client_addr] = {
+                'target_path': target_path,
+                'recipe': [None] * num_chunks,  # (digest, length) per chunk
+                'needed': set(),
+                'buffers': {},  # chunk index -> bytearray being received
+                'stored': set(),  # digests whose chunk files this session holds a use of
+                'size': file_size,
+                'result': None,
+                'commit': None,  # Future of the _reassemble() run on the indexer thread
+                'start_time': time.time()
+            }
+        future = self._indexing.get(target_path)
+        if future is not None:
+            if not future.done():
+                return "CDC_INDEXING"
+            del self._indexing[target_path]
+        return "CDC_READY"
+
+    def add_recipe(self, client_addr: tuple, start: int, entries: list) -> Optional[list]:
+        """Record a batch of recipe entries and return the indices the client must send"""
+        session = self.sessions.get(client_addr)
+        if not session:
+            return None
+        recipe = session['recipe']
+        if start < 0 or start + len(entries) > len(recipe):
+            raise ValueError("recipe entries out of range")
+        earlier = {entry[0] for entry in recipe[:start] if entry}
+        needed = []
+        for offset, (digest, length) in enumerate(entries):
+            if not 0 < length <= CDC_MAX_SIZE:
+                raise ValueError(f"bad chunk length {length}")
+            index = start + offset
+            recipe[index] = (digest, length)
+            if digest in earlier or self.chunk_store.has(digest):
+                METRICS.inc("dedup_chunks_total")
+                METRICS.inc("dedup_bytes_total", length)
+                self._use_stored(session, digest)
+                continue
+            earlier.add(digest)
+            needed.append(index)
+        session['needed'].update(needed)
+        return needed
+
+    def add_data(self, client_addr: tuple, index: int, offset: int, data: bytes) -> bool:
+        session = self.sessions.get(client_addr)
+        if not session or index not in session['needed']:
+            return False
+        digest, length = session['recipe'][index]
+        if digest in session['stored']:
+            METRICS.inc("duplicate_chunks_total")
+            return True  # already complete, this is a retransmission
+        buffer = session['buffers'].setdefault(index, bytearray())
+        if offset == len(buffer):
+            buffer.extend(data)
+            METRICS.inc("upload_bytes_total", len(data))
+        elif offset + len(data) <= len(buffer) and buffer[offset:offset + len(data)] == data:
+            METRICS.inc("duplicate_chunks_total")
+            return True  # 已收到的片段被重传
+        else:
+            return False
+        if len(buffer) >= length:
+            session['buffers'].pop(index)
+            if len(buffer) != length or hashlib.sha256(buffer).hexdigest() != digest:
+                logger.warning("  [Chunk] Digest mismatch for chunk %d from %s", index, client_addr)
+                return False
+            self.chunk_store.put(digest, bytes(buffer))
+            self._use_stored(session, digest)
+        return True
+
+    def _use_stored(self, session: dict, digest: str) -> None:
+        """Count the session as a user of digest's chunk file, if the chunk is stored as a file"""
+        if digest in session['stored'] or not self.chunk_store.chunk_path(digest).is_file():
+            return
+        session['stored'].add(digest)
+        self._stored_users[digest] = self._stored_users.get(digest, 0) + 1
+
+    def _release(self, session: dict) -> None:
+        """Drop the session's uses of stored chunk files, deleting those no open session still needs"""
+        for digest in session['stored']:
+            users = self._stored_users.pop(digest, 1) - 1
+            if users:
+                self._stored_users[digest] = users
+            else:
+                self.chunk_store.remove(digest)
+        session['stored'] = set()
+
+    def sweep(self) -> None:
+        """Forget finished index runs and references into files that changed or vanished"""
+        for path in [path for path, future in self._indexing.items() if future.done()]:
+            del self._indexing[path]
+        self.chunk_store.prune()
+
+    def commit(self, client_addr: tuple, expected_md5: str) -> str:
+        """Reassemble the target file from the chunk index; CDC_COMMITTING while the indexer thread works"""
+        session = self.sessions.get(client_addr)
+        if not session:
+            return "CDC_ERR NO_SESSION"
+        if session['result']:
+            METRICS.inc("duplicate_requests_total")
+            return session['result']  # retransmitted commit
+        if session['commit'] is None:
+            # 读块、写入和 fsync 都在后台线程进行，主循环期间继续服务其他客户端
+            tmp_path = partial_path(session['target_path'], f"cdc-{client_addr[1]}")
+            session['commit'] = self._indexer.submit(self._reassemble, session, tmp_path, expected_md5)
+        if not session['commit'].done():
+            return "CDC_COMMITTING"
+        target_path = session['target_path']
+        try:
+            md5, refs = session['commit'].result()
+            st = target_path.stat()
+            if self.state:
+                self.state.store_md5(target_path, st, md5)
+            # 重组后的文件按引用索引其块，上传的块文件随之可以删除
+            self.chunk_store.add_refs(target_path, st, refs)
+            session['result'] = "CDC_DONE"
+            logger.info("  [Chunk] Reassembled '%s' from %s chunk(s)", target_path.name, len(session['recipe']))
+        except (OSError, ValueError) as e:
+            session['result'] = f"CDC_ERR {e}"
+        self._release(session)
+        return session['result']
+
+    def _reassemble(self, session: dict, tmp_path: Path, expected_md5: str) -> tuple:
+        """Write the session's file from its chunks on the indexer thread; returns (md5, refs)"""
+        target_path = session['target_path']
+        hash_md5 = hashlib.md5()
+        refs = {}
+        try:
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+            with tmp_path.open('wb') as f:
+                for entry in session['recipe']:
+                    data = self.chunk_store.read(entry[0]) if entry else None
+                    if data is None:
+                        raise ValueError("MISSING_CHUNK")
+                    refs.setdefault(entry[0], (target_path, f.tell(), len(data)))
+                    hash_md5.update(data)
+                    f.write(data)
+                written = f.tell()
+                f.flush()
+                os.fsync(f.fileno())
+            if written != session['size'] or (expected_md5 and hash_md5.hexdigest() != expected_md5):
+                raise ValueError("DIGEST_MISMATCH")
+            os.replace(tmp_path, target_path)
+        except (OSError, ValueError):
+            tmp_path.unlink(missing_ok=True)
+            raise
+        fsync_directory(target_path.parent)
+        self.object_store.ingest(target_path, hash_md5.hexdigest())
+        return hash_md5.hexdigest(), refs
+
+class ReadAheadReader:
+    """Sequential reader that keeps up to `depth` large blocks read ahead on a background thread.
+
+    read(n) may return fewer than n bytes at a block boundary and b"" at end of file.
+    Files no larger than one block are read synchronously without a thread.
+    """
+
+    def __init__(self, path: Path, block_size: int = 1024 * 1024, depth: int = 4):
+        self.block_size = block_size
+        self._fd = os.open(path, os.O_RDONLY)
+        with contextlib.suppress(AttributeError, OSError):
+            os.posix_fadvise(self._fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self._blocks = queue.Queue(maxsize=depth)
+        self._closed = threading.Event()
+        self._current = b""
+        self._pos = 0
+        self._eof = False
+        self._thread = None
+        self.position = 0  # file offset of the next sequential read
+        self.size = os.fstat(self._fd).st_size
+        if self.size <= block_size:
+            self._current = os.pread(self._fd, block_size, 0)
+            self._blocks.put(b"")
+        else:
+            self._thread = threading.Thread(target=self._fill, daemon=True)
+            self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self) -> None:
+        offset = 0
+        try:
+            while True:
+                block = os.pread(self._fd, self.block_size, offset)
+                if not self._put(block) or not block:
+                    return
+                offset += len(block)
+        except OSError as e:
+            self._put(e)
+
+    def read(self, size: int) -> bytes:
+        while self._pos >= len(self._current):
+            if self._eof:
+                return b""
+            block = self._blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self._eof = True
+                return b""
+            self._current, self._pos = block, 0
+        data = self._current[self._pos:self._pos + size]
+        self._pos += len(data)
+        self.position += len(data)
+        return data
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        """Read at an absolute offset: in-order reads come from the read-ahead blocks, others use pread"""
+        if self.position < offset <= self.position + self.block_size:
+            # 跳过一段零区后继续读：丢弃预读中的这一段，保持顺序读取
+            while self.position < offset and self.read(offset - self.position):
+                pass
+        if offset == self.position:
+            return self.read(size)
+        return os.pread(self._fd, size, offset)
+
+    def peek(self, offset: int, size: int) -> bytes:
+        """Read at an absolute offset without moving the sequential position"""
+        return os.pread(self._fd, size, offset)
+
+    def next_data(self, offset: int) -> int:
+        """Start of the first data region at or after offset; the file size if only a hole follows"""
+        try:
+            return os.lseek(self._fd, offset, os.SEEK_DATA)
+        except AttributeError:
+            return offset  # 平台不支持 SEEK_DATA
+        except OSError as e:
+            return self.size if e.errno == errno.ENXIO else offset
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._thread:
+            self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class WriteBehindWriter:
+    """File writer that coalesces small writes and pwrite()s them from a background thread.
+
+    At most max_pending bytes wait in the queue; write() blocks beyond that. Write errors
+    surface from the next write() or from close(). Files smaller than coalesce_size are
+    written synchronously on close() without a thread.
+    """
+
+    def __init__(self, path: Path, coalesce_size: int = 256 * 1024, max_pending: int = 8 * 1024 * 1024):
+        self.coalesce_size = coalesce_size
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._buffer = bytearray()
+        self._offset = 0  # file offset of the start of _buffer
+        self._queue = queue.Queue(maxsize=max(1, max_pending // coalesce_size))
+        self._thread = None
+        self._error = None
+        self.position = 0  # end of everything written or skipped so far
+
+    def write(self, data: bytes) -> int:
+        if self._error:
+            raise self._error
+        self._buffer += data
+        self.position += len(data)
+        if len(self._buffer) >= self.coalesce_size:
+            self._submit()
+        return len(data)
+
+    def __sizeof__(self) -> int:
+        # 计入尚未写出的缓冲区和队列中的数据块，供会话内存统计使用
+        return object.__sizeof__(self) + sys.getsizeof(self._buffer) + self._queue.qsize() * self.coalesce_size
+
+    def skip(self, length: int) -> None:
+        """Leave the next `length` bytes as zeros: a hole, unless allocate() reserved them"""
+        if self._error:
+            raise self._error
+        if self._buffer:
+            self._submit()
+        self._offset += length
+        self.position += length
+
+    def allocate(self, size: int, sparse: bool = False) -> None:
+        """Set the final length up front; unless sparse, also reserve the blocks so the file is not fragmented.
+
+        The reservation runs on the writer thread ahead of the first data block, so a slow
+        posix_fallocate does not hold up the caller; a failure such as ENOSPC surfaces from
+        the next write(). Files below coalesce_size are only truncated.
+        """
+        os.ftruncate(self._fd, size)
+        if sparse or size < self.coalesce_size or not hasattr(os, "posix_fallocate"):
+            return
+        self._start()
+        self._queue.put((size, None))
+
+    def _fallocate(self, size: int) -> None:
+        try:
+            os.posix_fallocate(self._fd, 0, size)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise  # 例如 ENOSPC：在接收数据之前就失败
+
+    def _start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._drain, daemon=True)
+            self._thread.start()
+
+    def _submit(self) -> None:
+        self._start()
+        data, self._buffer = self._buffer, bytearray()
+        self._queue.put((self._offset, data))
+        self._offset += len(data)
+
+    def _pwrite(self, offset: int, data) -> None:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self._fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def _drain(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is None:
+                try:
+                    offset, data = item
+                    if data is None:
+                        self._fallocate(offset)  # allocate() 排入的预分配：(size, None)
+                    else:
+                        self._pwrite(offset, data)
+                except OSError as e:
+                    self._error = e
+
+    def close(self, fsync: bool = False) -> None:
+        """Flush all pending data (to stable storage if fsync) and close; raises the first write error"""
+        if self._fd is None:
+            return
+        try:
+            if self._thread:
+                if self._buffer:
+                    self._submit()
+                self._queue.put(None)
+                self._thread.join()
+            elif self._buffer:
+                self._pwrite(self._offset, self._buffer)
+            if self._error is None and os.fstat(self._fd).st_size != self.position:
+                # 结尾是零区，或预分配的长度与实际写入的不同
+                os.ftruncate(self._fd, self.position)
+            if fsync and self._error is None:
+                os.fsync(self._fd)
+        except OSError as e:
+            self._error = self._error or e
+        finally:
+            os.close(self._fd)
+            self._fd = None
+        if self._error:
+            raise self._error
+
+class FileCache:
+    """LRU of whole-file buffers for the download path, bounded by budget_bytes.
+
+    Files of MMAP_THRESHOLD bytes or more are mapped rather than read. Entries are
+    checked against the file's size and mtime on every lookup. Every get() of a map
+    must be paired with release(); an evicted or replaced map is closed once the
+    last download using it has released it.
+    """
+    MMAP_THRESHOLD = 1024 * 1024
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self.max_entry_bytes = budget_bytes // 2
+        self.used_bytes = 0
+        self._entries = OrderedDict()  # path -> (size, mtime_ns, buffer)
+        self._maps = {}  # id(mmap) -> [mmap, downloads using it, still cached]
+        self._lock = threading.Lock()
+
+    def get(self, path: Path):
+        """The file's contents as bytes or a read-only mmap, or None if it is not cacheable"""
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        if st.st_size > self.max_entry_bytes:
+            return None
+        key = str(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                self._entries.move_to_end(key)
+                METRICS.inc("file_cache_hits_total")
+                return self._acquire(entry[2])
+        METRICS.inc("file_cache_misses_total")
+        buffer = self._load(path, st.st_size)
+        if buffer is None:
+            return None
+        with self._lock:
+            if isinstance(buffer, mmap.mmap):
+                self._maps[id(buffer)] = [buffer, 0, True]
+            old = self._entries.pop(key, None)
+            if old:
+                self.used_bytes -= old[0]
+                self._retire(old[2])
+            self._entries[key] = (st.st_size, st.st_mtime_ns, buffer)
+            self.used_bytes += st.st_size
+            while self.used_bytes > self.budget_bytes and len(self._entries) > 1:
+                _, (size, _, evicted) = self._entries.popitem(last=False)
+                self.used_bytes -= size
+                self._retire(evicted)
+                METRICS.inc("file_cache_evictions_total")
+            return self._acquire(buffer)
+
+    def release(self, buffer) -> None:
+        """A download finished with a buffer returned by get()"""
+        with self._lock:
+            lease = self._maps.get(id(buffer))
+            if lease and lease[0] is buffer:
+                lease[1] -= 1
+                self._close_if_unused(lease)
+
+    def _acquire(self, buffer):
+        lease = self._maps.get(id(buffer))
+        if lease:
+            lease[1] += 1
+        return buffer
+
+    def _retire(self, buffer) -> None:
+        """The buffer left the cache; close it now if it is a map no download is using"""
+        lease = self._maps.get(id(buffer))
+        if lease:
+            lease[2] = False
+            self._close_if_unused(lease)
+
+    def _close_if_unused(self, lease: list) -> None:
+        if lease[1] <= 0 and not lease[2]:
+            del self._maps[id(lease[0])]
+            lease[0].close()
+
+    def _load(self, path: Path, size: int):
+        try:
+            with path.open('rb') as f:
+                if size < self.MMAP_THRESHOLD:
+                    return f.read()
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                with contextlib.suppress(AttributeError, OSError):
+                    mapped.madvise(mmap.MADV_WILLNEED)
+                return mapped
+        except (OSError, ValueError) as e:
+            logger.debug("[Cache] Not caching %s: %s", path, e)
+            return None
+
+class BufferReader:
+    """read(n) over an in-memory buffer, the cached counterpart of ReadAheadReader.
+
+    on_close(buffer) is called when the reader is closed, e.g. FileCache.release.
+    """
+
+    def __init__(self, buffer, on_close=None):
+        self._buffer = buffer
+        self._on_close = on_close
+        self._mapped = isinstance(buffer, mmap.mmap)
+        self.position = 0
+        self.size = len(buffer)
+
+    def read(self, size: int) -> bytes:
+        data = self.read_at(self.position, size)
+        self.position += len(data)
+        return data
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        end = offset + size
+        if self._mapped:
+            # 文件被就地截断后，读取映射中超出新文件末尾的页会触发 SIGBUS：只读到当前文件大小为止
+            end = min(end, self._buffer.size())
+        return self._buffer[offset:end]
+
+    peek = read_at
+
+    def next_data(self, offset: int) -> int:
+        return offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._on_close:
+            self._on_close(self._buffer)
+        self._buffer = None
+
+class DataPortPool:
+    """Pre-bound download sockets lent out one per transfer, served by a bounded thread pool.
+
+    A finished transfer can leave its socket lingering for LINGER seconds, during which one
+    background thread re-sends the final reply to the client's retransmitted last request
+    (in case the reply was lost). Lingering sockets are lent out only when none is free.
+    """
+    LINGER = 2.0
+
+    def __init__(self, config: ServerConfig):
+        self.config = config
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._free = deque()
+        self._lingering = {}  # socket -> (client_addr, last request, final reply, expiry)
+        self._owners = {}  # lent socket -> key of the request it serves, see acquire()
+        self.size = 0
+        first_port = config.base_data_port + config.worker_id * config.worker_data_ports
+        for port in range(first_port, first_port + config.data_ports):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.bind((config.host, port))
+            except OSError as e:
+                logger.warning("Data port %s unavailable, skipping: %s", port, e)
+                sock.close()
+                continue
+            sock.settimeout(config.transfer_timeout)
+            self._free.append(sock)
+            self.size += 1
+        self._executor = ThreadPoolExecutor(max_workers=max(1, self.size), thread_name_prefix="download")
+        threading.Thread(target=self._linger_loop, daemon=True).start()
+
+    def acquire(self, owner=None) -> Optional[socket.socket]:
+        """A free data socket, or None when every port is serving a download.
+
+        owner identifies the request; owner_of() returns it until the socket is released.
+        """
+        with self._lock:
+            if self._free:
+                sock = self._free.popleft()
+            elif self._lingering:
+                sock = min(self._lingering, key=lambda s: self._lingering[s][3])
+                del self._lingering[sock]  # 新会话会忽略上一个客户端的残留包
+            else:
+                return None
+            self._owners[sock] = owner
+            return sock
+
+    def owner_of(self, sock: socket.socket):
+        with self._lock:
+            return self._owners.get(sock)
+
+    def started(self, sock: socket.socket) -> None:
+        """The client reached the socket; a later request with the same owner is a new one"""
+        with self._lock:
+            self._owners.pop(sock, None)
+
+    @staticmethod
+    def _drain(sock: socket.socket) -> None:
+        # 丢弃上一个会话残留的数据包。套接字设置了超时，MSG_DONTWAIT 仍会等满整个超时，
+        # 所以先用 select 确认有数据；调用方不得持有 _lock
+        while select.select([sock], [], [], 0)[0]:
+            try:
+                sock.recvfrom(65535)
+            except OSError:
+                break
+
+    def release(self, sock: socket.socket, linger: Optional[tuple] = None) -> None:
+        """Return a socket; linger=(client_addr, request, reply) keeps answering that request for LINGER seconds"""
+        if not linger:
+            self._drain(sock)
+        with self._lock:
+            self._owners.pop(sock, None)
+            if linger:
+                self._lingering[sock] = (*linger, time.monotonic() + self.LINGER)
+                self._changed.notify()
+            else:
+                self._free.append(sock)
+
+    def _linger_loop(self) -> None:
+        while True:
+            with self._lock:
+                while not self._lingering:
+                    self._changed.wait()
+                socks = list(self._lingering)
+            readable, _, _ = select.select(socks, [], [], 0.05)
+            now = time.monotonic()
+            expired = []
+            with self._lock:
+                for sock in readable:
+                    entry = self._lingering.get(sock)
+                    if entry is None:
+                        continue  # acquire() lent it out meanwhile
+                    try:
+                        data, addr = sock.recvfrom(65535, socket.MSG_DONTWAIT)
+                    except OSError:
+                        continue
+                    if addr == entry[0] and data == entry[1]:
+                        sock.sendto(entry[2], addr)
+                        METRICS.inc("duplicate_requests_total")
+                for sock in [s for s, entry in self._lingering.items() if entry[3] <= now]:
+                    del self._lingering[sock]
+                    expired.append(sock)
+            for sock in expired:
+                self._drain(sock)
+            if expired:
+                with self._lock:
+                    self._free.extend(expired)
+
+    def submit(self, sock: socket.socket, fn, *args) -> None:
+        """Run fn(sock, *args) on a transfer thread, then return the socket, lingering on fn's result"""
+        def run():
+            linger = None
+            try:
+                linger = fn(sock, *args)
+            finally:
+                self.release(sock, linger)
+        self._executor.submit(run)
 
 class FileTransferHandler:
     """Handles file transfer operations"""
-    def __init__(self, config: ServerConfig):
+    def __init__(self, config: ServerConfig, object_store: Optional[ObjectStore] = None,
+                 state: Optional[LocalState] = None, rate_limiter: Optional["RateLimiter"] = None):
         self.config = config
+        self.object_store = object_store
+        self.state = state
+        self.rate_limiter = rate_limiter
+        self.file_cache = FileCache(config.cache_budget_bytes) if config.cache_budget_bytes else None
         self.chunk_size = 1024 # 定义块大小，应与客户端匹配
+        # client_addr -> in-progress upload session; abandoned ones are closed and their temp file removed
+        self.uploads = SessionTable("uploads", config.session_ttl, config.max_sessions,
+                                    on_evict=lambda addr, session: self._discard(session))
+        # client_addr -> (time, reply) of the last finished upload
+        self.completed_uploads = SessionTable("completed_uploads", COMPLETED_UPLOAD_TTL, config.max_sessions)
+
+    def handle_file_transfer(self, data_sock: socket.socket, filename: str, client_path: Path,
+                             on_start=None) -> Optional[tuple]:
+        """Serve one download on a pooled data socket; the caller returns the socket to the pool.
+
+        on_start(data_sock) runs once the client's handshake has arrived. Returns (client_addr,
+        final request, final reply) once the transfer completed, so the pool can answer a
+        retransmitted final request.
+        """
+        with PROFILER.section("download", filename):
+            return self._handle_file_transfer(data_sock, filename, client_path, on_start)
+
+    @staticmethod
+    def _reader_md5(reader) -> str:
+        """MD5 of everything a reader serves, for transfers that were not requested in order"""
+        hash_md5 = hashlib.md5()
+        for offset in range(0, reader.size, 1024 * 1024):
+            hash_md5.update(reader.read_at(offset, 1024 * 1024))
+        return hash_md5.hexdigest()
 
-    def handle_file_transfer(self, filename: str, data_port: int, client_path: Path) -> None:
-        """Handle complete file transfer process on a new port to match the new client logic."""
-        data_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        data_sock.bind((self.config.host, data_port))
-        print(f"[+] Data socket is now listening on port {data_port} for '{filename}'...")
+    @staticmethod
+    def _zero_run(reader, offset: int, length: int) -> int:
+        """Length of the run of zeros at offset, given that its first `length` bytes are zero"""
+        end = offset + length
+        while end < reader.size:
+            end = reader.next_data(end)  # 跳过空洞
+            block = reader.peek(end, ZERO_SCAN_SIZE)
+            zeros = len(block) - len(block.lstrip(b"\0"))
+            end += zeros
+            if not block or zeros < len(block):
+                break
+        return min(end, reader.size) - offset
+
+    def _handle_file_transfer(self, data_sock: socket.socket, filename: str, client_path: Path,
+                              on_start=None) -> Optional[tuple]:
+        data_port = data_sock.getsockname()[1]
+        logger.debug("[+] Data socket on port %s is serving '%s'...", data_port, filename)
 
         file_path = client_path / filename
         if not file_path.is_file():
-            print(f"!!! [Data Port] File not found at path: {file_path}")
-            data_sock.close()
+            logger.error("[Data Port] File not found at path: %s", file_path)
             return
             
         try:
-            # 1. 等待客户端的初始握手信号
-            request_bytes, client_addr = data_sock.recvfrom(self.config.data_buffer_size)
+            # 1. 等待客户端的初始握手信号；池中的端口可能还会收到上一个会话迟到的包，忽略它们
+            handshake = f"DOWNLOAD {filename}".encode('utf-8')
+            while True:
+                request_bytes, client_addr = data_sock.recvfrom(self.config.data_buffer_size)
+                if request_bytes == handshake:
+                    break
+                logger.debug("    [Data Port] Ignoring stale packet from %s: '%r'", client_addr, request_bytes[:40])
+            if on_start:
+                on_start(data_sock)
             request = request_bytes.decode('utf-8')
-            print(f"    [Data Port] Received from {client_addr}: '{request}'")
+            logger.debug("    [Data Port] Received from %s: '%s'", client_addr, request)
+
+            if request == f"DOWNLOAD {filename}":
+                # 2. 回复DOWNLOAD_READY，告诉客户端可以开始请求数据了
+                data_sock.sendto(b"DOWNLOAD_READY", client_addr)
+                logger.debug("    [Data Port] Sent DOWNLOAD_READY to %s. Starting transfer...", client_addr)
+
+                # 3. 打开文件，准备分块发送
+                transfer_start = time.perf_counter()
+                cached = self.file_cache.get(file_path) if self.file_cache else None
+                with (BufferReader(cached, self.file_cache.release) if cached is not None
+                      else ReadAheadReader(file_path)) as f:
+                    hash_md5 = hashlib.md5()
+                    hashed = 0  # 已计入 MD5 的前缀长度，顺序请求时摘要与发送同步完成
+                    last_request = last_response = None
+                    while True:
+                        # 4. 等待客户端的 "GET_CHUNK <offset>" 请求 (旧客户端发送不带偏移量的 "GET_CHUNK")
+                        chunk_req_bytes, recv_addr = data_sock.recvfrom(self.config.data_buffer_size)
+                        if recv_addr != client_addr:
+                            continue
+                        if chunk_req_bytes == handshake:
+                            # DOWNLOAD_READY 丢失，客户端重发了握手
+                            data_sock.sendto(b"DOWNLOAD_READY", client_addr)
+                            continue
+                        if chunk_req_bytes == last_request:
+                            # 回复丢失或损坏，客户端重新请求同一块
+                            data_sock.sendto(last_response, client_addr)
+                            METRICS.inc("duplicate_requests_total")
+                            continue
+                        request = chunk_req_bytes.decode('utf-8')
+                        if request == "GET_CHUNK":
+                            offset, legacy = f.position, True
+                        elif request.startswith("GET_CHUNK ") and request[10:].isdigit():
+                            offset, legacy = int(request[10:]), False
+                        else:
+                            # 如果收到意外的请求，则停止传输
+                            break
+
+                        chunk_data = f.read_at(offset, self.chunk_size)
+                        if not chunk_data:
+                            # 5. 文件读取完毕，发送传输完成信号，附带大小和整个文件的 MD5
+                            if legacy:
+                                response = b"TRANSFER_COMPLETE"
+                            else:
+                                digest = hash_md5.hexdigest() if hashed == f.size else self._reader_md5(f)
+                                response = f"TRANSFER_COMPLETE {f.size} {digest}".encode('utf-8')
+                            data_sock.sendto(response, client_addr)
+                            METRICS.inc("downloads_total")
+                            METRICS.observe("download_seconds", time.perf_counter() - transfer_start)
+                            logger.info("[+] File transfer for '%s' completed.", filename)
+                            return client_addr, chunk_req_bytes, response
+
+                        # 6. 发送数据块：偏移量 + CRC32 + base64 数据；空洞和全零的区段只发送 "ZERO <offset> <length>"
+                        if not legacy and is_zero_block(chunk_data):
+                            length = self._zero_run(f, offset, len(chunk_data))
+                            response = f"ZERO {offset} {length}".encode('utf-8')
+                            if offset == hashed:
+                                update_md5_zeros(hash_md5, length)
+                                hashed += length
+                            METRICS.inc("sparse_bytes_skipped_total", length)
+                        else:
+                            encoded_chunk = base64.b64encode(chunk_data).decode('utf-8')
+                            if legacy:
+                                response = f"DATA {encoded_chunk}".encode('utf-8')
+                            else:
+                                response = f"DATA {offset} {zlib.crc32(chunk_data):08x} {encoded_chunk}".encode('utf-8')
+                            if offset == hashed:
+                                hash_md5.update(chunk_data)
+                                hashed += len(chunk_data)
+                        if self.rate_limiter:
+                            self.rate_limiter.consume(client_addr[0], len(response))
+                        data_sock.sendto(response, client_addr)
+                        if not legacy:  # 旧客户端的请求都一样，无法区分重传
+                            last_request, last_response = chunk_req_bytes, response
+                        METRICS.inc("packets_out_total")
+                        METRICS.inc("bytes_out_total", len(response))
+                        METRICS.inc("download_bytes_total", len(chunk_data))
+            else:
+                logger.error("[Data Port] Expected 'DOWNLOAD %s' but received '%s'. Aborting.", filename, request)
+
+        except socket.timeout:
+            logger.error("[Data Port] Socket timed out during transfer for '%s'.", filename)
+        except Exception as e:
+            logger.error("[Data Port] An error occurred during file transfer: %s", e)
+        finally:
+            logger.debug("[-] Data socket on port %s is free again.", data_port)
+        return None
+
+    def start_upload(self, client_addr: tuple, target_file_path: Path) -> bool:
+        """Open an upload session; DATA/UPLOAD_DONE from this client are then routed to it.
+
+        Data streams into a temp file next to the target, which replaces the target only
+        once it is complete and verified. The old inode is never written through: it may be
+        a hardlink into the object store, or mapped by the download cache.
+        """
+        logger.debug("    [Util] Receiving data for -> %s", target_file_path.absolute())
+        self.abort_upload(client_addr)  # a retransmitted UPLOAD restarts the session
+        try:
+            target_file_path.parent.mkdir(parents=True, exist_ok=True)
+            if target_file_path.is_dir():
+                raise IsADirectoryError(target_file_path)
+            tmp_path = partial_path(target_file_path, f"{client_addr[1]}")
+            self.uploads[client_addr] = {
+                'path': target_file_path,
+                'tmp_path': tmp_path,
+                'file': WriteBehindWriter(tmp_path),
+                'md5': hashlib.md5(),
+                'size': 0,
+                'start_time': time.time()
+            }
+            self.completed_uploads.pop(client_addr, None)
+            return True
+        except Exception as e:
+            logger.error("[Util] Error opening upload target: %s", e)
+            return False
+
+    def has_upload(self, client_addr: tuple) -> bool:
+        return client_addr in self.uploads
+
+    def partial_paths(self) -> list:
+        """Temp files of the uploads in progress"""
+        return [session['tmp_path'] for session in self.uploads.values()]
+
+    def receive_chunk(self, client_addr: tuple, data_message: str) -> str:
+        """Apply 'DATA <offset> <crc32> <base64>' (or legacy 'DATA <base64>'); returns the reply.
+
+        A chunk whose CRC does not match is answered 'NACK_DATA <offset> CHECKSUM' so the
+        client resends just that chunk; a retransmitted chunk that was already written is
+        acknowledged again without being written twice.
+        """
+        session = self.uploads.get(client_addr)
+        if not session:
+            return self._late_chunk_reply(client_addr, data_message)
+        parts = data_message.split(' ', 3)
+        try:
+            if len(parts) == 4:
+                offset, crc = int(parts[1]), int(parts[2], 16)
+                chunk_data = base64.b64decode(parts[3])
+                if zlib.crc32(chunk_data) != crc:
+                    METRICS.inc("checksum_errors_total")
+                    return f"NACK_DATA {offset} CHECKSUM"
+                reply = self._offset_reply(session, offset)
+                if reply:
+                    return reply
+                reply = f"ACK_DATA {offset}"
+            else:
+                chunk_data = base64.b64decode(parts[1])
+                reply = "ACK_DATA"
+        except (ValueError, IndexError):
+            # binascii.Error 是 ValueError 的子类
+            METRICS.inc("checksum_errors_total")
+            return "NACK_DATA MALFORMED"
+        try:
+            session['file'].write(chunk_data)
+            session['md5'].update(chunk_data)
+            session['size'] += len(chunk_data)
+            METRICS.inc("upload_bytes_total", len(chunk_data))
+            return reply
+        except Exception as e:
+            logger.error("[Util] Error during file data reception: %s", e)
+            self.abort_upload(client_addr)
+            return "ERR_UPLOAD_FAILED"
+
+    def _late_chunk_reply(self, client_addr: tuple, message: str) -> str:
+        """Reply to DATA/ZERO that arrives after the client's upload was committed.
+
+        The scheduler serves UPLOAD_DONE ahead of queued chunks, so a duplicated chunk can
+        arrive late; it is acknowledged again rather than answered with an error the client
+        could take for the reply to UPLOAD_DONE.
+        """
+        if client_addr in self.completed_uploads:
+            parts = message.split(' ', 2)
+            if len(parts) == 3 and parts[1].isdigit():
+                METRICS.inc("duplicate_requests_total")
+                return f"ACK_DATA {parts[1]}"
+        return "ERR_NO_UPLOAD_SESSION"
+
+    @staticmethod
+    def _offset_reply(session: dict, offset: int) -> Optional[str]:
+        """Reply to a chunk that is not the next one expected, or None if it is"""
+        if offset < session['size']:
+            METRICS.inc("duplicate_requests_total")
+            return f"ACK_DATA {offset}"
+        if offset > session['size']:
+            return f"NACK_DATA {session['size']} GAP"
+        return None
+
+    def allocate_upload(self, client_addr: tuple, size: int, sparse: bool) -> str:
+        """Size the temp file before any data arrives; returns the reply"""
+        session = self.uploads.get(client_addr)
+        if not session:
+            return "ERR_NO_UPLOAD_SESSION"
+        try:
+            session['file'].allocate(size, sparse)
+        except OSError as e:
+            logger.error("[Util] Cannot allocate %s bytes for '%s': %s", size, session['path'].name, e)
+            self.abort_upload(client_addr)
+            return "ERR_UPLOAD_FAILED"
+        return f"ACK_SIZE {size}"
+
+    def receive_zeros(self, client_addr: tuple, message: str) -> str:
+        """Apply 'ZERO <offset> <length>': a run of zeros the client did not send as data"""
+        session = self.uploads.get(client_addr)
+        if not session:
+            return self._late_chunk_reply(client_addr, message)
+        try:
+            _, offset, length = message.split()
+            offset, length = int(offset), int(length)
+        except ValueError:
+            return "NACK_DATA MALFORMED"
+        if length <= 0:
+            return "NACK_DATA MALFORMED"
+        reply = self._offset_reply(session, offset)
+        if reply:
+            return reply
+        try:
+            session['file'].skip(length)
+        except Exception as e:
+            logger.error("[Util] Error during file data reception: %s", e)
+            self.abort_upload(client_addr)
+            return "ERR_UPLOAD_FAILED"
+        update_md5_zeros(session['md5'], length)
+        session['size'] += length
+        METRICS.inc("sparse_bytes_skipped_total", length)
+        return f"ACK_DATA {offset}"
+
+    def finish_upload(self, client_addr: tuple, expected_size: Optional[int] = None,
+                      expected_md5: Optional[str] = None) -> str:
+        """Verify, fsync and atomically commit the client's upload; returns the reply.
+
+        A retransmitted UPLOAD_DONE gets the same reply again. On failure the temp file
+        is removed and the previous version of the target is left untouched.
+        """
+        session = self.uploads.pop(client_addr, None)
+        if not session:
+            METRICS.inc("duplicate_requests_total")
+            completed = self.completed_uploads.get(client_addr)
+            return completed[1] if completed else "UPLOAD_FAILED NO_SESSION"
+        target_path, tmp_path = session['path'], session['tmp_path']
+        digest = session['md5'].hexdigest()
+        try:
+            session['file'].close(fsync=True)
+            if expected_size is not None and session['size'] != expected_size:
+                raise ValueError(f"SIZE_MISMATCH {session['size']}")
+            if expected_md5 is not None and digest != expected_md5:
+                raise ValueError(f"DIGEST_MISMATCH {digest}")
+            os.replace(tmp_path, target_path)
+            fsync_directory(target_path.parent)
+            # 已校验的摘要写入缓存，下一次 process_manifest 无需重新计算
+            if self.state:
+                self.state.store_md5(target_path, target_path.stat(), digest)
+            if self.object_store:
+                self.object_store.ingest(target_path, digest)
+            reply = "UPLOAD_COMPLETE"
+        except (OSError, ValueError) as e:
+            logger.error("[Util] Upload of '%s' failed: %s", target_path.name, e)
+            with contextlib.suppress(OSError):
+                tmp_path.unlink()
+            METRICS.inc("upload_failures_total")
+            reply = f"UPLOAD_FAILED {e}"
+        self.completed_uploads[client_addr] = (time.time(), reply)
+        if reply == "UPLOAD_COMPLETE":
+            METRICS.inc("uploads_total")
+            METRICS.observe("upload_seconds", time.time() - session['start_time'])
+            logger.debug("    [Util] File receive complete.")
+        return reply
+
+    def abort_upload(self, client_addr: tuple) -> None:
+        session = self.uploads.pop(client_addr, None)
+        if session:
+            self._discard(session)
+
+    @staticmethod
+    def _discard(session: dict) -> None:
+        with contextlib.suppress(OSError):
+            session['file'].close()
+        with contextlib.suppress(OSError):
+            session['tmp_path'].unlink()
+
+LOCAL_TOKEN_TTL = 30.0  # seconds a LOCAL_HELLO token stays valid
+LOCAL_WORKERS = 8  # concurrent transfers on the Unix socket
+LOCAL_TIMEOUT = 10.0  # for reading a request from the Unix socket
+
+class LocalTransferServer:
+    """Same-host fast path: file descriptors passed over a Unix socket instead of UDP chunks.
+
+    A client on this machine asks for a token with LOCAL_HELLO on the main port. The token
+    remembers the client's current directory and is good for one request on the socket:
+    'GET <token> <name>' is answered with 'OK <size>' and a read-only descriptor of the file,
+    'PUT <token> <size> <name>' carries the descriptor of the client's file, which the server
+    copies into a temp file and commits like a UDP upload. The socket is only accessible to
+    the server's user.
+    """
+
+    def __init__(self, config: ServerConfig, object_store: Optional[ObjectStore] = None,
+                 state: Optional[LocalState] = None):
+        self.config = config
+        self.object_store = object_store
+        self.state = state
+        self.path = config.local_socket_path
+        self.tokens = {}  # token -> (client directory, expiry, sync owner)
+        self.active = set()  # temp files of PUTs in progress
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=LOCAL_WORKERS, thread_name_prefix="local")
+
+    def start(self) -> bool:
+        with contextlib.suppress(OSError):
+            if stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                os.unlink(self.path)  # 上次运行遗留的套接字文件
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(str(self.path))
+            os.chmod(self.path, 0o600)
+            sock.listen(64)
+        except OSError as e:
+            logger.warning("Same-host fast path disabled, cannot listen on %s: %s", self.path, e)
+            sock.close()
+            return False
+        threading.Thread(target=self._accept_loop, args=(sock,), daemon=True).start()
+        return True
+
+    def hello(self, client_addr: tuple, current_client_path: Path) -> str:
+        """Reply to LOCAL_HELLO"""
+        if not is_local_address(client_addr[0]):
+            return "LOCAL_NO"
+        token = secrets.token_hex(16)
+        now = time.monotonic()
+        with self._lock:
+            for stale in [t for t, (_, expiry, _) in self.tokens.items() if expiry < now]:
+                del self.tokens[stale]
+            self.tokens[token] = (current_client_path, now + LOCAL_TOKEN_TTL, sync_owner(client_addr))
+        return f"LOCAL_OK {token} {self.path}"
+
+    def _accept_loop(self, sock: socket.socket) -> None:
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError as e:
+                logger.warning("[Local] Accept failed: %s", e)
+                time.sleep(0.1)
+                continue
+            self._executor.submit(self._serve, conn)
+
+    def _serve(self, conn: socket.socket) -> None:
+        fds = []
+        with conn:
+            try:
+                conn.settimeout(LOCAL_TIMEOUT)
+                message, fds, _, _ = socket.recv_fds(conn, 4096, 1)
+                request = message.decode('utf-8').rstrip("\n")
+                reply_fd = None
+                if request.startswith("GET "):
+                    reply, reply_fd = self._get(request)
+                elif request.startswith("PUT "):
+                    reply = self._put(request, fds)
+                else:
+                    reply = "ERR_UNKNOWN_COMMAND"
+                if reply_fd is None:
+                    conn.sendall(reply.encode('utf-8') + b"\n")
+                else:
+                    try:
+                        socket.send_fds(conn, [reply.encode('utf-8') + b"\n"], [reply_fd])
+                    finally:
+                        os.close(reply_fd)
+            except (OSError, UnicodeDecodeError) as e:
+                logger.warning("[Local] Request failed: %s", e)
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+    def _resolve(self, token: str, name: str) -> tuple:
+        """(path of name in the directory the token was issued for, sync owner); ValueError(reply) if not allowed"""
+        with self._lock:
+            entry = self.tokens.pop(token, None)
+        if not entry or entry[1] < time.monotonic():
+            raise ValueError("ERR_INVALID_TOKEN")
+        file_path = entry[0] / name
+        real_path = file_path.resolve()
+        if (not str(real_path).startswith(str(self.config.base_dir))
+                or is_reserved_path(real_path, self.config.base_dir)):
+            raise ValueError("ERR_INVALID_PATH")
+        return file_path, entry[2]
+
+    def _get(self, request: str) -> tuple:
+        """'GET <token> <name>' -> ('OK <size>', read-only descriptor)"""
+        try:
+            _, token, name = request.split(' ', 2)
+            file_path, _ = self._resolve(token, name)
+        except ValueError as e:
+            return (str(e) if str(e).startswith("ERR") else "ERR_INVALID_REQUEST"), None
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            return "ERR_FILE_NOT_FOUND", None
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            os.close(fd)
+            return "ERR_FILE_NOT_FOUND", None
+        METRICS.inc("local_transfers_total", direction="download")
+        METRICS.inc("local_bytes_total", st.st_size, direction="download")
+        logger.debug("[Local] Passed '%s' (%d bytes) to a local client", file_path, st.st_size)
+        return f"OK {st.st_size}", fd
+
+    def partial_paths(self) -> list:
+        with self._lock:
+            return list(self.active)
+
+    def _put(self, request: str, fds: list) -> str:
+        """'PUT <token> <size> <name>' with the source descriptor; copy, verify and commit"""
+        try:
+            _, token, size, name = request.split(' ', 3)
+            size = int(size)
+            target_path, owner = self._resolve(token, name)
+        except ValueError as e:
+            return str(e) if str(e).startswith("ERR") else "ERR_INVALID_REQUEST"
+        if len(fds) != 1:
+            return "ERR_NO_DESCRIPTOR"
+        if self.state.is_locked(str(target_path.resolve()), owner):
+            logger.info("[REJECT] Local write to '%s' rejected. Its folder is syncing.", target_path)
+            return "server syncing , plz wait"
+        src_st = os.fstat(fds[0])
+        if not stat.S_ISREG(src_st.st_mode) or src_st.st_size != size:
+            return "UPLOAD_FAILED SIZE_MISMATCH"
+        start = time.perf_counter()
+        tmp_path = partial_path(target_path, f"local{token[:8]}")
+        with self._lock:
+            self.active.add(tmp_path)
+        try:
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+            if target_path.is_dir():
+                raise IsADirectoryError(target_path)
+            dst_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                method = copy_file_data(fds[0], dst_fd, size)
+                os.fsync(dst_fd)
+            finally:
+                os.close(dst_fd)
+            os.replace(tmp_path, target_path)
+            fsync_directory(target_path.parent)
+            # 摘要由服务器自己计算，不信任客户端；没有对象存储时留给下一次同步按需计算
+            if self.object_store:
+                digest = self.object_store.ingest(target_path)
+                if digest and self.state:
+                    self.state.store_md5(target_path, target_path.stat(), digest)
+        except OSError as e:
+            logger.error("[Local] Upload of '%s' failed: %s", target_path.name, e)
+            with contextlib.suppress(OSError):
+                tmp_path.unlink()
+            METRICS.inc("upload_failures_total")
+            return f"UPLOAD_FAILED {e}"
+        finally:
+            with self._lock:
+                self.active.discard(tmp_path)
+        METRICS.inc("local_transfers_total", direction="upload")
+        METRICS.inc("local_bytes_total", size, direction="upload")
+        METRICS.observe("local_upload_seconds", time.perf_counter() - start)
+        logger.debug("[Local] Received '%s' (%d bytes, %s)", target_path, size, method)
+        return "UPLOAD_COMPLETE"
+
+MCAST_CHUNK = 1024  # payload bytes per MDATA packet; base64 and header keep it below a 1500 byte MTU
+MCAST_ANNOUNCE_EVERY = 256  # chunks between repeated MANNOUNCE packets, for receivers that join late
+MCAST_END_INTERVAL = 0.25  # MANNOUNCE + MEND are repeated this often once the stream has been sent
+MCAST_REPLY_TTL = 10.0  # a repeated MCAST_PUBLISH within this many seconds is a retransmission
+MCAST_LINGER = 3.0  # a stream ends this many seconds after its last NACK
+MCAST_REPAIR_HOLDOFF = 0.1  # a chunk NACKed by several receivers at once is re-sent only once
+MAX_MCAST_STREAMS = 4  # concurrent MCAST_PUBLISH streams per worker
+
+class MulticastStream:
+    """One file sent once to the multicast group, then repaired on request.
+
+    Packets: 'MANNOUNCE <sid> <size> <chunks> <md5> <name>', 'MDATA <sid> <index> <crc32> <base64>'
+    and 'MEND <sid> <chunks>'. Receivers send 'MNACK <sid> <a-b,c,...>' for missing chunks to the
+    stream's source address; those chunks are multicast again, so every receiver that lost them
+    is repaired by the same packet.
+    """
+
+    def __init__(self, config: ServerConfig, sid: str, path: Path, size: int,
+                 state: Optional[LocalState] = None):
+        self.config = config
+        self.sid = sid
+        self.path = path
+        self.size = size
+        self.chunks = -(-size // MCAST_CHUNK)
+        self.state = state
+        self.group = (config.mcast_group, config.mcast_port)
+        self.bucket = TokenBucket(config.mcast_rate) if config.mcast_rate else None
+        self.repairs = {}  # chunk index -> None, in NACK order
+        self.repaired_at = {}  # chunk index -> when it was last re-sent
+        self.sock = None
+        self.data = b""
+
+    def run(self) -> None:
+        digest = self.state.file_md5(self.path) if self.state else calculate_md5(self.path)
+        if not digest:
+            logger.warning("[Mcast] Cannot read '%s', stream %s not sent", self.path, self.sid)
+            return
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        start = time.perf_counter()
+        with self.sock, self.path.open('rb') as f, \
+                (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else contextlib.nullcontext(b"")) as data:
+            self.data = data
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.config.mcast_ttl)
+            if self.config.mcast_interface:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                     socket.inet_aton(self.config.mcast_interface))
+            self.sock.bind((self.config.host, 0))
+            announce = f"MANNOUNCE {self.sid} {self.size} {self.chunks} {digest} {self.path.name}".encode('utf-8')
+            end = f"MEND {self.sid} {self.chunks}".encode('utf-8')
+
+            for _ in range(3):
+                self._send(announce)
+            for index in range(self.chunks):
+                if index and index % MCAST_ANNOUNCE_EVERY == 0:
+                    self._send(announce)
+                    self._collect_nacks(0)
+                    self._send_repairs()
+                self._send(self._packet(index))
+            # 发送完毕后重复 MEND，接收方据此发送 NACK；最后一个 NACK 之后再等待 MCAST_LINGER 秒
+            last_nack = time.monotonic()
+            while time.monotonic() - last_nack < MCAST_LINGER:
+                self._send(announce)
+                self._send(end)
+                deadline = time.monotonic() + MCAST_END_INTERVAL
+                while (remaining := deadline - time.monotonic()) > 0:
+                    if self._collect_nacks(remaining):
+                        last_nack = time.monotonic()
+                    self._send_repairs()
+            self.data = b""
+        METRICS.inc("mcast_streams_total")
+        METRICS.observe("mcast_stream_seconds", time.perf_counter() - start)
+        logger.info("[Mcast] Stream %s of '%s' finished", self.sid, self.path.name)
+
+    def _packet(self, index: int) -> bytes:
+        chunk = self.data[index * MCAST_CHUNK:(index + 1) * MCAST_CHUNK]
+        return f"MDATA {self.sid} {index} {zlib.crc32(chunk):08x} ".encode('utf-8') + base64.b64encode(chunk)
+
+    def _send(self, packet: bytes) -> None:
+        if self.bucket:
+            while not self.bucket.try_consume(len(packet)):
+                time.sleep(self.bucket.wait_time(len(packet)))
+        while True:
+            try:
+                self.sock.sendto(packet, self.group)
+                break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                time.sleep(0.001)  # 发送队列已满，稍后重试
+        METRICS.inc("mcast_bytes_total", len(packet))
+
+    def _collect_nacks(self, timeout: float) -> bool:
+        """Queue the chunks NACKed within timeout seconds; True if a NACK for this stream arrived"""
+        got_nack = False
+        while select.select([self.sock], [], [], timeout)[0]:
+            timeout = 0
+            try:
+                message, _ = self.sock.recvfrom(65535)
+                _, sid, ranges = message.decode('utf-8').split(' ', 2)
+            except (OSError, UnicodeDecodeError, ValueError):
+                continue
+            if sid != self.sid:
+                continue
+            got_nack = True
+            METRICS.inc("mcast_nacks_total")
+            now = time.monotonic()
+            for item in ranges.split(','):
+                first, _, last = item.partition('-')
+                try:
+                    first, last = int(first), int(last or first)
+                except ValueError:
+                    continue
+                for index in range(max(0, first), min(last + 1, self.chunks)):
+                    if now - self.repaired_at.get(index, -MCAST_REPAIR_HOLDOFF) >= MCAST_REPAIR_HOLDOFF:
+                        self.repairs[index] = None
+        return got_nack
 
-            if request == f"DOWNLOAD {filename}":
-                # 2. 回复DOWNLOAD_READY，告诉客户端可以开始请求数据了
-                data_sock.sendto(b"DOWNLOAD_READY", client_addr)
-                print(f"    [Data Port] Sent DOWNLOAD_READY to {client_addr}. Starting transfer...")
+    def _send_repairs(self) -> None:
+        while self.repairs:
+            index = next(iter(self.repairs))
+            del self.repairs[index]
+            self._send(self._packet(index))
+            self.repaired_at[index] = time.monotonic()
+            METRICS.inc("mcast_repairs_total")
 
-                # 3. 打开文件，准备分块发送
-                with file_path.open('rb') as f:
-                    while True:
-                        # 4. 等待客户端的 "GET_CHUNK" 请求
-                        chunk_req_bytes, recv_addr = data_sock.recvfrom(self.config.data_buffer_size)
-                        if chunk_req_bytes.decode('utf-8') != "GET_CHUNK":
-                            # 如果收到意外的请求，则停止传输
-                            break
-                        
-                        chunk_data = f.read(self.chunk_size)
-                        if not chunk_data:
-                            # 5. 文件读取完毕，发送传输完成信号
-                            data_sock.sendto(b"TRANSFER_COMPLETE", client_addr)
-                            print(f"[+] File transfer for '{filename}' completed.")
-                            break
-                        
-                        # 6. 发送数据块
-                        encoded_chunk = base64.b64encode(chunk_data).decode('utf-8')
-                        response = f"DATA {encoded_chunk}"
-                        data_sock.sendto(response.encode('utf-8'), client_addr)
-            else:
-                print(f"!!! [Data Port] Expected 'DOWNLOAD {filename}' but received '{request}'. Aborting.")
+class MulticastPublisher:
+    """Starts MCAST_PUBLISH streams, at most MAX_MCAST_STREAMS at a time"""
 
-        except socket.timeout:
-            print(f"!!! [Data Port] Socket timed out during transfer for '{filename}'.")
-        except Exception as e:
-            print(f"!!! [Data Port] An error occurred during file transfer: {e}")
-        finally:
-            data_sock.close()
-            print(f"[-] Data socket on port {data_port} has been closed.")
+    def __init__(self, config: ServerConfig, state: Optional[LocalState] = None):
+        self.config = config
+        self.state = state
+        self._active = 0
+        self._lock = threading.Lock()
+        # (client_addr, path) -> MCAST_OK reply, so a retransmitted request does not start a second stream
+        self.replies = SessionTable("mcast_publishes", MCAST_REPLY_TTL, config.max_sessions)
+
+    def publish(self, client_addr: tuple, path: Path) -> str:
+        """Reply to MCAST_PUBLISH; the stream itself runs on its own thread"""
+        reply = self.replies.get((client_addr, str(path)))
+        if reply:
+            METRICS.inc("duplicate_requests_total")
+            return reply
+        reply = self._start(path)
+        if reply.startswith("MCAST_OK"):
+            self.replies[(client_addr, str(path))] = reply
+        return reply
 
-    def receive_file_data(self, sock: socket.socket, original_client_addr: tuple, target_file_path: Path) -> None:
-        """Receive complete file data on the main socket"""
-        print(f"    [Util] Receiving data for -> {target_file_path.absolute()}")
+    def _start(self, path: Path) -> str:
         try:
-            target_file_path.parent.mkdir(parents=True, exist_ok=True)
-            with target_file_path.open('wb') as f:
-                while True:
-                    data_bytes, recv_addr = sock.recvfrom(self.config.upload_buffer_size)
-                    data_message = data_bytes.decode('utf-8')
-                    if data_message == "UPLOAD_DONE":
-                        sock.sendto(b"UPLOAD_COMPLETE", original_client_addr)
-                        print(f"    [Util] File receive complete.")
-                        break
-                    if data_message.startswith("DATA "):
-                        chunk_data = base64.b64decode(data_message.split(' ', 1)[1])
-                        f.write(chunk_data)
-                        sock.sendto(b"ACK_DATA", original_client_addr)
+            st = path.stat()
+        except OSError:
+            return "ERR_FILE_NOT_FOUND"
+        if not stat.S_ISREG(st.st_mode):
+            return "ERR_FILE_NOT_FOUND"
+        with self._lock:
+            if self._active >= MAX_MCAST_STREAMS:
+                return "ERR_MCAST_BUSY"
+            self._active += 1
+        stream = MulticastStream(self.config, secrets.token_hex(4), path, st.st_size, self.state)
+        threading.Thread(target=self._run, args=(stream,), daemon=True).start()
+        logger.info("[Mcast] Publishing '%s' (%s bytes) as stream %s to %s:%s",
+                    path.name, st.st_size, stream.sid, self.config.mcast_group, self.config.mcast_port)
+        return f"MCAST_OK {stream.sid} {self.config.mcast_group}:{self.config.mcast_port} {stream.size} {stream.chunks}"
+
+    def _run(self, stream: MulticastStream) -> None:
+        try:
+            stream.run()
         except Exception as e:
-            print(f"!!! [Util] Error during file data reception: {e}")
+            logger.error("[Mcast] Stream %s failed: %s", stream.sid, e)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+TREE_CHUNK_BYTES = 7000  # records per TREE_CHUNK packet
+TREE_LISTING_TTL = 300.0  # listings never closed with TREE_DONE are dropped after this many idle seconds
+TREE_BUILDERS = 2  # threads hashing folders for TREE listings
 
 class FolderHandler:
     """Handles folder operations and folder upload functionality"""
-    def __init__(self, config: ServerConfig):
+    def __init__(self, config: ServerConfig, state: Optional[LocalState] = None):
         self.config = config
-        self.sessions = {}  # Store upload sessions
+        self.state = state
+        self.sessions = SessionTable("folder_uploads", config.session_ttl, config.max_sessions)  # Store upload sessions
+        self.listings = SessionTable("tree_listings", TREE_LISTING_TTL, config.max_sessions)  # TREE listings being fetched
+        self._builder = ThreadPoolExecutor(max_workers=TREE_BUILDERS, thread_name_prefix="tree")
         self.max_folder_depth = 10  # Maximum allowed folder depth
         self.max_path_length = 255  # Maximum path length
 
+    def begin_session(self, root_folder_name: str, current_client_path: Path, client_addr: tuple) -> bool:
+        """Create <root_folder_name> under the client's directory and open a folder upload session"""
+        base_path = current_client_path / root_folder_name
+        real_base_path = base_path.resolve()
+
+        # Security check: ensure the path is within server directory
+        if not str(real_base_path).startswith(str(self.config.base_dir)):
+            logger.error("Attempted to create folder outside server directory: %s", real_base_path)
+            return False
+
+        base_path.mkdir(parents=True, exist_ok=True)
+        self.sessions[client_addr] = {
+            'base_path': base_path,
+            'real_base_path': real_base_path,
+            'created_dirs': {base_path},  # 本次会话已创建 (或确认存在) 的目录，避免重复 resolve/mkdir
+            'applied_seq': -1,
+            'last_reply': None,
+            'start_time': time.time()
+        }
+        return True
+
+    def _relative_path(self, relative_path: str, is_file: bool = False) -> Optional[Path]:
+        """Validate a client-supplied path relative to the upload root"""
+        rel_path = Path(relative_path.replace('/', os.path.sep))
+        if not relative_path or rel_path.is_absolute() or '..' in rel_path.parts:
+            logger.error("Invalid path in folder upload: %s", relative_path)
+            return None
+        if len(relative_path) > self.max_path_length:
+            logger.error("Path too long: %s", relative_path)
+            return None
+        if len(rel_path.parts) - (1 if is_file else 0) > self.max_folder_depth:
+            logger.error("Folder depth exceeds maximum: %s", relative_path)
+            return None
+        return rel_path
+
+    def _ensure_dir(self, session: dict, directory: Path) -> bool:
+        """mkdir -p inside the session's root; directories created earlier in the session are skipped"""
+        created = session['created_dirs']
+        if directory in created:
+            return True
+        # 先 resolve 再创建，防止通过已有的符号链接在根目录之外建目录
+        if not str(directory.resolve()).startswith(str(session['real_base_path'])):
+            logger.error("Attempted to create folder outside upload directory: %s", directory)
+            return False
+        directory.mkdir(parents=True, exist_ok=True)
+        while directory not in created:
+            created.add(directory)
+            directory = directory.parent
+        return True
+
+    def apply_metadata(self, client_addr: tuple, seq: int, records: str) -> str:
+        """Apply one SUPLOAD_META batch of 'D <dir>' / 'F <file>' records; returns the reply.
+
+        Directories are created and the parents of announced files made to exist. Records
+        that are rejected are listed by index in the reply ('META_OK <seq> SKIP 3,7') so the
+        client leaves those files out. A retransmitted batch gets the same reply again.
+        """
+        if not self.is_session_valid(client_addr):
+            return "ERR_NO_SUPLOAD_SESSION"
+        session = self.sessions[client_addr]
+        if seq <= session['applied_seq']:
+            METRICS.inc("duplicate_requests_total")
+            return session['last_reply'] if seq == session['applied_seq'] else f"META_OK {seq}"
+        skipped = []
+        for index, record in enumerate(records.split('\n')):
+            kind, _, relative_path = record.partition(' ')
+            rel_path = self._relative_path(relative_path, is_file=kind == "F") if kind in ("D", "F") else None
+            try:
+                if rel_path is not None:
+                    target = session['base_path'] / rel_path
+                    if self._ensure_dir(session, target if kind == "D" else target.parent):
+                        continue
+            except OSError as e:
+                logger.error("Failed to create folder for '%s': %s", relative_path, e)
+            skipped.append(index)
+        reply = f"META_OK {seq}" + (f" SKIP {','.join(map(str, skipped))}" if skipped else "")
+        session['applied_seq'], session['last_reply'] = seq, reply
+        return reply
+
     def create_folder_structure(self, root_folder_name: str, current_client_path: Path, 
                               folder_structure: str, client_addr: tuple) -> bool:
         """
-        Create folder structure for upload
+        Create folder structure for upload (single-packet SUPLOAD_STRUCTURE from older clients)
         Returns True if successful, False otherwise
         """
         try:
-            base_path = current_client_path / root_folder_name
-            real_base_path = base_path.resolve()
-            
-            # Security check: ensure the path is within server directory
-            if not str(real_base_path).startswith(str(self.config.base_dir)):
-                print(f"[ERROR] Attempted to create folder outside server directory: {real_base_path}")
+            if not self.begin_session(root_folder_name, current_client_path, client_addr):
                 return False
-
-            # Create base directory
-            base_path.mkdir(parents=True, exist_ok=True)
-            
-            # Store session information
-            self.sessions[client_addr] = {
-                'base_path': base_path,
-                'created_dirs': set(),
-                'start_time': time.time()
-            }
-
-            # Process folder structure
+            session = self.sessions[client_addr]
             for rel_dir in folder_structure.split('\n'):
                 if not rel_dir:
                     continue
-                    
-                # Convert to Path object and normalize
-                rel_path = Path(rel_dir.replace('/', os.path.sep))
-                
-                # Security checks
-                if '..' in str(rel_path) or rel_path.is_absolute():
-                    print(f"[ERROR] Invalid path in folder structure: {rel_path}")
-                    return False
-                    
-                # Check path length
-                if len(str(rel_path)) > self.max_path_length:
-                    print(f"[ERROR] Path too long: {rel_path}")
+                rel_path = self._relative_path(rel_dir)
+                if rel_path is None or not self._ensure_dir(session, session['base_path'] / rel_path):
                     return False
-                    
-                # Check folder depth
-                if len(rel_path.parts) > self.max_folder_depth:
-                    print(f"[ERROR] Folder depth exceeds maximum: {rel_path}")
-                    return False
-
-                full_path = base_path / rel_path
-                full_path.mkdir(parents=True, exist_ok=True)
-                self.sessions[client_addr]['created_dirs'].add(full_path)
-
             return True
 
         except Exception as e:
-            print(f"[ERROR] Failed to create folder structure: {e}")
+            logger.error("Failed to create folder structure: %s", e)
             return False
 
     def get_upload_path(self, client_addr: tuple, relative_file_path: str) -> Optional[Path]:
@@ -245,34 +2297,76 @@ class FolderHandler:
             return None
 
         try:
-            # Convert to Path object and normalize
-            rel_path = Path(relative_file_path.replace('/', os.path.sep))
-            
-            # Security checks
-            if '..' in str(rel_path) or rel_path.is_absolute():
-                print(f"[ERROR] Invalid file path: {rel_path}")
-                return None
-                
-            # Check path length
-            if len(str(rel_path)) > self.max_path_length:
-                print(f"[ERROR] File path too long: {rel_path}")
+            rel_path = self._relative_path(relative_file_path, is_file=True)
+            if rel_path is None:
                 return None
-
             full_path = session['base_path'] / rel_path
-            real_path = full_path.resolve()
-            
-            # Security check: ensure the file is within the upload directory
-            if not str(real_path).startswith(str(session['base_path'].resolve())):
-                print(f"[ERROR] Attempted to upload file outside upload directory: {real_path}")
+            if not self._ensure_dir(session, full_path.parent):
                 return None
-
-            # Ensure parent directory exists
-            full_path.parent.mkdir(parents=True, exist_ok=True)
             return full_path
 
         except Exception as e:
-            print(f"[ERROR] Failed to get upload path: {e}")
+            logger.error("Failed to get upload path: %s", e)
+            return None
+
+    def list_tree(self, client_addr: tuple, folder: str, current_client_path: Path) -> Optional[tuple]:
+        """Start or poll the recursive listing of <folder> for a folder download.
+
+        The listing is hashed on a builder thread. Returns (num_chunks, num_records, folder path
+        relative to base_dir) once it is ready, with num_chunks None while it is still being built,
+        or None if the folder is invalid or could not be listed.
+        """
+        real_path = (current_client_path / folder).resolve()
+        if (not real_path.is_dir() or not str(real_path).startswith(str(self.config.base_dir))
+                or is_reserved_path(real_path, self.config.base_dir)):
+            return None
+        root = real_path.relative_to(self.config.base_dir).as_posix()
+
+        listing = self.listings.get(client_addr)
+        if listing is None or listing['root'] != real_path:
+            listing = {'root': real_path, 'chunks': None, 'records': 0, 'start_time': time.time(),
+                       'future': self._builder.submit(self._build_listing, real_path)}
+            self.listings[client_addr] = listing
+        elif listing['chunks'] is not None:
+            METRICS.inc("duplicate_requests_total")  # 重传的 TREE，复用已建好的清单
+        if listing['chunks'] is None:
+            if not listing['future'].done():
+                return None, 0, root
+            try:
+                listing['chunks'], listing['records'] = listing.pop('future').result()
+            except Exception as e:
+                self.listings.pop(client_addr, None)
+                logger.error("[Tree] Failed to list '%s': %s", folder, e)
+                return None
+        return len(listing['chunks']), listing['records'], root
+
+    def _build_listing(self, real_path: Path) -> tuple:
+        """Records are 'D <dir>' and 'F <md5> <file>' lines relative to the folder, packed into
+        TREE_CHUNK packets; returns (chunks, number of records)."""
+        manifest = generate_md5_manifest(real_path, self.config.base_dir, self.state)
+        # 目录排在文件前面，客户端可以先建好目录树再下载文件
+        records = [f"D {rel}" for rel, md5 in sorted(manifest.items()) if md5 == "__DIR__"]
+        records += [f"F {md5} {rel}" for rel, md5 in sorted(manifest.items()) if md5 and md5 != "__DIR__"]
+        chunks, batch, size = [], [], 0
+        for record in records:
+            if batch and size + len(record) + 1 > TREE_CHUNK_BYTES:
+                chunks.append("\n".join(batch))
+                batch, size = [], 0
+            batch.append(record)
+            size += len(record) + 1
+        if batch or not chunks:
+            chunks.append("\n".join(batch))
+        return chunks, len(records)
+
+    def get_tree_chunk(self, client_addr: tuple, index: int) -> Optional[str]:
+        """Return TREE_CHUNK packet <index> of the client's listing, or None"""
+        listing = self.listings.get(client_addr)
+        if listing is None or listing['chunks'] is None or not 0 <= index < len(listing['chunks']):
             return None
+        return f"TREE_CHUNK {index}\n{listing['chunks'][index]}"
+
+    def end_listing(self, client_addr: tuple) -> None:
+        self.listings.pop(client_addr, None)
 
     def cleanup_session(self, client_addr: tuple) -> None:
         """Clean up upload session"""
@@ -284,23 +2378,115 @@ class FolderHandler:
 
     def is_session_valid(self, client_addr: tuple) -> bool:
         """Check if the upload session is valid"""
-        if client_addr not in self.sessions:
-            return False
-            
-        session = self.sessions[client_addr]
-        # Check if session has expired (e.g., 30 minutes)
-        if time.time() - session['start_time'] > 1800:
-            self.cleanup_session(client_addr)
+        # 空闲超过 session_ttl 的会话已由 SessionTable 丢弃
+        return client_addr in self.sessions
+
+class TrashBin:
+    """Deletes by renaming into base_dir/.trash and reclaims the space on a background thread.
+
+    A rename is a single metadata operation however large the tree is, so the request that
+    deleted it can be answered at once. Leftovers from a previous run are reclaimed on start.
+    A directory holding the temp file of an upload in progress (as reported by in_use) is
+    not moved, so the upload can still be renamed into place.
+    """
+
+    def __init__(self, config: ServerConfig, in_use=None):
+        self.root = config.trash_dir
+        self.in_use = in_use or (lambda: ())
+        self._counter = itertools.count()
+        self._wake = threading.Event()
+
+    def start(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        threading.Thread(target=self._reclaim_loop, name="trash-reclaimer", daemon=True).start()
+        self._wake.set()
+
+    def discard(self, path: Path) -> bool:
+        """Move path (file or directory tree) into the trash; True once it is gone from its place"""
+        if self._holds_upload(path):
+            logger.info("[Trash] Keeping %s, an upload into it is in progress", path)
             return False
-            
+        # pid 和计数器保证多个 worker 同时丢弃同名条目时不会冲突
+        target = self.root / f"{os.getpid()}-{time.time_ns()}-{next(self._counter)}-{path.name}"
+        try:
+            os.rename(path, target)
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                logger.warning("[Trash] Cannot move %s to the trash: %s", path, e)
+                return False
+            # 跨文件系统（例如挂载点）无法原子重命名，只能就地删除
+            try:
+                _remove_tree(path)
+            except OSError as e:
+                logger.warning("[Trash] Failed to delete %s: %s", path, e)
+                return False
+            return True
+        METRICS.inc("trash_items_total")
+        self._wake.set()
         return True
 
+    def _holds_upload(self, path: Path) -> bool:
+        if not path.is_dir() or path.is_symlink():
+            return False
+        root = path.resolve()
+        return any(tmp_path.parent.resolve().is_relative_to(root) for tmp_path in self.in_use())
+
+    def _reclaim_loop(self) -> None:
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self.reclaim()
+
+    def reclaim(self) -> None:
+        """Delete everything currently in the trash"""
+        try:
+            entries = list(os.scandir(self.root))
+        except OSError:
+            return
+        for entry in entries:
+            start = time.perf_counter()
+            try:
+                _remove_tree(Path(entry.path))
+            except FileNotFoundError:
+                continue  # 其他 worker 已经回收
+            except OSError as e:
+                logger.warning("[Trash] Failed to reclaim %s: %s", entry.path, e)
+                continue
+            METRICS.inc("trash_reclaimed_total")
+            METRICS.observe("trash_reclaim_seconds", time.perf_counter() - start)
+            logger.debug("[Trash] Reclaimed %s", entry.name)
+
+def _remove_tree(path: Path) -> None:
+    """Remove a file, symlink or directory tree"""
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, **_RMTREE_ERRORS)
+    else:
+        path.unlink()
+
+def _ignore_missing(func, path, exc) -> None:
+    """rmtree error handler: another worker may be reclaiming the same tree concurrently"""
+    if not isinstance(exc, FileNotFoundError):
+        raise exc
+
+# onerror 自 3.12 起弃用，改用 onexc（直接传入异常对象）
+_RMTREE_ERRORS = ({"onexc": _ignore_missing} if sys.version_info >= (3, 12)
+                  else {"onerror": lambda func, path, exc_info: _ignore_missing(func, path, exc_info[1])})
+
+SYNC_BUILDERS = 2  # threads hashing target folders and applying SYNC_FINISH results
+
 class SyncHandler:
     """Handles file synchronization on the server side."""
     
-    def __init__(self, config: ServerConfig):
+    def __init__(self, config: ServerConfig, object_store: Optional[ObjectStore] = None, state: Optional[LocalState] = None,
+                 trash: Optional[TrashBin] = None):
         self.config = config
-        self.sessions = {}  # Store sync sessions
+        self.object_store = object_store
+        self.state = state
+        self.trash = trash or TrashBin(config)
+        self.sessions = SessionTable("sync", config.session_ttl, config.max_sessions)  # Store sync sessions
+        self._builder = ThreadPoolExecutor(max_workers=SYNC_BUILDERS, thread_name_prefix="sync")
         
     def start_sync_session(self, client_addr: tuple, remote_path: str, total_chunks: int) -> bool:
         """Start a new sync session for a client."""
@@ -312,13 +2498,13 @@ class SyncHandler:
                 'total': total_chunks,
                 'start_time': time.time()
             }
-            print(f"\n[Sync] ====== New Sync Session Started ======")
-            print(f"  [Sync] Client: {client_addr}")
-            print(f"  [Sync] Target Remote Path: '{remote_path}'")
-            print(f"  [Sync] Total chunks expected: {total_chunks}")
+            logger.info("[Sync] ====== New Sync Session Started ======")
+            logger.info("  [Sync] Client: %s", client_addr)
+            logger.info("  [Sync] Target Remote Path: '%s'", remote_path)
+            logger.info("  [Sync] Total chunks expected: %s", total_chunks)
             return True
         except Exception as e:
-            print(f"  [Sync] Error starting sync session: {e}")
+            logger.warning("  [Sync] Error starting sync session: %s", e)
             return False
             
     def add_chunk(self, client_addr: tuple, chunk_num: int, chunk_data: str) -> bool:
@@ -327,20 +2513,39 @@ class SyncHandler:
         session = self.sessions.get(session_key)
         
         if not session:
-            print(f"  [Sync] Error: No active session found for {client_addr}")
+            logger.warning("  [Sync] Error: No active session found for %s", client_addr)
             return False
             
         try:
             session['chunks'].append(chunk_data)
-            print(f"  [Sync] Received chunk {chunk_num}/{session['total']} from {client_addr}")
-            print(f"  [Sync] Chunk size: {len(chunk_data)} bytes")
+            logger.debug("  [Sync] Received chunk %d/%d from %s (%d bytes)", chunk_num, session['total'], client_addr, len(chunk_data))
             return True
         except Exception as e:
-            print(f"  [Sync] Error adding chunk: {e}")
+            logger.warning("  [Sync] Error adding chunk: %s", e)
             return False
             
-    def process_manifest(self, client_addr: tuple) -> tuple[bool, str]:
-        """Process the complete manifest and determine required actions."""
+    def process_manifest(self, client_addr: tuple) -> Optional[tuple[bool, str]]:
+        """Start or poll processing of the complete manifest on a builder thread.
+
+        Hashing the target folder, linking known content and deleting are done off the
+        main loop. Returns None while that is still running, then (success, reply), which
+        is kept in the session as 'result' for retransmitted SYNC_FINISH requests.
+        """
+        session = self.sessions.get(f"sync-{client_addr}")
+        if not session:
+            return False, "ERR_NO_SYNC_SESSION"
+        if 'future' not in session:
+            session['future'] = self._builder.submit(self._profiled_manifest, client_addr)
+        if not session['future'].done():
+            return None
+        session['result'] = session.pop('future').result()
+        return session['result']
+
+    def _profiled_manifest(self, client_addr: tuple) -> tuple[bool, str]:
+        with PROFILER.section("sync", f"{client_addr[0]}_{client_addr[1]}"):
+            return self._process_manifest(client_addr)
+
+    def _process_manifest(self, client_addr: tuple) -> tuple[bool, str]:
         session_key = f"sync-{client_addr}"
         session = self.sessions.get(session_key)
         
@@ -350,7 +2555,12 @@ class SyncHandler:
         try:
             full_manifest_str = "".join(session['chunks'])
             client_manifest = json.loads(full_manifest_str)
-            print(f"\nDebug: Client manifest size: {len(client_manifest)} items")
+            ignore = None
+            if isinstance(client_manifest.get("version"), int):
+                # v2 清单: {"version": 2, "files": {...}, "ignore": [...]}，服务器按同样的规则扫描
+                ignore = IgnoreRules(client_manifest.get("ignore") or [])
+                client_manifest = client_manifest["files"]
+            logger.debug("Client manifest size: %d items", len(client_manifest))
             
             # 1. 从会话中获取 remote_path
             remote_path_str = session['remote_path']
@@ -360,15 +2570,16 @@ class SyncHandler:
 
             # 3. !!! 安全检查: 确保目标目录在服务器根目录下 !!!
             if not str(target_dir).startswith(str(self.config.base_dir.resolve())):
-                print(f"[SECURITY] Client {client_addr} attempted directory traversal: '{remote_path_str}'")
+                logger.error("[SECURITY] Client %s attempted directory traversal: '%s'", client_addr, remote_path_str)
                 return False, "ERR_INVALID_PATH"
 
             # 4. 如果目录不存在，则创建它
             target_dir.mkdir(parents=True, exist_ok=True)
 
             # 5. 在指定的目标目录生成服务器清单
-            server_manifest = generate_md5_manifest(target_dir) # <-- 修改: 使用目标目录
-            print(f"Debug: Server manifest size: {len(server_manifest)} items for path '{target_dir}'")
+            # 被忽略的内容不出现在服务器清单中，因此也不会被删除
+            server_manifest = generate_md5_manifest(target_dir, self.config.base_dir, self.state, ignore)
+            logger.debug("Server manifest size: %d items for path '%s'", len(server_manifest), target_dir)
 
             # 后续的比较逻辑完全不变...
             client_items = set(client_manifest.keys())
@@ -376,22 +2587,33 @@ class SyncHandler:
             items_to_delete = server_items - client_items
             files_to_request = []
             
-            print(f"\n[Sync] ====== File Changes for '{remote_path_str}' ======") # <-- 增强日志
-            print(f"  [Sync] Items to delete: {len(items_to_delete)}")
+            logger.info("[Sync] ====== File Changes for '%s' ======", remote_path_str) # <-- 增强日志
+            logger.debug("  [Sync] Items to delete: %s", len(items_to_delete))
             
-            for path in sorted(set(client_items) | server_items):
+            for path in sorted(client_items):
                 client_md5 = client_manifest.get(path)
                 server_md5 = server_manifest.get(path)
                 
                 if path not in server_manifest:
-                    print(f"  [Sync] New file: {path}")
-                    files_to_request.append(path)
+                    logger.debug("  [Sync] New file: %s", path)
                 elif client_md5 != "__DIR__" and server_md5 != "__DIR__" and client_md5 != server_md5:
-                    print(f"  [Sync] Modified file: {path}")
-                    files_to_request.append(path)
+                    logger.debug("  [Sync] Modified file: %s", path)
+                else:
+                    continue
+                # 清单路径来自客户端：逃出目标目录或落入保留目录的条目既不链接也不请求上传
+                if not self._is_safe_entry(target_dir, path):
+                    logger.warning("[Sync] Client %s sent an unsafe manifest path: %r", client_addr, path)
+                    continue
+                # Content already known to the object store is linked in place instead of re-uploaded
+                if self.object_store and client_md5 and self.object_store.has(client_md5):
+                    if self.object_store.link_into(client_md5, target_dir / path):
+                        METRICS.inc("dedup_files_total")
+                        logger.debug("  [Sync] Linked from object store: %s", path)
+                        continue
+                files_to_request.append(path)
             
             # 将目标目录传递给删除函数
-            self._delete_files(items_to_delete, target_dir) # <-- 修改: 传递目标目录
+            self._delete_files(items_to_delete, target_dir, server_items - items_to_delete, ignore) # <-- 修改: 传递目标目录
             
             # 后续的返回逻辑完全不变...
             if files_to_request:
@@ -409,9 +2631,14 @@ class SyncHandler:
                 return True, "SYNC_OK_NO_CHANGES"
             
         except Exception as e:
-            print(f"Error processing manifest: {e}")
+            logger.warning("Error processing manifest: %s", e)
             return False, f"ERR_PROCESSING_MANIFEST: {str(e)}"
             
+    def _is_safe_entry(self, target_dir: Path, rel_path: str) -> bool:
+        """True if a client manifest path stays inside target_dir and outside the reserved entries"""
+        real_path = (target_dir / rel_path).resolve()
+        return target_dir in real_path.parents and not is_reserved_path(real_path, self.config.base_dir)
+
     def get_response_chunk(self, client_addr: tuple, chunk_index: int) -> tuple[bool, str]:
         """Get a specific response chunk for a client."""
         session_key = f"sync-{client_addr}"
@@ -424,66 +2651,386 @@ class SyncHandler:
             chunk_data = session['response_chunks'][chunk_index]
             # If this is the last chunk, clean up the session
             if chunk_index == len(session['response_chunks']) - 1:
-                print(f"    [Sync] Client {client_addr} has fetched all response chunks. Cleaning up session.")
+                logger.debug("    [Sync] Client %s has fetched all response chunks. Cleaning up session.", client_addr)
                 self.sessions.pop(session_key, None)
             return True, chunk_data
         except IndexError:
             return False, "ERR_INVALID_CHUNK_INDEX"
             
-    def _delete_files(self, items_to_delete: set, base_delete_path: Path) -> None:
-        """在指定的基础路径下删除不再需要的文件和空目录。"""
+    def _delete_files(self, items_to_delete: set, base_delete_path: Path, kept: set = frozenset(),
+                      ignore: Optional[IgnoreRules] = None) -> None:
+        """在指定的基础路径下删除不再需要的文件和空目录。
+
+        Files go to the trash with one rename each. A directory with no kept entry below it is
+        renamed whole and its entries are skipped; with ignore rules in effect it may still hold
+        ignored files, so it is only removed once empty.
+        """
         if not items_to_delete:
             return
-            
+
+        trashed_dirs = set()
+        if not ignore:
+            # 仍保留的条目的所有上级目录都不能整体移走
+            kept_dirs = {'/'.join(parts[:i]) for parts in (k.split('/') for k in kept) for i in range(1, len(parts))}
+            for path in sorted(items_to_delete, key=lambda x: len(x.split('/'))):
+                parts = path.split('/')
+                if path in kept_dirs or any('/'.join(parts[:i]) in trashed_dirs for i in range(1, len(parts))):
+                    continue
+                full_path = base_delete_path / path
+                if full_path.is_dir() and not full_path.is_symlink() and self.trash.discard(full_path):
+                    trashed_dirs.add(path)
+                    logger.debug("  [Sync] Deleted directory: %s/", path)
+
         sorted_items = sorted(items_to_delete, key=lambda x: len(x.split('/')), reverse=True)
         
         for path in sorted_items:
+            parts = path.split('/')
+            if any('/'.join(parts[:i]) in trashed_dirs for i in range(1, len(parts) + 1)):
+                continue
             full_path = base_delete_path / path
             try:
-                if full_path.is_file():
-                    full_path.unlink()
-                    print(f"  [Sync] Deleted: {path}")
+                if full_path.is_file() or full_path.is_symlink():
+                    if not self.trash.discard(full_path):
+                        full_path.unlink()
+                    logger.debug("  [Sync] Deleted: %s", path)
                 elif full_path.is_dir():
                     is_empty = not any(full_path.iterdir())
                     if is_empty:
                         full_path.rmdir()
-                        print(f"  [Sync] Deleted empty directory: {path}/")
+                        logger.debug("  [Sync] Deleted empty directory: %s/", path)
                     else:
-                        print(f"  [Sync] Keeping directory: {path}/ (contains files not managed by this client)")
+                        logger.debug("  [Sync] Keeping directory: %s/ (contains files not managed by this client)",
+                                     path)
             except Exception as e:
-                print(f"  [Sync] Failed to delete {path}: {e}")
+                logger.warning("  [Sync] Failed to delete %s: %s", path, e)
+
+BULK_PREFIXES = (b"DATA ", b"ZERO ", b"CDC_DATA ")  # upload chunks; everything else is control traffic
+BULK_QUANTUM = 8192  # bytes credited to a client host per round robin turn, times its weight
+MIN_CLIENT_WEIGHT = 0.125  # keeps a turn's credit above the largest datagram the main socket accepts
+MAX_BULK_QUEUE = 256  # queued chunks per client host; further ones are dropped and retransmitted by the client
+MAX_CONTROL_QUEUE = 4096
+RECV_BATCH = 256  # datagrams moved from the socket into the queues between two requests
+
+class TokenBucket:
+    """Refills at `rate` bytes per second up to a small burst; thread-safe"""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.burst = max(rate / 10, 16 * 1024)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, n: int) -> bool:
+        """Take n bytes if the bucket has them (a packet larger than the burst only needs a full bucket)"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens < min(n, self.burst):
+                return False
+            self.tokens -= n
+            return True
+
+    def wait_time(self, n: int) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (min(n, self.burst) - self.tokens) / self.rate)
+
+    def idle(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.burst
+
+class RateLimiter:
+    """Per-host token buckets for bulk transfer bytes (ServerConfig.client_rate_limit/client_rate_limits)"""
+
+    def __init__(self, config: ServerConfig):
+        self.default_rate = config.client_rate_limit
+        self.rates = config.client_rate_limits
+        self._buckets = {}  # host -> TokenBucket
+        self._lock = threading.Lock()
+
+    def _bucket(self, host: str) -> Optional[TokenBucket]:
+        rate = self.rates.get(host, self.default_rate)
+        if rate <= 0:
+            return None
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(rate)
+            return bucket
+
+    def try_consume(self, host: str, n: int) -> bool:
+        bucket = self._bucket(host)
+        if bucket is None or bucket.try_consume(n):
+            return True
+        METRICS.inc("rate_limited_total")
+        return False
+
+    def wait_time(self, host: str, n: int) -> float:
+        bucket = self._bucket(host)
+        return bucket.wait_time(n) if bucket else 0.0
+
+    def consume(self, host: str, n: int) -> None:
+        """Block the calling transfer thread until n bytes may be sent to host"""
+        bucket = self._bucket(host)
+        if bucket is None:
+            return
+        while not bucket.try_consume(n):
+            METRICS.inc("rate_limited_total")
+            time.sleep(max(bucket.wait_time(n), 0.001))
+
+    def prune(self) -> None:
+        """Forget the buckets of hosts that have not sent anything for a while (full buckets)"""
+        with self._lock:
+            for host in [h for h, bucket in self._buckets.items() if bucket.idle()]:
+                del self._buckets[host]
+
+class RequestScheduler:
+    """Orders the requests read from the main socket.
+
+    Control requests (CD, LIST_FILES, UPLOAD, SYNC_*, STATS, ...) are served first, in
+    arrival order, so the interactive menu stays responsive during large uploads. Upload
+    chunks (DATA, ZERO, CDC_DATA) wait in one queue per client host and are served by
+    deficit round robin weighted by ServerConfig.client_weights; a host over its rate
+    limit is passed over until its token bucket has refilled.
+    """
+
+    def __init__(self, config: ServerConfig, limiter: RateLimiter):
+        self.weights = config.client_weights
+        self.limiter = limiter
+        self.control = deque()  # (message, addr, enqueue time)
+        self.bulk = {}  # host -> deque of (message, addr, enqueue time)
+        self.active = deque()  # hosts with queued chunks, in round robin order
+        self.deficit = {}  # host -> bytes it may still send in its turn
+
+    def push(self, message_bytes: bytes, client_addr: tuple) -> None:
+        item = (message_bytes, client_addr, time.monotonic())
+        if not message_bytes.startswith(BULK_PREFIXES):
+            if len(self.control) >= MAX_CONTROL_QUEUE:
+                METRICS.inc("requests_dropped_total", queue="control")
+                return
+            self.control.append(item)
+            return
+        host = client_addr[0]
+        chunks = self.bulk.get(host)
+        if chunks is None:
+            chunks = self.bulk[host] = deque()
+            self.active.append(host)
+            self.deficit[host] = 0
+        if len(chunks) >= MAX_BULK_QUEUE:
+            METRICS.inc("requests_dropped_total", queue="bulk")
+            return
+        chunks.append(item)
+
+    def queued(self) -> tuple:
+        """(control, bulk) requests waiting"""
+        return len(self.control), sum(len(chunks) for chunks in self.bulk.values())
+
+    def pop(self) -> Optional[tuple]:
+        """Next (message, addr) to handle, or None if nothing may be served right now"""
+        if self.control:
+            message_bytes, client_addr, queued = self.control.popleft()
+            METRICS.observe("queue_wait_seconds", time.monotonic() - queued, queue="control")
+            return message_bytes, client_addr
+        throttled = set()  # 本次被限速跳过的客户端；每个只计一次
+        while len(throttled) < len(self.active):
+            host = self.active[0]
+            chunks = self.bulk[host]
+            size = len(chunks[0][0])
+            if self.deficit[host] < size:
+                # 本轮额度用完，给下一轮加上按权重计算的额度并轮到下一个客户端
+                self.deficit[host] += BULK_QUANTUM * self.weights.get(host, 1.0)
+                self.active.rotate(-1)
+                continue
+            if not self.limiter.try_consume(host, size):
+                throttled.add(host)
+                self.active.rotate(-1)
+                continue
+            self.deficit[host] -= size
+            message_bytes, client_addr, queued = chunks.popleft()
+            if not chunks:
+                self.active.popleft()
+                del self.bulk[host], self.deficit[host]
+            METRICS.observe("queue_wait_seconds", time.monotonic() - queued, queue="bulk")
+            return message_bytes, client_addr
+        return None
+
+    def wait_time(self) -> Optional[float]:
+        """Seconds until pop() can return something; None if the queues are empty"""
+        if self.control:
+            return 0.0
+        if not self.active:
+            return None
+        return min(self.limiter.wait_time(host, len(self.bulk[host][0][0])) for host in self.active)
 
 class FileServer:
     """Main file server class"""
+    # Commands tracked individually in the per-command latency histogram
+    COMMANDS = ("CD", "LIST_FILES", "UPLOAD", "UPLOAD_SIZE", "DATA", "ZERO", "UPLOAD_DONE", "DOWNLOAD", "HAVE", "LOCAL_HELLO", "MCAST_PUBLISH", "CDC_BEGIN",
+                "CDC_RECIPE", "CDC_DATA", "CDC_COMMIT", "SYNC_START", "SYNC_CHUNK", "SYNC_FINISH",
+                "GET_SYNC_CHUNK", "SUPLOAD_BEGIN", "SUPLOAD_META", "SUPLOAD_STRUCTURE", "SUPLOAD_FILE",
+                "SUPLOAD_COMPLETE", "TREE", "GET_TREE_CHUNK", "TREE_DONE",
+                "KILL_SERVER_FILES", "STATS", "PROFILE")
     def __init__(self, config: ServerConfig):
         self.config = config
-        self.file_handler = FileTransferHandler(config)
-        self.folder_handler = FolderHandler(config)
-        self.sync_handler = SyncHandler(config)  # Add sync handler
-        self.client_paths = {}
+        # 客户端目录、同步锁和 MD5 缓存；多进程模式下放在 SQLite 中共享
+        self.state = (SharedState(config.state_db, config.max_sessions) if config.workers > 1
+                      else LocalState(config.max_sessions))
+        self.object_store = ObjectStore(config) if config.dedup else None
+        self.chunk_handler = (ChunkUploadHandler(config, ChunkStore(config), self.object_store, self.state)
+                              if self.object_store else None)
+        self.rate_limiter = RateLimiter(config)
+        self.scheduler = RequestScheduler(config, self.rate_limiter)
+        self.file_handler = FileTransferHandler(config, self.object_store, self.state, self.rate_limiter)
+        self.data_ports = None  # bound in start()
+        # (client_addr, path) -> (data socket, OK reply) of downloads whose socket may still be waiting
+        self.pending_downloads = SessionTable("pending_downloads", config.transfer_timeout, config.max_sessions)
+        self.folder_handler = FolderHandler(config, self.state)
+        self.trash = TrashBin(config, self._partials_in_use)
+        self.local_server = LocalTransferServer(config, self.object_store, self.state) if config.local_transfers else None
+        self.publisher = MulticastPublisher(config, self.state)
+        self.sync_handler = SyncHandler(config, self.object_store, self.state, self.trash)  # Add sync handler
         self.server_sock = None
-        self.is_syncing = False  # <-- 新增：一个简单的布尔标志
+
+    def _partials_in_use(self) -> list:
+        """Temp files of the uploads this process is receiving, which the trash must not move"""
+        paths = self.file_handler.partial_paths()
+        if self.local_server:
+            paths += self.local_server.partial_paths()
+        return paths
+
+    def _sweep_partials(self, cutoff_ns: int) -> None:
+        """Trash the .part files last modified before cutoff_ns: uploads an earlier run never finished"""
+        swept = 0
+        for entry in walk_tree(self.config.base_dir, skip=lambda rel_path, is_dir: is_dir and rel_path in RESERVED_NAMES):
+            if (not entry.is_dir and entry.st_mtime_ns < cutoff_ns
+                    and is_partial_name(entry.rel_path.rpartition('/')[2]) and self.trash.discard(Path(entry.path))):
+                swept += 1
+        if swept:
+            logger.info("[Trash] Removed %d stale upload temp file(s)", swept)
 
     def start(self) -> None:
         """Start the server"""
         self.config.base_dir.mkdir(parents=True, exist_ok=True)
-        print(f"[INFO] Server files directory is ready at: {self.config.base_dir}")
+        logger.info("Server files directory is ready at: %s", self.config.base_dir)
+        self.trash.start()
+        # 单进程时，启动前已存在的临时文件都没有上传在写；多个 worker 时其他 worker 可能正在上传，
+        # 只清理空闲超过会话 TTL 的（对应的会话早已被丢弃）
+        cutoff_ns = time.time_ns() - (int(self.config.session_ttl * 1e9) if self.config.workers > 1 else 0)
+        threading.Thread(target=self._sweep_partials, args=(cutoff_ns,), name="partial-sweeper", daemon=True).start()
+        if self.object_store:
+            self.config.objects_dir.mkdir(parents=True, exist_ok=True)
+            logger.info("Deduplicating object store enabled at: %s", self.config.objects_dir)
+            # 上次运行遗留的块文件已没有会话使用
+            self.trash.discard(self.chunk_handler.chunk_store.root)
 
         self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.config.workers > 1:
+            # 所有 worker 绑定同一端口，内核按客户端地址哈希分配，同一客户端固定落在同一进程
+            self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_sock.bind((self.config.host, self.config.default_port))
-        print(f"[*] Server listening on {self.config.host or '0.0.0.0'}:{self.config.default_port}")
+        self.data_ports = DataPortPool(self.config)
+        logger.info("[*] Server listening on %s:%s", self.config.host or '0.0.0.0', self.config.default_port)
+        if self.local_server and self.local_server.start():
+            logger.info("Same-host transfers served on %s", self.local_server.path)
+        elif self.local_server:
+            self.local_server = None
+
+        if self.config.metrics_file:
+            threading.Thread(target=self._metrics_dump_loop, daemon=True).start()
+            logger.info("Dumping metrics to %s every %ss", self.config.metrics_file, self.config.metrics_interval)
+        if self.config.profile:
+            PROFILER.enable(self.config.profile_dir, memory=self.config.profile_memory)
+            logger.info("Profiling enabled, writing dumps to %s", self.config.profile_dir)
 
         self._main_loop()
 
+    def _send(self, data: bytes, client_addr: tuple) -> None:
+        """Send a reply on the main socket, counting it in the metrics"""
+        try:
+            self.server_sock.sendto(data, client_addr)
+        except BlockingIOError:
+            # 发送缓冲区已满 (套接字为非阻塞)；与丢包一样，由客户端重传请求
+            METRICS.inc("replies_dropped_total")
+            return
+        METRICS.inc("packets_out_total")
+        METRICS.inc("bytes_out_total", len(data))
+
+    def _metrics_dump_loop(self) -> None:
+        """Background thread writing the metrics file every metrics_interval seconds"""
+        while True:
+            time.sleep(self.config.metrics_interval)
+            try:
+                METRICS.dump(self.config.metrics_file)
+            except OSError as e:
+                logger.warning("[Metrics] Failed to write %s: %s", self.config.metrics_file, e)
+
     def _main_loop(self) -> None:
         """Main server loop"""
+        # 每处理一个请求前先把套接字中已到达的包全部取出放入调度队列，控制命令因此可以插到大批数据块之前
+        # 会话表只在主循环中访问，空闲时也按时醒来清理过期会话
+        self.server_sock.setblocking(False)
+        next_sweep = time.monotonic() + SESSION_SWEEP_INTERVAL
         while True:
             try:
-                print("\n======================================================")
-                message_bytes, client_addr = self.server_sock.recvfrom(self.config.buffer_size)
-                self._handle_client_request(message_bytes, client_addr)
+                self._receive_ready()
+                item = self.scheduler.pop()
+                if item is None:
+                    # 没有可处理的请求：等待新的包，或等到被限速的客户端重新有配额
+                    wait = self.scheduler.wait_time()
+                    until_sweep = max(0.0, next_sweep - time.monotonic())
+                    select.select([self.server_sock], [], [], until_sweep if wait is None else min(wait, until_sweep))
+                else:
+                    self._handle_client_request(*item)
             except Exception as e:
-                print(f"\n!!! [FATAL] An error occurred in the main loop: {e}")
+                logger.error("An error occurred in the main loop: %s", e)
+            if time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + SESSION_SWEEP_INTERVAL
+                self._sweep_sessions()
+
+    def _receive_ready(self) -> None:
+        """Move the datagrams waiting on the main socket into the scheduler's queues"""
+        for _ in range(RECV_BATCH):
+            try:
+                message_bytes, client_addr = self.server_sock.recvfrom(self.config.buffer_size)
+            except BlockingIOError:
+                return
+            METRICS.inc("packets_in_total")
+            METRICS.inc("bytes_in_total", len(message_bytes))
+            self.scheduler.push(message_bytes, client_addr)
+
+    def _session_tables(self) -> list:
+        tables = [self.file_handler.uploads, self.file_handler.completed_uploads, self.folder_handler.sessions,
+                  self.folder_handler.listings, self.sync_handler.sessions, self.publisher.replies,
+                  self.pending_downloads]
+        if self.chunk_handler:
+            tables.append(self.chunk_handler.sessions)
+        if not isinstance(self.state, SharedState):
+            tables.append(self.state.client_paths)  # 多进程模式下保存在 SQLite 中
+        return tables
+
+    def _sweep_sessions(self) -> None:
+        """Drop idle sessions and publish the session counts and their approximate memory"""
+        try:
+            self.state.sweep()
+            self.rate_limiter.prune()
+            if self.chunk_handler:
+                self.chunk_handler.sweep()
+            if self.object_store:
+                self.object_store.sweep()
+            control, bulk = self.scheduler.queued()
+            METRICS.set_gauge("queued_requests", control, queue="control")
+            METRICS.set_gauge("queued_requests", bulk, queue="bulk")
+            for table in self._session_tables():
+                table.sweep()
+                METRICS.set_gauge("sessions", len(table), table=table.name)
+                METRICS.set_gauge("session_memory_bytes", table.memory_bytes(), table=table.name)
+        except Exception as e:
+            logger.warning("[Session] Sweep failed: %s", e)
 
     def _handle_client_request(self, message_bytes: bytes, client_addr: tuple) -> None:
         """Handle incoming client request"""
@@ -493,19 +3040,24 @@ class FileServer:
         payload = parts[1] if len(parts) > 1 else ""
         
         # --- 新增的、极简的锁定检查 ---
-        # 1. 检查服务器是否正在同步
-        # 2. 并且检查进来的命令不是一个同步流程中的后续命令
-        allowed_sync_commands = ("SYNC_CHUNK", "SYNC_FINISH", "GET_SYNC_CHUNK")
-        if self.is_syncing and not command_line.startswith(allowed_sync_commands):
-            # 3. 如果是其他命令 (如 UPLOAD, DOWNLOAD, LIST_FILES, 或一个新的 SYNC_START)，则拒绝
+        # 同步锁只锁住各自的远程目录 (见 SYNC_START)，其他传输照常进行；
+        # 只有会清空整个服务器目录的 KILL_SERVER_FILES 要等所有同步结束
+        if command_line == "KILL_SERVER_FILES" and self.state.is_syncing():
             rejection_message = b"server syncing , plz wait"
-            print(f"[REJECT] Request '{command_line}' from {client_addr} rejected. Server is syncing.")
-            self.server_sock.sendto(rejection_message, client_addr)
+            logger.info("[REJECT] Request '%s' from %s rejected. Server is syncing.", command_line, client_addr)
+            self._send(rejection_message, client_addr)
             return  # 直接返回，不处理该请求
         # --- 检查结束 ---
         
-        print(f"[Main Port] Request from {client_addr}: '{command_line}'")
-        current_client_path = self.client_paths.get(client_addr, self.config.base_dir)
+        logger.debug("[Main Port] Request from %s: '%.80s'", client_addr, command_line)
+        command = command_line.split(' ', 1)[0]
+        command = command if command in self.COMMANDS else "OTHER"
+        with METRICS.timer("command_seconds", command=command), PROFILER.section("command", command, aggregate=True):
+            self._dispatch(command_line, message_str, payload, client_addr)
+
+    def _dispatch(self, command_line: str, message_str: str, payload: str, client_addr: tuple) -> None:
+        """Route a request to its handler"""
+        current_client_path = self.state.get_client_path(client_addr, self.config.base_dir)
 
         if command_line.startswith("CD "):
             self._handle_cd_command(command_line, client_addr, current_client_path)
@@ -513,8 +3065,31 @@ class FileServer:
             self._handle_list_command(client_addr, current_client_path)
         elif command_line.startswith("UPLOAD "):
             self._handle_upload_command(command_line, client_addr, current_client_path)
+        elif command_line.startswith("UPLOAD_SIZE "):
+            self._handle_upload_size(command_line, client_addr)
+        elif command_line.startswith("DATA "):
+            self._handle_data_command(message_str, client_addr)
+        elif command_line.startswith("ZERO "):
+            self._handle_zero_command(command_line, client_addr)
+        elif command_line == "UPLOAD_DONE" or command_line.startswith("UPLOAD_DONE "):
+            self._handle_upload_done(command_line, client_addr)
         elif command_line.startswith("DOWNLOAD "):
             self._handle_download_command(command_line, client_addr, current_client_path)
+        elif command_line.startswith("HAVE "):
+            self._handle_have_command(command_line, client_addr, current_client_path)
+        elif command_line.startswith("MCAST_PUBLISH "):
+            self._handle_mcast_publish(command_line, client_addr, current_client_path)
+        elif command_line == "LOCAL_HELLO":
+            reply = self.local_server.hello(client_addr, current_client_path) if self.local_server else "LOCAL_NO"
+            self._send(reply.encode('utf-8'), client_addr)
+        elif command_line.startswith("CDC_BEGIN "):
+            self._handle_cdc_begin(command_line, client_addr, current_client_path)
+        elif command_line.startswith("CDC_RECIPE "):
+            self._handle_cdc_recipe(command_line, payload, client_addr)
+        elif command_line.startswith("CDC_DATA "):
+            self._handle_cdc_data(command_line, payload, client_addr)
+        elif command_line.startswith("CDC_COMMIT"):
+            self._handle_cdc_commit(command_line, client_addr)
         elif command_line.startswith("SYNC_START "):
             self._handle_sync_start(command_line, client_addr)
         elif command_line.startswith("SYNC_CHUNK "):
@@ -523,88 +3098,277 @@ class FileServer:
             self._handle_sync_finish(client_addr)
         elif command_line.startswith("GET_SYNC_CHUNK "):
             self._handle_get_sync_chunk(command_line, client_addr)
+        elif command_line.startswith("SUPLOAD_BEGIN "):
+            self._handle_supload_begin(command_line, client_addr, current_client_path)
+        elif command_line.startswith("SUPLOAD_META "):
+            self._handle_supload_meta(command_line, payload, client_addr)
         elif command_line.startswith("SUPLOAD_STRUCTURE "):
             self._handle_supload_structure(command_line, payload, client_addr, current_client_path)
         elif command_line.startswith("SUPLOAD_FILE "):
             self._handle_supload_file(command_line, client_addr)
         elif command_line == "SUPLOAD_COMPLETE":
             self._handle_supload_complete(client_addr)
+        elif command_line.startswith("TREE "):
+            self._handle_tree_command(command_line, client_addr, current_client_path)
+        elif command_line.startswith("GET_TREE_CHUNK "):
+            self._handle_get_tree_chunk(command_line, client_addr)
+        elif command_line == "TREE_DONE":
+            self.folder_handler.end_listing(client_addr)
+            self._send(b"TREE_DONE_OK", client_addr)
         elif command_line == "KILL_SERVER_FILES":
             self._handle_kill_command(client_addr)
+        elif command_line.startswith("STATS"):
+            self._handle_stats_command(command_line, client_addr)
+        elif command_line.startswith("PROFILE"):
+            self._handle_profile_command(command_line, client_addr)
         else:
-            self.server_sock.sendto(b"ERR_UNKNOWN_COMMAND", client_addr)
+            self._send(b"ERR_UNKNOWN_COMMAND", client_addr)
 
     def _handle_cd_command(self, command_line: str, client_addr: tuple, current_client_path: Path) -> None:
         """Handle CD command"""
         target_dir = command_line.split(" ", 1)[1]
         if target_dir == "..":
             new_path = current_client_path.parent if current_client_path != self.config.base_dir else self.config.base_dir
+        elif target_dir.startswith("/"):
+            new_path = self.config.base_dir / target_dir.lstrip("/")  # 绝对路径从服务器根目录算起
         else:
             new_path = current_client_path / target_dir
         
         real_new_path = new_path.resolve()
-        if real_new_path.is_dir() and str(real_new_path).startswith(str(self.config.base_dir)):
-            self.client_paths[client_addr] = real_new_path
+        if (real_new_path.is_dir() and str(real_new_path).startswith(str(self.config.base_dir))
+                and not is_reserved_path(real_new_path, self.config.base_dir)):
+            self.state.set_client_path(client_addr, real_new_path)
             response = f"CD_OK Now in /{real_new_path.relative_to(self.config.base_dir) or '.'}"
         else:
             response = "CD_ERR Directory not found or invalid."
-        self.server_sock.sendto(response.encode('utf-8'), client_addr)
+        self._send(response.encode('utf-8'), client_addr)
 
     def _handle_list_command(self, client_addr: tuple, current_client_path: Path) -> None:
         """Handle LIST_FILES command"""
-        entries = list(current_client_path.iterdir())
-        files = [f.name for f in entries if f.is_file()]
-        dirs = [f"{d.name}/" for d in entries if d.is_dir()]
+        at_root = current_client_path == self.config.base_dir
+        entries = [e for e in walk_tree(current_client_path, recursive=False)
+                   if not (at_root and e.rel_path in RESERVED_NAMES) and not is_partial_name(e.rel_path)]
+        files = [e.rel_path for e in entries if not e.is_dir]
+        dirs = [f"{e.rel_path}/" for e in entries if e.is_dir]
         response = "OK " + " ".join(dirs + files)
-        self.server_sock.sendto(response.encode('utf-8'), client_addr)
+        self._send(response.encode('utf-8'), client_addr)
 
     def _handle_upload_command(self, command_line: str, client_addr: tuple, current_client_path: Path) -> None:
         """Handle UPLOAD command"""
         filename = command_line.split(' ', 1)[1]
         file_path = current_client_path / filename
-        self.server_sock.sendto(b"UPLOAD_READY", client_addr)
-        self.file_handler.receive_file_data(self.server_sock, client_addr, file_path)
+        # 回收站等保留目录中的文件随时可能被后台删除，不接受上传
+        if is_reserved_path(file_path, self.config.base_dir):
+            self._send(b"ERR_UPLOAD_FAILED", client_addr)
+            return
+        if self._refuse_if_syncing(file_path, client_addr):
+            return
+        if self.file_handler.start_upload(client_addr, file_path):
+            self._send(b"UPLOAD_READY", client_addr)
+        else:
+            self._send(b"ERR_UPLOAD_FAILED", client_addr)
+
+    def _handle_upload_size(self, command_line: str, client_addr: tuple) -> None:
+        """Handle UPLOAD_SIZE <size> SPARSE|DENSE: truncate or preallocate the upload's temp file"""
+        parts = command_line.split()
+        if len(parts) != 3 or not parts[1].isdigit() or parts[2] not in ("SPARSE", "DENSE"):
+            self._send(b"ERR_INVALID_UPLOAD_SIZE", client_addr)
+            return
+        reply = self.file_handler.allocate_upload(client_addr, int(parts[1]), parts[2] == "SPARSE")
+        self._send(reply.encode('utf-8'), client_addr)
+
+    def _handle_data_command(self, message_str: str, client_addr: tuple) -> None:
+        """Handle a DATA chunk for the client's open upload session"""
+        reply = self.file_handler.receive_chunk(client_addr, message_str)
+        self._send(reply.encode('utf-8'), client_addr)
+
+    def _handle_zero_command(self, command_line: str, client_addr: tuple) -> None:
+        """Handle a ZERO run for the client's open upload session"""
+        reply = self.file_handler.receive_zeros(client_addr, command_line)
+        self._send(reply.encode('utf-8'), client_addr)
+
+    def _handle_upload_done(self, command_line: str, client_addr: tuple) -> None:
+        """Handle UPLOAD_DONE [<size> <md5>] for the client's open upload session"""
+        parts = command_line.split()
+        try:
+            expected_size = int(parts[1]) if len(parts) > 1 else None
+        except ValueError:
+            self._send(b"ERR_INVALID_UPLOAD_DONE", client_addr)
+            return
+        expected_md5 = parts[2].lower() if len(parts) > 2 else None
+        reply = self.file_handler.finish_upload(client_addr, expected_size, expected_md5)
+        self._send(reply.encode('utf-8'), client_addr)
+
+    def _handle_have_command(self, command_line: str, client_addr: tuple, current_client_path: Path) -> None:
+        """Handle HAVE <md5> <path>: link known content into place instead of receiving it again"""
+        try:
+            _, digest, filename = command_line.split(' ', 2)
+        except ValueError:
+            self._send(b"ERR_INVALID_HAVE_COMMAND", client_addr)
+            return
+        if not self.object_store:
+            self._send(b"HAVE_UNSUPPORTED", client_addr)  # 客户端之后不再预先计算摘要和发送 HAVE
+            return
+        if not self.object_store.has(digest):
+            self._send(b"HAVE_NO", client_addr)
+            return
+
+        file_path = current_client_path / filename
+        real_path = file_path.resolve()
+        if (not str(real_path).startswith(str(self.config.base_dir))
+                or is_reserved_path(real_path, self.config.base_dir)):
+            self._send(b"ERR_INVALID_PATH", client_addr)
+            return
+        if self._refuse_if_syncing(real_path, client_addr):
+            return
+        if self.object_store.link_into(digest, file_path):
+            METRICS.inc("dedup_files_total")
+            logger.info("  [Store] %s already-known content linked to '%s'", client_addr, filename)
+            self._send(b"HAVE_OK", client_addr)
+        else:
+            self._send(b"HAVE_NO", client_addr)
+
+    def _handle_mcast_publish(self, command_line: str, client_addr: tuple, current_client_path: Path) -> None:
+        """Handle MCAST_PUBLISH <name>: stream the file once to the multicast group"""
+        file_path = current_client_path / command_line.split(' ', 1)[1]
+        real_path = file_path.resolve()
+        if (not str(real_path).startswith(str(self.config.base_dir))
+                or is_reserved_path(real_path, self.config.base_dir)):
+            self._send(b"ERR_INVALID_PATH", client_addr)
+            return
+        if self._refuse_if_syncing(real_path, client_addr):
+            return  # 同步可能正在替换或删除这个文件
+        self._send(self.publisher.publish(client_addr, file_path).encode('utf-8'), client_addr)
+
+    def _handle_cdc_begin(self, command_line: str, client_addr: tuple, current_client_path: Path) -> None:
+        """Handle CDC_BEGIN <num_chunks> <size> <path>"""
+        if not self.chunk_handler:
+            self._send(b"CDC_UNSUPPORTED", client_addr)
+            return
+        try:
+            _, num_chunks, file_size, filename = command_line.split(' ', 3)
+            num_chunks, file_size = int(num_chunks), int(file_size)
+        except ValueError:
+            self._send(b"ERR_INVALID_CDC_COMMAND", client_addr)
+            return
+        file_path = current_client_path / filename
+        real_path = file_path.resolve()
+        if (not str(real_path).startswith(str(self.config.base_dir))
+                or is_reserved_path(real_path, self.config.base_dir)):
+            self._send(b"ERR_INVALID_PATH", client_addr)
+            return
+        if self._refuse_if_syncing(real_path, client_addr):
+            return
+        self._send(self.chunk_handler.begin(client_addr, file_path, num_chunks, file_size).encode('utf-8'), client_addr)
+
+    def _handle_cdc_recipe(self, command_line: str, payload: str, client_addr: tuple) -> None:
+        """Handle CDC_RECIPE <start> with '<sha256>:<length>' entries in the payload"""
+        try:
+            start = int(command_line.split()[1])
+            entries = []
+            for item in payload.split():
+                digest, length = item.split(':')
+                entries.append((digest, int(length)))
+            needed = self.chunk_handler.add_recipe(client_addr, start, entries)
+        except (ValueError, IndexError, AttributeError):
+            self._send(b"ERR_INVALID_CDC_COMMAND", client_addr)
+            return
+        if needed is None:
+            self._send(b"CDC_ERR NO_SESSION", client_addr)
+            return
+        response = f"CDC_NEED {start} " + (",".join(map(str, needed)) or "-")
+        self._send(response.encode('utf-8'), client_addr)
+
+    def _handle_cdc_data(self, command_line: str, payload: str, client_addr: tuple) -> None:
+        """Handle CDC_DATA <index> <offset> with a base64 payload"""
+        try:
+            _, index, offset = command_line.split()
+            index, offset = int(index), int(offset)
+        except ValueError:
+            self._send(b"CDC_ERR BAD_CHUNK", client_addr)
+            return
+        try:
+            ok = self.chunk_handler.add_data(client_addr, index, offset, base64.b64decode(payload))
+        except (ValueError, AttributeError):
+            ok = False
+        # 回复带上块索引和偏移量，客户端据此识别迟到的旧回复
+        reply = f"ACK_DATA {index} {offset}" if ok else f"CDC_ERR BAD_CHUNK {index} {offset}"
+        self._send(reply.encode('utf-8'), client_addr)
+
+    def _handle_cdc_commit(self, command_line: str, client_addr: tuple) -> None:
+        """Handle CDC_COMMIT [md5]"""
+        if not self.chunk_handler:
+            self._send(b"CDC_UNSUPPORTED", client_addr)
+            return
+        parts = command_line.split()
+        response = self.chunk_handler.commit(client_addr, parts[1] if len(parts) > 1 else "")
+        self._send(response.encode('utf-8'), client_addr)
 
     def _handle_download_command(self, command_line: str, client_addr: tuple, current_client_path: Path) -> None:
         """Handle DOWNLOAD command"""
         filename = command_line.split(' ', 1)[1]
         file_path = current_client_path / filename
+        real_path = file_path.resolve()
+        # 与 HAVE/CDC/MCAST 相同：不得读出基目录之外或保留目录 (.objects、.trash) 中的文件
+        if (not str(real_path).startswith(str(self.config.base_dir))
+                or is_reserved_path(real_path, self.config.base_dir)):
+            self._send(f"ERR {filename} INVALID_PATH".encode('utf-8'), client_addr)
+            return
+        key = (client_addr, str(file_path))
+        pending = self.pending_downloads.get(key)
+        if pending and self.data_ports.owner_of(pending[0]) == key:
+            # 重传的 DOWNLOAD：传输线程仍在等待这个客户端，重发同一个 OK，不再占用第二个端口
+            METRICS.inc("duplicate_requests_total")
+            self._send(pending[1], client_addr)
+            return
         if file_path.is_file():
-            data_port = self.config.base_data_port + threading.active_count()
-            response = f"OK {filename} SIZE {file_path.stat().st_size} PORT {data_port}"
-            self.server_sock.sendto(response.encode('utf-8'), client_addr)
-            threading.Thread(
-                target=self.file_handler.handle_file_transfer,
-                args=(filename, data_port, current_client_path)
-            ).start()
+            data_sock = self.data_ports.acquire(key)
+            if data_sock is None:
+                # 所有数据端口都在传输中，客户端稍后重试
+                METRICS.inc("download_busy_total")
+                self._send(f"ERR {filename} BUSY".encode('utf-8'), client_addr)
+                return
+            response = f"OK {filename} SIZE {file_path.stat().st_size} PORT {data_sock.getsockname()[1]}".encode('utf-8')
+            self.pending_downloads[key] = (data_sock, response)
+            self._send(response, client_addr)
+            self.data_ports.submit(data_sock, self.file_handler.handle_file_transfer, filename, current_client_path,
+                                   self.data_ports.started)
         else:
-            self.server_sock.sendto(f"ERR {filename} NOT_FOUND".encode('utf-8'), client_addr)
+            self._send(f"ERR {filename} NOT_FOUND".encode('utf-8'), client_addr)
 
     def _handle_sync_start(self, command_line: str, client_addr: tuple) -> None:
         """Handle SYNC_START <remote_path> <num_chunks> command."""
-        # 检查是否已有另一个同步在进行
-        if self.is_syncing:
-            print(f"[REJECT] New sync from {client_addr} rejected. Server is already syncing.")
-            self.server_sock.sendto(b"server syncing , plz wait", client_addr)
-            return
-
-        # 设置同步状态为 True
-        self.is_syncing = True
-        print(f"[LOCK] Server is now locked for SYNC operation by {client_addr}.")
-
         try:
             parts = command_line.split(' ', 2) # 最多分割两次
             remote_path = parts[1]
             total_chunks = int(parts[2])
-
-            # 调用新的 start_sync_session 方法
-            if self.sync_handler.start_sync_session(client_addr, remote_path, total_chunks):
-                self.server_sock.sendto(b"SYNC_READY", client_addr)
-            else:
-                self.server_sock.sendto(b"ERR_INVALID_START_COMMAND", client_addr)
         except (ValueError, IndexError):
-            print(f"  [Sync] Error: Invalid start command from {client_addr}: {command_line}")
-            self.server_sock.sendto(b"ERR_INVALID_START_COMMAND", client_addr)
+            logger.warning("  [Sync] Error: Invalid start command from %s: %s", client_addr, command_line)
+            self._send(b"ERR_INVALID_START_COMMAND", client_addr)
+            return
+
+        # 检查该远程目录 (或其上下级目录) 是否已有另一个同步在进行，没有则加锁
+        lock_path = str((self.config.base_dir / remote_path).resolve())
+        if not self.state.try_lock_sync(sync_owner(client_addr), lock_path):
+            logger.info("[REJECT] New sync of '%s' from %s rejected. It is already syncing.", remote_path, client_addr)
+            self._send(b"server syncing , plz wait", client_addr)
+            return
+
+        logger.info("[LOCK] '%s' is now locked for SYNC operation by %s.", remote_path, client_addr)
+
+        # 调用新的 start_sync_session 方法
+        if self.sync_handler.start_sync_session(client_addr, remote_path, total_chunks):
+            self._send(b"SYNC_READY", client_addr)
+        else:
+            self._send(b"ERR_INVALID_START_COMMAND", client_addr)
+
+    def _refuse_if_syncing(self, path: Path, client_addr: tuple) -> bool:
+        """Reply 'server syncing' and return True if a running sync holds a folder overlapping path"""
+        if not self.state.is_locked(str(path.resolve()), sync_owner(client_addr)):
+            return False
+        logger.info("[REJECT] Write to '%s' from %s rejected. Its folder is syncing.", path, client_addr)
+        self._send(b"server syncing , plz wait", client_addr)
+        return True
 
     def _handle_sync_chunk(self, command_line: str, payload: str, client_addr: tuple) -> None:
         """Handle SYNC_CHUNK command."""
@@ -613,71 +3377,234 @@ class FileServer:
             chunk_num = int(chunk_num_str)
             
             if self.sync_handler.add_chunk(client_addr, chunk_num, payload):
-                self.server_sock.sendto(f"ACK_CHUNK {chunk_num}".encode('utf-8'), client_addr)
+                self._send(f"ACK_CHUNK {chunk_num}".encode('utf-8'), client_addr)
             else:
-                self.server_sock.sendto(b"ERR_NO_SYNC_SESSION", client_addr)
+                self._send(b"ERR_NO_SYNC_SESSION", client_addr)
         except (ValueError, IndexError):
-            print(f"  [Sync] Error: Invalid chunk command from {client_addr}: {command_line}")
-            self.server_sock.sendto(b"ERR_INVALID_CHUNK_COMMAND", client_addr)
+            logger.warning("  [Sync] Error: Invalid chunk command from %s: %s", client_addr, command_line)
+            self._send(b"ERR_INVALID_CHUNK_COMMAND", client_addr)
 
     def _handle_sync_finish(self, client_addr: tuple) -> None:
-        """Handle SYNC_FINISH command and ensure server unlocks."""
+        """Handle SYNC_FINISH: SYNC_PROCESSING while the manifest is processed, then its result.
+
+        The sync lock is held until processing (including deletions) is done.
+        """
+        session = self.sync_handler.sessions.get(f"sync-{client_addr}")
+        if session and 'result' in session:
+            METRICS.inc("duplicate_requests_total")  # 重传的 SYNC_FINISH
+            self._send(session['result'][1].encode('utf-8'), client_addr)
+            return
         try:
-            success, response = self.sync_handler.process_manifest(client_addr)
-            self.server_sock.sendto(response.encode('utf-8'), client_addr)
-        finally:
-            # 无论成功与否，最后都必须将标志设回 False
-            self.is_syncing = False
-            print(f"[UNLOCK] Server is now unlocked. Sync operation for {client_addr} has finished.")
+            result = self.sync_handler.process_manifest(client_addr)
+        except Exception as e:
+            logger.warning("Error processing manifest: %s", e)
+            result = False, f"ERR_PROCESSING_MANIFEST: {e}"
+        if result is None:
+            self._send(b"SYNC_PROCESSING", client_addr)  # 客户端稍后再次发送 SYNC_FINISH
+            return
+        success, response = result
+        # 无论成功与否都必须释放同步锁；先解锁再回复，客户端的下一个请求可能落在另一个 worker 上
+        self.state.unlock_sync(sync_owner(client_addr))
+        logger.info("[UNLOCK] Sync operation for %s has finished, its directory is unlocked.", client_addr)
+        self._send(response.encode('utf-8'), client_addr)
+        if session:
+            METRICS.observe("sync_session_seconds", time.time() - session['start_time'])
+        METRICS.inc("sync_sessions_total", result="ok" if success else "error")
 
     def _handle_get_sync_chunk(self, command_line: str, client_addr: tuple) -> None:
         """Handle GET_SYNC_CHUNK command."""
         try:
             chunk_index = int(command_line.split(' ', 1)[1])
             success, response = self.sync_handler.get_response_chunk(client_addr, chunk_index)
-            self.server_sock.sendto(response.encode('utf-8'), client_addr)
+            self._send(response.encode('utf-8'), client_addr)
         except (IndexError, ValueError) as e:
-            print(f"!!! [Sync] Invalid chunk request from {client_addr}: {command_line}. Error: {e}")
-            self.server_sock.sendto(b"ERR_INVALID_CHUNK_REQUEST", client_addr)
+            logger.error("[Sync] Invalid chunk request from %s: %s. Error: %s", client_addr, command_line, e)
+            self._send(b"ERR_INVALID_CHUNK_REQUEST", client_addr)
+
+    def _handle_supload_begin(self, command_line: str, client_addr: tuple, current_client_path: Path) -> None:
+        """Handle SUPLOAD_BEGIN <root>: open a folder upload whose structure follows in SUPLOAD_META batches"""
+        root_folder_name = command_line.split(' ', 1)[1]
+        if self._refuse_if_syncing(current_client_path / root_folder_name, client_addr):
+            return
+        try:
+            ok = self.folder_handler.begin_session(root_folder_name, current_client_path, client_addr)
+        except OSError as e:
+            logger.error("Failed to create folder '%s': %s", root_folder_name, e)
+            ok = False
+        self._send(b"SUPLOAD_READY" if ok else b"SUPLOAD_ERR", client_addr)
+
+    def _handle_supload_meta(self, command_line: str, payload: str, client_addr: tuple) -> None:
+        """Handle SUPLOAD_META <seq> followed by one record per line"""
+        try:
+            seq = int(command_line.split(' ', 1)[1])
+        except ValueError:
+            self._send(b"ERR_INVALID_SUPLOAD_META", client_addr)
+            return
+        reply = self.folder_handler.apply_metadata(client_addr, seq, payload)
+        self._send(reply.encode('utf-8'), client_addr)
 
     def _handle_supload_structure(self, command_line: str, payload: str, client_addr: tuple, current_client_path: Path) -> None:
         """Handle SUPLOAD_STRUCTURE command"""
         root_folder_name = command_line.split(' ', 1)[1]
         if self.folder_handler.create_folder_structure(root_folder_name, current_client_path, payload, client_addr):
-            self.server_sock.sendto(b"STRUCTURE_OK", client_addr)
+            self._send(b"STRUCTURE_OK", client_addr)
         else:
-            self.server_sock.sendto(b"STRUCTURE_ERR", client_addr)
+            self._send(b"STRUCTURE_ERR", client_addr)
 
     def _handle_supload_file(self, command_line: str, client_addr: tuple) -> None:
         """Handle SUPLOAD_FILE command"""
         if not self.folder_handler.is_session_valid(client_addr):
-            self.server_sock.sendto(b"ERR_NO_SUPLOAD_SESSION", client_addr)
+            self._send(b"ERR_NO_SUPLOAD_SESSION", client_addr)
             return
 
         relative_file_path = command_line.split(' ', 1)[1]
         full_save_path = self.folder_handler.get_upload_path(client_addr, relative_file_path)
         
         if full_save_path:
-            self.server_sock.sendto(b"FILE_READY", client_addr)
-            self.file_handler.receive_file_data(self.server_sock, client_addr, full_save_path)
+            # 文件内容随后通过 UPLOAD <root>/<relative path> 上传
+            self._send(b"FILE_READY", client_addr)
         else:
-            self.server_sock.sendto(b"ERR_INVALID_PATH", client_addr)
+            self._send(b"ERR_INVALID_PATH", client_addr)
 
     def _handle_supload_complete(self, client_addr: tuple) -> None:
         """Handle SUPLOAD_COMPLETE command"""
         self.folder_handler.cleanup_session(client_addr)
-        self.server_sock.sendto(b"SUPLOAD_OK", client_addr)
+        self._send(b"SUPLOAD_OK", client_addr)
+
+    def _handle_tree_command(self, command_line: str, client_addr: tuple, current_client_path: Path) -> None:
+        """Handle TREE <folder>: reply TREE_READY <chunks> <records> /<folder path>, or TREE_BUILDING
+        while the listing is still being hashed (the client asks again)"""
+        folder = command_line.split(' ', 1)[1]
+        try:
+            result = self.folder_handler.list_tree(client_addr, folder, current_client_path)
+        except OSError as e:
+            logger.error("[Tree] Failed to list '%s': %s", folder, e)
+            result = None
+        if result is None:
+            self._send(b"TREE_ERR Directory not found or invalid.", client_addr)
+            return
+        num_chunks, num_records, root = result
+        if num_chunks is None:
+            self._send(b"TREE_BUILDING", client_addr)
+            return
+        self._send(f"TREE_READY {num_chunks} {num_records} /{root}".encode('utf-8'), client_addr)
+
+    def _handle_get_tree_chunk(self, command_line: str, client_addr: tuple) -> None:
+        """Handle GET_TREE_CHUNK <i> [<j> ...]: stream the requested listing chunks back to back"""
+        indexes = command_line.split()[1:]
+        if not all(index.isdigit() for index in indexes):
+            self._send(b"ERR_INVALID_CHUNK_REQUEST", client_addr)
+            return
+        for index in indexes:
+            chunk = self.folder_handler.get_tree_chunk(client_addr, int(index))
+            if chunk is None:
+                self._send(b"ERR_NO_TREE_LISTING", client_addr)
+                return
+            self._send(chunk.encode('utf-8'), client_addr)
+
+    def _handle_stats_command(self, command_line: str, client_addr: tuple) -> None:
+        """Handle STATS [PROM]: reply with a JSON snapshot or Prometheus text"""
+        self._sweep_sessions()  # 会话计数和内存为当前值
+        if command_line.split()[1:] == ["PROM"]:
+            response = METRICS.to_prometheus()
+        else:
+            response = json.dumps(METRICS.snapshot(), separators=(',', ':'))
+        self._send(response.encode('utf-8'), client_addr)
+
+    def _handle_profile_command(self, command_line: str, client_addr: tuple) -> None:
+        """Handle PROFILE ON [MEM] | OFF | DUMP | STATUS; dumps always go to the configured profile_dir"""
+        args = command_line.split()[1:]
+        action = args[0].upper() if args else "STATUS"
+        if action == "ON":
+            try:
+                PROFILER.enable(self.config.profile_dir, memory=args[1:] == ["MEM"])
+            except OSError as e:
+                self._send(f"ERR_PROFILE {e}".encode('utf-8'), client_addr)
+                return
+            logger.info("[Profile] Enabled by %s, writing to %s", client_addr, self.config.profile_dir)
+            response = f"PROFILE_OK on {self.config.profile_dir}"
+        elif action == "OFF":
+            written = PROFILER.disable()
+            logger.info("[Profile] Disabled by %s", client_addr)
+            response = f"PROFILE_OK off {len(written)} files"
+        elif action == "DUMP":
+            response = f"PROFILE_OK dumped {len(PROFILER.flush())} files"
+        elif action == "STATUS":
+            response = json.dumps(PROFILER.status(), separators=(',', ':'))
+        else:
+            response = "ERR_PROFILE usage: PROFILE ON [MEM] | OFF | DUMP | STATUS"
+        self._send(response.encode('utf-8'), client_addr)
 
     def _handle_kill_command(self, client_addr: tuple) -> None:
         """Handle KILL_SERVER_FILES command"""
-        shutil.rmtree(self.config.base_dir)
-        self.config.base_dir.mkdir(parents=True, exist_ok=True)
-        self.server_sock.sendto(b"KILL_OK All files and directories deleted successfully.", client_addr)
+        # 逐个顶层条目移入回收站，实际删除由后台线程完成，所以可以立即回复
+        failed = []
+        with os.scandir(self.config.base_dir) as entries:
+            for entry in entries:
+                if entry.name != self.trash.root.name and not self.trash.discard(Path(entry.path)):
+                    failed.append(entry.name)
+        if failed:
+            self._send(f"KILL_ERR Could not delete: {', '.join(sorted(failed))}".encode('utf-8'), client_addr)
+            return
+        self._send(b"KILL_OK All files and directories deleted successfully.", client_addr)
+
+def _exit_with_parent() -> None:
+    """Ask Linux to SIGTERM this worker when the supervisor dies, even if it was SIGKILLed"""
+    PR_SET_PDEATHSIG = 1
+    with contextlib.suppress(OSError, AttributeError):
+        import ctypes
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+
+def run_workers(config: ServerConfig) -> None:
+    """Prefork config.workers server processes on the same port and restart any that die"""
+    config.base_dir.mkdir(parents=True, exist_ok=True)
+    SharedState(config.state_db)  # create the schema once, before the workers race for it
+    children = {}
+
+    def spawn(worker_id: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            _exit_with_parent()
+            metrics_file = config.metrics_file
+            if metrics_file:
+                # 每个 worker 写自己的指标文件，避免互相覆盖
+                metrics_file = metrics_file.with_name(f"{metrics_file.stem}.worker{worker_id}{metrics_file.suffix}")
+            try:
+                FileServer(replace(config, worker_id=worker_id, metrics_file=metrics_file)).start()
+            finally:
+                os._exit(1)
+        children[pid] = worker_id
+
+    def shutdown(signum, frame):
+        for pid in children:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+
+    for worker_id in range(config.workers):
+        spawn(worker_id)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    logger.info("Started %s workers on port %s, shared state in %s",
+                config.workers, config.default_port, config.state_db)
+    while True:
+        pid, status = os.wait()
+        worker_id = children.pop(pid, None)
+        if worker_id is not None:
+            logger.warning("Worker %s (pid %s) exited with status %s; restarting", worker_id, pid, status)
+            time.sleep(1)
+            spawn(worker_id)
 
 if __name__ == "__main__":
     # Create server configuration
     config = ServerConfig.from_args()
+    logging.basicConfig(level=config.log_level, format="%(message)s")
     
-    # Create and start server
-    server = FileServer(config)
-    server.start()
\ No newline at end of file
+    if config.workers > 1:
+        run_workers(config)
+    else:
+        # Create and start server
+        server = FileServer(config)
+        server.start()
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""Fixtures that run server.py on loopback in a temporary directory and talk to it over UDP."""
+import json
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Channel:
+    """One client address: replies to its requests come back to the same socket."""
+
+    def __init__(self, address, timeout: float = 3.0):
+        self.address = address
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(timeout)
+
+    def ask(self, message, address=None) -> str:
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        self.sock.sendto(message, address or self.address)
+        return self.sock.recvfrom(65535)[0].decode("utf-8")
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class Server:
+    """server.py on 127.0.0.1; files live under `base`, the server's serverfile directory."""
+
+    def __init__(self, root: Path, *args):
+        self.port = free_port()
+        self.address = ("127.0.0.1", self.port)
+        self.root = root
+        self.base = root / "serverfile"
+        self.log_path = root.with_name(root.name + ".log")
+        root.mkdir(parents=True, exist_ok=True)
+        with self.log_path.open("w") as log:
+            self.proc = subprocess.Popen(
+                [sys.executable, str(REPO_ROOT / "server.py"), str(self.port), "--log-level", "INFO", *args],
+                cwd=root, stdout=log, stderr=subprocess.STDOUT)
+        self._channels = []
+        self._wait_ready()
+
+    def _wait_ready(self, timeout: float = 10.0) -> None:
+        channel = self.channel(timeout=0.2)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"server exited:\n{self.log()}")
+            try:
+                channel.ask("STATS")
+                return
+            except OSError:
+                continue
+        raise RuntimeError(f"server did not answer within {timeout}s:\n{self.log()}")
+
+    def channel(self, timeout: float = 3.0) -> Channel:
+        channel = Channel(self.address, timeout)
+        self._channels.append(channel)
+        return channel
+
+    def ask(self, message) -> str:
+        """Send one request from a fresh client address"""
+        return self.channel().ask(message)
+
+    def client(self, *args, input: str = None, cwd: Path = None) -> list:
+        """Run the non-interactive client.py and return its JSON lines"""
+        result = subprocess.run(
+            [sys.executable, str(REPO_ROOT / "client.py"), "--port", str(self.port), *map(str, args)],
+            input=input, capture_output=True, text=True, timeout=120, cwd=cwd or self.root.parent)
+        return [json.loads(line) for line in result.stdout.splitlines() if line.startswith("{")]
+
+    def log(self) -> str:
+        return self.log_path.read_text(errors="replace")
+
+    def stop(self) -> None:
+        for channel in self._channels:
+            channel.close()
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+
+@pytest.fixture
+def start_server(tmp_path):
+    """Factory: start_server(*server_args) -> Server; every server is stopped after the test"""
+    servers = []
+
+    def start(*args) -> Server:
+        server = Server(tmp_path / f"srv{len(servers)}", *args)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def server(start_server) -> Server:
+    """A plain server with the same-host fast path off, so transfers go over UDP"""
+    return start_server("--no-local")
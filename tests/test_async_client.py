@@ -0,0 +1,50 @@
+"""AsyncClient: concurrent operations, each on its own UDP endpoint"""
+import asyncio
+import os
+
+import pytest
+
+from client import AsyncClient, TransferError
+
+
+def test_concurrent_upload_and_download(server, tmp_path):
+    files = {f"f{i}.bin": os.urandom(20000 + i * 1000) for i in range(8)}
+    for name, data in files.items():
+        (tmp_path / name).write_bytes(data)
+
+    async def run():
+        async with AsyncClient("127.0.0.1", server.port) as client:
+            await asyncio.gather(*(client.upload(tmp_path / name, name) for name in files))
+            listed = await client.list()
+            paths = await asyncio.gather(*(client.download(name, tmp_path / "dl" / name) for name in files))
+        return listed, paths
+
+    listed, paths = asyncio.run(run())
+    assert sorted(listed) == sorted(files)
+    for path in paths:
+        assert path.read_bytes() == files[path.name]
+
+
+def test_cd_is_replayed_on_every_endpoint(server, tmp_path):
+    (server.base / "a" / "b").mkdir(parents=True)
+    (tmp_path / "x.txt").write_text("in b")
+
+    async def run():
+        async with AsyncClient("127.0.0.1", server.port) as client:
+            assert await client.cd("a") == "a"
+            assert await client.cd("b") == "a/b"
+            await client.upload(tmp_path / "x.txt", "x.txt")
+            assert await client.cd("/a") == "a"  # 以 / 开头的路径从根目录解析
+            return await client.list()
+
+    assert asyncio.run(run()) == ["b/"]
+    assert (server.base / "a" / "b" / "x.txt").read_text() == "in b"
+
+
+def test_cd_into_missing_folder_fails(server):
+    async def run():
+        async with AsyncClient("127.0.0.1", server.port) as client:
+            await client.cd("missing")
+
+    with pytest.raises(TransferError):
+        asyncio.run(run())
@@ -0,0 +1,30 @@
+"""bench/run_bench.py: a quick run produces a complete JSON report"""
+import json
+import subprocess
+import sys
+
+from conftest import REPO_ROOT
+
+sys.path.insert(0, str(REPO_ROOT / "bench"))
+from run_bench import percentile  # noqa: E402
+
+
+def test_percentile():
+    assert percentile([], 0.5) is None
+    assert percentile([3, 1, 2], 0.5) == 2
+    assert percentile(list(range(101)), 0.99) == 99
+
+
+def test_quick_run_reports_json(tmp_path):
+    result = subprocess.run(
+        [sys.executable, str(REPO_ROOT / "bench" / "run_bench.py"), "--quick", "--workloads", "huge,sync_modified",
+         "-o", str(tmp_path / "report.json")],
+        capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr[-2000:]
+    report = json.loads((tmp_path / "report.json").read_text())
+    assert report == json.loads(result.stdout)
+    huge, sync = report["results"]["huge"], report["results"]["sync_modified"]
+    assert huge["ok"] and huge["verified"] and huge["upload_mb_s"] > 0
+    assert sync["ok"]
+    for workload in (huge, sync):
+        assert workload["wall_seconds"] > 0 and workload["server_peak_rss_kb"] > 0
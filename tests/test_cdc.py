@@ -0,0 +1,93 @@
+"""CDC_BEGIN / CDC_RECIPE / CDC_DATA / CDC_COMMIT: re-uploading only the chunks that changed"""
+import base64
+import hashlib
+import os
+import time
+
+import pytest
+
+
+def _counts(records) -> dict:
+    histograms = records[-1]["metrics"]["histograms"]
+    return {command: histograms.get(f'request_seconds{{command="{command}"}}', {}).get("count", 0)
+            for command in ("CDC_BEGIN", "CDC_DATA")}
+
+
+def _commit(channel, md5):
+    deadline = time.monotonic() + 5
+    while (reply := channel.ask(f"CDC_COMMIT {md5}")) == "CDC_COMMITTING" and time.monotonic() < deadline:
+        time.sleep(0.05)  # 文件在后台线程中重组
+    return reply
+
+
+def test_modified_file_sends_only_changed_chunks(start_server, tmp_path):
+    server = start_server("--dedup", "--no-local")
+    data = bytearray(os.urandom(4 * 1024 * 1024))
+    local = tmp_path / "big.bin"
+    local.write_bytes(data)
+    first = server.client("upload", local, "big.bin")
+    assert first[0]["ok"]
+
+    data[2_000_000:2_000_010] = b"x" * 10
+    local.write_bytes(data)
+    second = server.client("upload", local, "big.bin")
+    assert second[0]["ok"]
+    assert (server.base / "big.bin").read_bytes() == data
+    counts = _counts(second)
+    assert counts["CDC_BEGIN"] >= 1
+    assert 0 < counts["CDC_DATA"] < _counts(first)["CDC_DATA"] // 10
+
+
+def test_raw_cdc_session(start_server):
+    server = start_server("--dedup", "--no-local")
+    channel = server.channel()
+    body = b"a" * 20
+    assert channel.ask("CDC_BEGIN 1 20 small.txt") == "CDC_READY"
+    assert channel.ask(f"CDC_RECIPE 0\n{hashlib.sha256(body).hexdigest()}:20") == "CDC_NEED 0 0"
+    payload = base64.b64encode(body).decode()
+    assert channel.ask(f"CDC_DATA 0 0\n{payload}") == "ACK_DATA 0 0"
+    assert channel.ask(f"CDC_DATA 0 0\n{payload}") == "ACK_DATA 0 0"  # retransmission
+    assert channel.ask(f"CDC_COMMIT {hashlib.md5(body).hexdigest()}") in ("CDC_COMMITTING", "CDC_DONE")
+    assert _commit(channel, hashlib.md5(body).hexdigest()) == "CDC_DONE"
+    assert channel.ask(f"CDC_COMMIT {hashlib.md5(body).hexdigest()}") == "CDC_DONE"  # retransmission
+    assert (server.base / "small.txt").read_bytes() == body
+
+
+@pytest.mark.parametrize("request_line", [
+    "CDC_BEGIN 100000000 1000 x",     # more chunks than the size allows
+    "CDC_BEGIN -1 1000 x",
+    "CDC_BEGIN one 1000 x",
+])
+def test_cdc_begin_rejects_bad_counts(start_server, request_line):
+    server = start_server("--dedup", "--no-local")
+    assert server.ask(request_line) == "ERR_INVALID_CDC_COMMAND"
+
+
+def test_cdc_recipe_and_data_validation(start_server):
+    server = start_server("--dedup", "--no-local")
+    channel = server.channel()
+    assert channel.ask("CDC_BEGIN 1 20 x") == "CDC_READY"
+    assert channel.ask("CDC_RECIPE -1\nab:3") == "ERR_INVALID_CDC_COMMAND"
+    assert channel.ask("CDC_RECIPE 0\nab:0") == "ERR_INVALID_CDC_COMMAND"
+    digest = hashlib.sha256(b"a" * 20).hexdigest()
+    assert channel.ask(f"CDC_RECIPE 0\n{digest}:20") == "CDC_NEED 0 0"
+    # 偏移量必须接着已收到的数据
+    assert channel.ask(f"CDC_DATA 0 5\n{base64.b64encode(b'a' * 5).decode()}") == "CDC_ERR BAD_CHUNK 0 5"
+    assert channel.ask("CDC_DATA 0 x\nYQ==") == "CDC_ERR BAD_CHUNK"
+
+
+def test_cdc_without_store(server):
+    assert server.ask("CDC_BEGIN 1 20 x") == "CDC_UNSUPPORTED"
+
+
+def test_cdc_commit_digest_mismatch_keeps_target(start_server):
+    server = start_server("--dedup", "--no-local")
+    (server.base / "small.txt").write_bytes(b"old")
+    channel = server.channel()
+    body = b"b" * 20
+    assert channel.ask("CDC_BEGIN 1 20 small.txt") == "CDC_READY"
+    assert channel.ask(f"CDC_RECIPE 0\n{hashlib.sha256(body).hexdigest()}:20") == "CDC_NEED 0 0"
+    assert channel.ask(f"CDC_DATA 0 0\n{base64.b64encode(body).decode()}") == "ACK_DATA 0 0"
+    assert _commit(channel, "0" * 32) == "CDC_ERR DIGEST_MISMATCH"
+    assert (server.base / "small.txt").read_bytes() == b"old"
+    assert not list(server.base.glob("*.part"))
@@ -0,0 +1,30 @@
+"""Non-interactive client: one JSON line per operation, then a summary"""
+from client import parse_batch_lines
+
+
+def test_batch_runs_each_line(server, tmp_path):
+    (tmp_path / "a.txt").write_text("a")
+    (server.base / "docs").mkdir(parents=True)
+    script = f"# comment\ncd docs\nupload {tmp_path / 'a.txt'} a.txt\nls\ndownload missing.txt\n"
+    records = server.client("--jobs", "1", "batch", "-", input=script)
+    by_op = {record["op"]: record for record in records}
+    assert by_op["cd"]["ok"] and by_op["upload"]["ok"]
+    assert by_op["ls"]["entries"] == ["a.txt"]
+    assert not by_op["download"]["ok"]
+    assert by_op["summary"]["ok"] == 3 and by_op["summary"]["failed"] == 1
+    assert (server.base / "docs" / "a.txt").read_text() == "a"
+
+
+def test_unparseable_line_fails_alone(server):
+    records = server.client("batch", "-", input='ls\nupload "unterminated\nls\n')
+    failed = [record for record in records if record.get("ok") is False]
+    assert [(record["line"], record["op"]) for record in failed] == [(2, "parse-error")]
+    assert records[-1]["ok"] == 2 and records[-1]["failed"] == 1
+
+
+def test_parse_batch_lines():
+    lines = ["# skipped", "", "upload 'my file.txt' remote.txt", "LS", 'cd "x']
+    operations = parse_batch_lines(lines)
+    assert operations[0] == (3, "upload", ["my file.txt", "remote.txt"])
+    assert operations[1] == (4, "ls", [])
+    assert operations[2][:2] == (5, "parse-error")
@@ -0,0 +1,79 @@
+"""HAVE: linking content the object store already holds instead of uploading it again"""
+import hashlib
+import os
+from types import SimpleNamespace
+
+from server import ObjectStore
+from test_upload import data_line
+
+
+def test_have_links_known_content(start_server, tmp_path):
+    server = start_server("--dedup", "--no-local")
+    data = os.urandom(50000)
+    (tmp_path / "a.bin").write_bytes(data)
+    assert server.client("upload", tmp_path / "a.bin", "a.bin")[0]["ok"]
+
+    digest = hashlib.md5(data).hexdigest()
+    assert server.ask(f"HAVE {digest} copies/b.bin") == "HAVE_OK"
+    assert (server.base / "copies" / "b.bin").read_bytes() == data
+    assert os.stat(server.base / "copies" / "b.bin").st_ino == os.stat(server.base / "a.bin").st_ino
+
+
+def test_have_unknown_digest(start_server):
+    server = start_server("--dedup", "--no-local")
+    assert server.ask(f"HAVE {'0' * 32} x.bin") == "HAVE_NO"
+    assert not (server.base / "x.bin").exists()
+
+
+def test_have_rejects_paths_outside_base(start_server, tmp_path):
+    server = start_server("--dedup", "--no-local")
+    (tmp_path / "a.txt").write_text("known")
+    server.client("upload", tmp_path / "a.txt", "a.txt")
+    digest = hashlib.md5(b"known").hexdigest()
+    assert server.ask(f"HAVE {digest} ../escape.txt") == "ERR_INVALID_PATH"
+    assert server.ask(f"HAVE {digest} .objects/x") == "ERR_INVALID_PATH"
+    assert not (server.root / "escape.txt").exists()
+
+
+def test_have_without_store(server):
+    assert server.ask(f"HAVE {'0' * 32} x.bin") == "HAVE_UNSUPPORTED"
+
+
+def test_repeated_upload_is_linked(start_server, tmp_path):
+    server = start_server("--dedup", "--no-local")
+    (tmp_path / "a.txt").write_text("same content")
+    server.client("upload", tmp_path / "a.txt", "one.txt")
+    record = server.client("upload", tmp_path / "a.txt", "two.txt")[0]
+    assert record["ok"]
+    assert (server.base / "two.txt").read_text() == "same content"
+    assert os.stat(server.base / "one.txt").st_ino == os.stat(server.base / "two.txt").st_ino
+
+
+def test_changed_object_is_not_linked(start_server, tmp_path):
+    server = start_server("--dedup", "--no-local")
+    data = b"real content"
+    digest = hashlib.md5(data).hexdigest()
+    obj_path = server.base / ".objects" / digest[:2] / digest
+    obj_path.parent.mkdir(parents=True)
+    obj_path.write_bytes(b"other bytes!")  # 对象被就地改动过，摘要已不符
+    assert server.ask(f"HAVE {digest} b.txt") == "HAVE_NO"
+    assert not obj_path.exists() and not (server.base / "b.txt").exists()
+
+    obj_path.write_bytes(b"other bytes!")
+    (tmp_path / "a.txt").write_bytes(data)
+    channel = server.channel()
+    assert channel.ask("UPLOAD a.txt") == "UPLOAD_READY"
+    assert channel.ask(data_line(0, data)) == "ACK_DATA 0"
+    assert channel.ask(f"UPLOAD_DONE {len(data)} {digest}") == "UPLOAD_COMPLETE"
+    assert (server.base / "a.txt").read_bytes() == data
+    assert obj_path.read_bytes() == data
+
+
+def test_prune_removes_unreferenced_objects(tmp_path):
+    store = ObjectStore(SimpleNamespace(objects_dir=tmp_path / ".objects"))
+    (tmp_path / "kept.txt").write_text("kept")
+    (tmp_path / "gone.txt").write_text("gone")
+    kept, gone = store.ingest(tmp_path / "kept.txt"), store.ingest(tmp_path / "gone.txt")
+    (tmp_path / "gone.txt").unlink()
+    assert store.prune() == 1
+    assert store.has(kept) and not store.has(gone)
@@ -0,0 +1,70 @@
+"""Read-ahead and write-behind file I/O used by the transfer paths"""
+import os
+
+import pytest
+
+from server import ReadAheadReader, WriteBehindWriter
+
+
+@pytest.mark.parametrize("size", [0, 1000, 5 * 64 * 1024 + 17])
+def test_read_ahead_returns_whole_file(tmp_path, size):
+    data = os.urandom(size)
+    (tmp_path / "f").write_bytes(data)
+    chunks = []
+    with ReadAheadReader(tmp_path / "f", block_size=64 * 1024, depth=2) as reader:
+        while True:
+            chunk = reader.read(10000)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    assert b"".join(chunks) == data
+
+
+def test_read_ahead_read_at(tmp_path):
+    data = os.urandom(300 * 1024)
+    (tmp_path / "f").write_bytes(data)
+    with ReadAheadReader(tmp_path / "f", block_size=64 * 1024) as reader:
+        assert reader.read_at(0, 100) == data[:100]
+        assert reader.read_at(200 * 1024, 100) == data[200 * 1024:200 * 1024 + 100]  # 跳过一段
+        assert reader.read_at(50, 10) == data[50:60]  # 回退时直接 pread
+
+
+def test_write_behind_coalesces_and_skips(tmp_path):
+    writer = WriteBehindWriter(tmp_path / "f", coalesce_size=4096)
+    parts = [os.urandom(1000) for _ in range(20)]
+    for part in parts[:10]:
+        writer.write(part)
+    writer.skip(8192)
+    for part in parts[10:]:
+        writer.write(part)
+    writer.skip(100)  # 结尾的零区
+    writer.close(fsync=True)
+    expected = b"".join(parts[:10]) + bytes(8192) + b"".join(parts[10:]) + bytes(100)
+    assert (tmp_path / "f").read_bytes() == expected
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_write_behind_allocate(tmp_path, sparse):
+    size = 1024 * 1024
+    writer = WriteBehindWriter(tmp_path / "f", coalesce_size=64 * 1024)
+    writer.allocate(size, sparse)
+    writer.write(b"head")
+    writer.skip(size - 8)
+    writer.write(b"tail")
+    writer.close()
+    path = tmp_path / "f"
+    assert path.stat().st_size == size
+    with path.open("rb") as f:
+        assert f.read(4) == b"head"
+        f.seek(size - 4)
+        assert f.read() == b"tail"
+    if sparse:
+        assert path.stat().st_blocks * 512 < size
+
+
+def test_write_behind_shorter_than_allocated(tmp_path):
+    writer = WriteBehindWriter(tmp_path / "f", coalesce_size=64 * 1024)
+    writer.allocate(1024 * 1024)
+    writer.write(b"x" * 10)
+    writer.close()
+    assert (tmp_path / "f").read_bytes() == b"x" * 10
@@ -0,0 +1,96 @@
+"""DOWNLOAD through the pool of pre-bound data ports"""
+import base64
+import hashlib
+import os
+import socket
+import threading
+import zlib
+
+from client import _perform_download
+
+
+def _port(reply: str) -> int:
+    parts = reply.split()
+    assert parts[0] == "OK" and parts[-2] == "PORT", reply
+    return int(parts[-1])
+
+
+def test_retransmitted_download_gets_same_port(server):
+    (server.base / "f.bin").write_bytes(os.urandom(5000))
+    channel = server.channel()
+    replies = [channel.ask("DOWNLOAD f.bin") for _ in range(3)]
+    assert len(set(replies)) == 1
+    assert replies[0].startswith("OK f.bin SIZE 5000 PORT ")
+
+    data_port = _port(replies[0])
+    assert channel.ask("DOWNLOAD f.bin", ("127.0.0.1", data_port)) == "DOWNLOAD_READY"
+    # 握手之后再请求同一文件就是新的下载
+    assert _port(channel.ask("DOWNLOAD f.bin")) != data_port
+
+
+def test_download_missing_file(server):
+    assert server.ask("DOWNLOAD missing.bin").startswith("ERR")
+
+
+def test_download_rejects_paths_outside_base(server):
+    (server.root / "secret.txt").write_text("secret")
+    (server.base / ".trash" / "old.txt").write_text("deleted")
+    assert server.ask("DOWNLOAD ../secret.txt") == "ERR ../secret.txt INVALID_PATH"
+    assert server.ask("DOWNLOAD .trash/old.txt") == "ERR .trash/old.txt INVALID_PATH"
+
+
+def test_downloads_of_many_files(server, tmp_path):
+    files = {f"f{i}.bin": os.urandom(3000 * (i + 1)) for i in range(6)}
+    for name, data in files.items():
+        (server.base / name).write_bytes(data)
+    script = "".join(f"download {name} {tmp_path / 'dl' / name}\n" for name in files)
+    records = server.client("--jobs", "6", "batch", "-", input=script)
+    assert records[-1]["ok"] == len(files)
+    for name, data in files.items():
+        assert (tmp_path / "dl" / name).read_bytes() == data
+
+
+def test_data_port_chunks_carry_checksums(server):
+    data = os.urandom(5000)
+    (server.base / "d.bin").write_bytes(data)
+    channel = server.channel()
+    data_address = ("127.0.0.1", _port(channel.ask("DOWNLOAD d.bin")))
+    assert channel.ask("DOWNLOAD d.bin", data_address) == "DOWNLOAD_READY"
+    reply = channel.ask("GET_CHUNK 2048", data_address)
+    assert channel.ask("GET_CHUNK 2048", data_address) == reply  # 重传得到同样的数据
+    kind, offset, crc, payload = reply.split()
+    body = base64.b64decode(payload)
+    assert (kind, int(offset)) == ("DATA", 2048)
+    assert int(crc, 16) == zlib.crc32(body) and body == data[2048:2048 + len(body)]
+    assert channel.ask("GET_CHUNK 5000", data_address) == f"TRANSFER_COMPLETE 5000 {hashlib.md5(data).hexdigest()}"
+
+
+def _serve_bad_download(sock, body: bytes):
+    """A data port that sends body but announces the wrong MD5 in TRANSFER_COMPLETE"""
+    while True:
+        try:
+            message, address = sock.recvfrom(8192)
+        except OSError:
+            return
+        command = message.decode()
+        if command.startswith("DOWNLOAD"):
+            reply = "DOWNLOAD_READY"
+        elif command == "GET_CHUNK 0":
+            reply = f"DATA 0 {zlib.crc32(body):08x} {base64.b64encode(body).decode()}"
+        else:
+            reply = f"TRANSFER_COMPLETE {len(body)} {'0' * 32}"
+        sock.sendto(reply.encode(), address)
+
+
+def test_failed_download_keeps_existing_file(tmp_path):
+    target = tmp_path / "f.txt"
+    target.write_text("previous version")
+    fake = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    fake.bind(("127.0.0.1", 0))
+    fake.settimeout(5)
+    threading.Thread(target=_serve_bad_download, args=(fake, b"new body"), daemon=True).start()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        assert not _perform_download(sock, fake.getsockname(), "f.txt", target, 8)
+    fake.close()
+    assert target.read_text() == "previous version"
+    assert [p.name for p in tmp_path.iterdir()] == ["f.txt"]
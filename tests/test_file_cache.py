@@ -0,0 +1,70 @@
+"""FileCache: LRU of whole files for the download path"""
+import mmap
+import os
+
+from server import BufferReader, FileCache
+
+
+def test_hit_and_invalidation(tmp_path):
+    cache = FileCache(budget_bytes=10 * 1024 * 1024)
+    path = tmp_path / "f"
+    path.write_bytes(b"one")
+    assert cache.get(path) == b"one"
+    assert cache.get(path) is cache.get(path)
+    path.write_bytes(b"three")  # 大小和 mtime 变化后重新读取
+    assert cache.get(path) == b"three"
+
+
+def test_large_files_are_mapped(tmp_path):
+    cache = FileCache(budget_bytes=8 * FileCache.MMAP_THRESHOLD)
+    path = tmp_path / "big"
+    data = os.urandom(FileCache.MMAP_THRESHOLD)
+    path.write_bytes(data)
+    buffer = cache.get(path)
+    assert isinstance(buffer, mmap.mmap)
+    assert buffer[:] == data
+
+
+def test_budget_evicts_least_recently_used(tmp_path):
+    cache = FileCache(budget_bytes=2500)
+    for name in "abc":
+        (tmp_path / name).write_bytes(name.encode() * 1000)
+    cache.get(tmp_path / "a")
+    cache.get(tmp_path / "b")
+    cache.get(tmp_path / "a")
+    cache.get(tmp_path / "c")  # b 最久未使用，被淘汰
+    assert cache.used_bytes == 2000
+    assert list(cache._entries) == [str(tmp_path / "a"), str(tmp_path / "c")]
+
+
+def test_files_over_half_the_budget_are_not_cached(tmp_path):
+    cache = FileCache(budget_bytes=1000)
+    (tmp_path / "f").write_bytes(b"x" * 600)
+    assert cache.get(tmp_path / "f") is None
+    assert cache.get(tmp_path / "missing") is None
+
+
+def test_maps_are_closed_once_evicted_and_released(tmp_path):
+    cache = FileCache(budget_bytes=2 * FileCache.MMAP_THRESHOLD)
+    for name in "abcd":
+        (tmp_path / name).write_bytes(os.urandom(FileCache.MMAP_THRESHOLD))
+    in_use, idle = cache.get(tmp_path / "a"), cache.get(tmp_path / "b")
+    cache.release(idle)
+    cache.release(cache.get(tmp_path / "c"))  # 淘汰 a，但它仍在被下载使用
+    assert not in_use.closed and not idle.closed
+    cache.release(cache.get(tmp_path / "d"))  # 淘汰 b
+    assert idle.closed and not in_use.closed
+    with BufferReader(in_use, cache.release) as reader:
+        assert len(reader.read(10)) == 10
+    assert in_use.closed
+
+
+def test_truncated_mapped_file_is_not_read_past_its_end(tmp_path):
+    cache = FileCache(budget_bytes=8 * FileCache.MMAP_THRESHOLD)
+    path = tmp_path / "big"
+    data = os.urandom(2 * FileCache.MMAP_THRESHOLD)
+    path.write_bytes(data)
+    with BufferReader(cache.get(path), cache.release) as reader:
+        os.truncate(path, 1000)  # 就地截断：读取旧末尾之后的页会触发 SIGBUS
+        assert reader.read_at(500, 1000) == data[500:1000]
+        assert reader.read_at(FileCache.MMAP_THRESHOLD, 1024) == b""
@@ -0,0 +1,64 @@
+"""Same-host fast path: file descriptors passed over the server's Unix socket"""
+import json
+import os
+
+import pytest
+
+from client import local_download, local_upload
+
+
+@pytest.fixture
+def local_server(start_server, tmp_path):
+    return start_server("--local-socket", tmp_path / "local.sock")
+
+
+def _session(channel):
+    kind, token, socket_path = channel.ask("LOCAL_HELLO").split()
+    assert kind == "LOCAL_OK"
+    return token, socket_path
+
+
+def test_put_and_get(local_server, tmp_path):
+    data = os.urandom(200_000)
+    (tmp_path / "src.bin").write_bytes(data)
+    channel = local_server.channel()
+    assert local_upload(_session(channel), tmp_path / "src.bin", "dst.bin")
+    assert (local_server.base / "dst.bin").read_bytes() == data
+    assert local_download(_session(channel), "dst.bin", tmp_path / "back.bin")
+    assert (tmp_path / "back.bin").read_bytes() == data
+    assert not list(tmp_path.glob(".*.part"))
+    counters = json.loads(local_server.ask("STATS"))["counters"]
+    assert counters['local_transfers_total{direction="download"}'] == 1
+
+
+def test_tokens_are_single_use_and_scoped(local_server, tmp_path):
+    (local_server.base / "f.txt").write_text("f")
+    channel = local_server.channel()
+    session = _session(channel)
+    assert local_download(session, "f.txt", tmp_path / "a.txt")
+    assert not local_download(session, "f.txt", tmp_path / "b.txt")  # 令牌只能用一次
+    assert not local_download(_session(channel), "../outside.txt", tmp_path / "c.txt")
+    assert not local_download(_session(channel), "missing.txt", tmp_path / "d.txt")
+    assert not (tmp_path / "b.txt").exists() and not (tmp_path / "d.txt").exists()
+
+
+def test_put_refused_while_folder_syncs(local_server, tmp_path):
+    (local_server.base / "synced").mkdir(parents=True)
+    (tmp_path / "src.txt").write_text("new")
+    syncer = local_server.channel()
+    assert syncer.ask("SYNC_START synced 1") == "SYNC_READY"
+    channel = local_server.channel()
+    assert not local_upload(_session(channel), tmp_path / "src.txt", "synced/new.txt")
+    assert not (local_server.base / "synced" / "new.txt").exists()
+    assert local_upload(_session(channel), tmp_path / "src.txt", "elsewhere.txt")
+
+
+def test_cli_uses_fast_path(local_server, tmp_path):
+    data = os.urandom(100_000)
+    (tmp_path / "v.bin").write_bytes(data)
+    assert local_server.client("upload", tmp_path / "v.bin", "v.bin")[0]["ok"]
+    assert local_server.client("download", "v.bin", tmp_path / "w.bin")[0]["ok"]
+    assert (tmp_path / "w.bin").read_bytes() == data
+    counters = json.loads(local_server.ask("STATS"))["counters"]
+    assert counters['local_transfers_total{direction="upload"}'] == 1
+    assert counters['local_transfers_total{direction="download"}'] == 1
@@ -0,0 +1,38 @@
+"""STATS and the Metrics registry shared by server and client"""
+import json
+
+from localsend_common import Metrics
+
+
+def test_stats_json_counts_requests(server, tmp_path):
+    (tmp_path / "a.txt").write_text("hello")
+    server.client("upload", tmp_path / "a.txt")
+    stats = json.loads(server.ask("STATS"))
+    assert stats["counters"]["packets_in_total"] > 0
+    assert stats["histograms"]['command_seconds{command="UPLOAD"}']["count"] >= 1
+    assert 'sessions{table="uploads"}' in stats["gauges"]
+
+
+def test_stats_prometheus(server):
+    text = server.ask("STATS PROM")
+    assert "udp_localsend_server_packets_in_total" in text
+    assert 'udp_localsend_server_command_seconds_bucket{command="STATS",le="+Inf"}' in text
+
+
+def test_metrics_registry(tmp_path):
+    metrics = Metrics("t")
+    metrics.inc("hits_total", kind="a")
+    metrics.inc("hits_total", 2, kind="a")
+    metrics.set_gauge("depth", 7)
+    for value in (0.001, 0.002, 3.0):
+        metrics.observe("latency", value)
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {'hits_total{kind="a"}': 3}
+    assert snapshot["gauges"] == {"depth": 7}
+    assert snapshot["histograms"]["latency"]["count"] == 3
+    assert snapshot["histograms"]["latency"]["p50"] == 0.0025
+
+    metrics.dump(tmp_path / "m.prom")
+    assert 't_hits_total{kind="a"} 3' in (tmp_path / "m.prom").read_text()
+    metrics.dump(tmp_path / "m.json")
+    assert json.loads((tmp_path / "m.json").read_text()) == snapshot
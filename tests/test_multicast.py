@@ -0,0 +1,63 @@
+"""MCAST_PUBLISH: one stream to the multicast group, received by every mcast-recv"""
+import base64
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import zlib
+
+from client import MCAST_CHUNK, MulticastReceiver
+from conftest import REPO_ROOT, free_port
+
+GROUP = "239.255.77.78"
+
+
+def _announce(sid, data, name, md5=None):
+    chunks = -(-len(data) // MCAST_CHUNK)
+    return f"MANNOUNCE {sid} {len(data)} {chunks} {md5 or hashlib.md5(data).hexdigest()} {name}".encode()
+
+
+def _mdata(sid, index, data):
+    chunk = data[index * MCAST_CHUNK:(index + 1) * MCAST_CHUNK]
+    return f"MDATA {sid} {index} {zlib.crc32(chunk):08x} ".encode() + base64.b64encode(chunk)
+
+
+def test_receiver_validates_packets(tmp_path):
+    data = os.urandom(3 * MCAST_CHUNK - 5)
+    source = ("127.0.0.1", 9)
+    with MulticastReceiver(f"{GROUP}:{free_port()}", "127.0.0.1", tmp_path) as receiver:
+        assert receiver._handle(b"MANNOUNCE s1 10 5 " + b"0" * 32 + b" f", source, 0) is None  # 块数不符
+        assert receiver._handle(_announce("s2", data, "f", md5="xyz"), source, 0) is None
+        assert receiver._handle(_announce("s3", data, ".."), source, 0) is None
+        assert not receiver.sessions
+        assert receiver._handle(_announce("s4", data, "../../escape.bin"), source, 0) is None
+        assert receiver.sessions["s4"]["tmp_path"].parent == tmp_path
+        corrupt = b"MDATA s4 0 00000000 " + base64.b64encode(data[:MCAST_CHUNK])
+        assert receiver._handle(corrupt, source, 0) is None and not receiver.sessions["s4"]["have"][0]
+        for index in (2, 0, 0, 1):
+            session = receiver._handle(_mdata("s4", index, data), source, 0)
+        result = receiver._finish(session)
+    assert result["ok"] and (tmp_path / "escape.bin").read_bytes() == data
+
+
+def test_publish_reaches_every_receiver(start_server, tmp_path):
+    port = free_port()
+    server = start_server("--no-local", "--mcast-group", GROUP, "--mcast-port", str(port),
+                          "--mcast-interface", "127.0.0.1")
+    data = os.urandom(300_000)
+    (server.base / "movie.bin").write_bytes(data)
+    receivers = [subprocess.Popen(
+        [sys.executable, str(REPO_ROOT / "client.py"), "mcast-recv", str(tmp_path / f"rx{i}"),
+         "--group", f"{GROUP}:{port}", "--interface", "127.0.0.1", "--wait", "15"],
+        stdout=subprocess.PIPE, text=True) for i in range(2)]
+    # 接收方稍后加入也没关系：MANNOUNCE 会在流结束前重复发送
+    reply = server.channel().ask("MCAST_PUBLISH movie.bin").split()
+    assert reply[0] == "MCAST_OK" and reply[2:] == [f"{GROUP}:{port}", "300000", str(-(-300_000 // MCAST_CHUNK))]
+    for i, receiver in enumerate(receivers):
+        out, _ = receiver.communicate(timeout=30)
+        records = [json.loads(line) for line in out.splitlines() if line.startswith("{")]
+        assert records[0]["ok"] and records[0]["name"] == "movie.bin"
+        assert (tmp_path / f"rx{i}" / "movie.bin").read_bytes() == data
+    assert server.ask("MCAST_PUBLISH ../x").startswith("ERR")
+    assert server.ask("MCAST_PUBLISH missing.bin") == "ERR_FILE_NOT_FOUND"
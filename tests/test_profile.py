@@ -0,0 +1,26 @@
+"""PROFILE ON/DUMP/STATUS/OFF and the client's --profile-dir"""
+import json
+
+
+def test_profile_command(start_server, tmp_path):
+    profile_dir = tmp_path / "profiles"
+    server = start_server("--no-local", "--profile-dir", profile_dir)
+    channel = server.channel()
+    assert json.loads(channel.ask("PROFILE STATUS"))["enabled"] is False
+    assert channel.ask("PROFILE ON MEM") == f"PROFILE_OK on {profile_dir}"
+    assert channel.ask("LIST_FILES").startswith("OK")
+    status = json.loads(channel.ask("PROFILE STATUS"))
+    assert status["enabled"] and status["memory"]
+
+    assert channel.ask("PROFILE DUMP").startswith("PROFILE_OK dumped")
+    assert any(profile_dir.glob("*.prof"))
+    assert any(profile_dir.glob("*.mem.txt"))
+    assert channel.ask("PROFILE OFF").startswith("PROFILE_OK off")
+    assert json.loads(channel.ask("PROFILE STATUS"))["enabled"] is False
+    assert channel.ask("PROFILE BOGUS").startswith("ERR_PROFILE")
+
+
+def test_client_profile_dir(server, tmp_path):
+    records = server.client("--profile-dir", tmp_path / "client-profiles", "ls")
+    assert records[0]["ok"]
+    assert any((tmp_path / "client-profiles").glob("*.prof"))
@@ -0,0 +1,53 @@
+"""RequestScheduler: control traffic first, upload chunks by weighted round robin"""
+from collections import Counter
+from types import SimpleNamespace
+
+from server import BULK_QUANTUM, RateLimiter, RequestScheduler, TokenBucket
+
+
+def _scheduler(weights=None, rate=0, rates=None):
+    config = SimpleNamespace(client_weights=weights or {}, client_rate_limit=rate, client_rate_limits=rates or {})
+    return RequestScheduler(config, RateLimiter(config))
+
+
+def _chunk(size=1000):
+    return b"DATA 0 00000000 " + b"A" * (size - 16)
+
+
+def test_control_requests_go_first():
+    scheduler = _scheduler()
+    for _ in range(3):
+        scheduler.push(_chunk(), ("10.0.0.1", 1000))
+    scheduler.push(b"LIST_FILES", ("10.0.0.2", 2000))
+    assert scheduler.queued() == (1, 3)
+    assert scheduler.pop() == (b"LIST_FILES", ("10.0.0.2", 2000))
+    assert [scheduler.pop()[1] for _ in range(3)] == [("10.0.0.1", 1000)] * 3
+    assert scheduler.pop() is None and scheduler.wait_time() is None
+
+
+def test_weighted_round_robin():
+    scheduler = _scheduler(weights={"10.0.0.1": 2.0})
+    for _ in range(200):
+        scheduler.push(_chunk(), ("10.0.0.1", 1000))
+        scheduler.push(_chunk(), ("10.0.0.2", 1000))
+    served = Counter(scheduler.pop()[1][0] for _ in range(10 * 3 * BULK_QUANTUM // 1000))
+    assert 1.8 < served["10.0.0.1"] / served["10.0.0.2"] < 2.2  # 每轮剩余的额度留到下一轮
+
+
+def test_rate_limited_host_is_passed_over():
+    scheduler = _scheduler(rates={"10.0.0.1": 16 * 1024})
+    for _ in range(40):
+        scheduler.push(_chunk(), ("10.0.0.1", 1000))
+    served = 0
+    while scheduler.pop():
+        served += 1
+    assert served == 16  # 令牌桶的突发额度用完
+    assert 0 < scheduler.wait_time() <= 0.1
+    scheduler.push(_chunk(), ("10.0.0.2", 1000))
+    assert scheduler.pop()[1] == ("10.0.0.2", 1000)  # 其他客户端不受影响
+
+
+def test_token_bucket():
+    bucket = TokenBucket(1024 * 1024)
+    assert bucket.idle() and bucket.try_consume(bucket.burst)
+    assert not bucket.try_consume(1000) and bucket.wait_time(1000) > 0
@@ -0,0 +1,41 @@
+"""TREE listings and recursive folder downloads (sdownload)"""
+import hashlib
+import time
+
+
+def _tree(channel, folder):
+    deadline = time.monotonic() + 5
+    while (reply := channel.ask(f"TREE {folder}")) == "TREE_BUILDING" and time.monotonic() < deadline:
+        time.sleep(0.05)  # 清单在后台线程中计算
+    return reply
+
+
+def test_tree_listing(server):
+    root = server.base / "pics"
+    (root / "a" / "b").mkdir(parents=True)
+    (root / "empty").mkdir()
+    (root / "a" / "b" / "x.jpg").write_bytes(b"x")
+    channel = server.channel()
+    assert _tree(channel, "pics") == "TREE_READY 1 4 /pics"
+    assert _tree(channel, "pics") == "TREE_READY 1 4 /pics"  # retransmission
+    records = channel.ask("GET_TREE_CHUNK 0").split("\n")
+    assert records == ["TREE_CHUNK 0", "D a", "D a/b", "D empty", f"F {hashlib.md5(b'x').hexdigest()} a/b/x.jpg"]
+    assert channel.ask("GET_TREE_CHUNK 1") == "ERR_NO_TREE_LISTING"
+    assert channel.ask("TREE_DONE") == "TREE_DONE_OK"
+    assert channel.ask("GET_TREE_CHUNK 0") == "ERR_NO_TREE_LISTING"
+    assert channel.ask("TREE ..").startswith("TREE_ERR")
+    assert channel.ask("TREE missing").startswith("TREE_ERR")
+
+
+def test_sdownload_roundtrip(server, tmp_path):
+    root = server.base / "music"
+    files = {f"artist{i}/album{j}/track.flac": f"{i}/{j}".encode() * 500 for i in range(4) for j in range(3)}
+    for rel_path, data in files.items():
+        (root / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel_path).write_bytes(data)
+    (root / "empty").mkdir()
+    records = server.client("sdownload", "music", tmp_path / "dl")
+    assert records[0]["ok"], records
+    for rel_path, data in files.items():
+        assert (tmp_path / "dl" / rel_path).read_bytes() == data
+    assert (tmp_path / "dl" / "empty").is_dir()
@@ -0,0 +1,77 @@
+"""SessionTable: per-client state bounded by an idle TTL and a size cap"""
+import json
+import os
+
+import pytest
+
+import server as server_module
+from server import LocalState, SessionTable, SharedState
+from test_upload import _partials, data_line
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_idle_entries_expire(clock):
+    evicted = []
+    table = SessionTable("t", ttl=10, max_sessions=100, on_evict=lambda key, value: evicted.append(key))
+    table["a"], table["b"] = 1, 2
+    clock[0] += 6
+    assert table.get("a") == 1  # 使用会刷新空闲时间
+    clock[0] += 6
+    assert "b" not in table and table.get("a") == 1
+    clock[0] += 11
+    assert table.sweep() == 1 and len(table) == 0
+    assert evicted == ["b", "a"]
+
+
+def test_least_recently_used_is_evicted(clock):
+    evicted = []
+    table = SessionTable("t", ttl=10, max_sessions=2, on_evict=lambda key, value: evicted.append((key, value)))
+    table["a"], table["b"] = 1, 2
+    table.get("a")
+    table["c"] = 3
+    assert evicted == [("b", 2)] and sorted(table.values()) == [1, 3]
+    assert table.pop("a") == 1 and evicted == [("b", 2)]  # pop 不调用 on_evict
+    with pytest.raises(KeyError):
+        table["a"]
+
+
+def test_evicted_upload_is_cleaned_up(start_server):
+    server = start_server("--no-local", "--max-sessions", "2")
+    first = server.channel()
+    assert first.ask("UPLOAD a.txt") == "UPLOAD_READY"
+    assert first.ask(data_line(0, b"abc")) == "ACK_DATA 0"
+    for name in ("b.txt", "c.txt"):
+        assert server.channel().ask(f"UPLOAD {name}") == "UPLOAD_READY"
+    assert first.ask(data_line(3, b"def")) == "ERR_NO_UPLOAD_SESSION"
+    assert len(_partials(server.base)) == 2  # 被淘汰会话的临时文件已删除
+    counters = json.loads(server.ask("STATS"))["counters"]
+    assert counters['sessions_evicted_total{reason="lru",table="uploads"}'] == 1
+
+
+def test_md5_cache_is_bounded(monkeypatch, tmp_path):
+    monkeypatch.setattr(server_module, "MD5_CACHE_ENTRIES", 2)
+    state = LocalState()
+    st = os.stat(tmp_path)
+    for name in "abc":
+        state.store_md5(tmp_path / name, st, name * 32)
+    assert len(state.md5_cache) == 2
+    assert state.cached_md5(tmp_path / "a", st) is None and state.cached_md5(tmp_path / "c", st) == "c" * 32
+
+
+def test_shared_md5_cache_drops_stale_rows(monkeypatch, tmp_path):
+    monkeypatch.setattr(server_module, "MD5_CACHE_ENTRIES", 2)
+    state = SharedState(tmp_path / "state.db")
+    st = os.stat(tmp_path)
+    for name in "abcd":
+        state.store_md5(tmp_path / name, st, name * 32)
+    state._query("UPDATE md5_cache SET used = used - ? WHERE path = ?",
+                 (server_module.MD5_CACHE_TTL + 1, str(tmp_path / "d")))
+    state._query("UPDATE md5_cache SET used = used - 10 WHERE path = ?", (str(tmp_path / "a"),))
+    state.sweep()
+    assert sorted(row[0] for row in state._query("SELECT md5 FROM md5_cache")) == ["b" * 32, "c" * 32]
@@ -0,0 +1,50 @@
+"""Sparse files: UPLOAD_SIZE preallocation and ZERO runs in both directions"""
+import hashlib
+
+from test_download import _port
+from test_upload import data_line
+
+
+def test_upload_size_and_zero_runs(server):
+    channel = server.channel()
+    assert channel.ask("UPLOAD z.bin") == "UPLOAD_READY"
+    assert channel.ask("UPLOAD_SIZE 100000 SPARSE") == "ACK_SIZE 100000"
+    assert channel.ask("UPLOAD_SIZE 10 HOLEY") == "ERR_INVALID_UPLOAD_SIZE"
+    assert channel.ask(data_line(0, b"head")) == "ACK_DATA 0"
+    assert channel.ask("ZERO 4 99992") == "ACK_DATA 4"
+    assert channel.ask("ZERO 4 99992") == "ACK_DATA 4"  # retransmission
+    assert channel.ask("ZERO 99996 0") == "NACK_DATA MALFORMED"
+    assert channel.ask(data_line(99996, b"tail")) == "ACK_DATA 99996"
+    expected = b"head" + bytes(99992) + b"tail"
+    assert channel.ask(f"UPLOAD_DONE 100000 {hashlib.md5(expected).hexdigest()}") == "UPLOAD_COMPLETE"
+    assert (server.base / "z.bin").read_bytes() == expected
+
+
+def test_download_sends_zero_runs(server):
+    edge = bytes(range(1, 251)) * 4  # 不含零字节，空洞边界是确定的
+    data = edge + bytes(200_000) + edge
+    (server.base / "z.bin").write_bytes(data)
+    channel = server.channel()
+    data_address = ("127.0.0.1", _port(channel.ask("DOWNLOAD z.bin")))
+    assert channel.ask("DOWNLOAD z.bin", data_address) == "DOWNLOAD_READY"
+    assert channel.ask("GET_CHUNK 0", data_address).startswith("DATA 0 ")
+    # 全零区段只回复长度
+    assert channel.ask("GET_CHUNK 1000", data_address) == "ZERO 1000 200000"
+    assert channel.ask("GET_CHUNK 201000", data_address).startswith("DATA 201000 ")
+
+
+def test_cli_roundtrip_keeps_holes(server, tmp_path):
+    size = 8 * 1024 * 1024
+    source = tmp_path / "hole.bin"
+    with source.open("wb") as f:
+        f.write(b"start")
+        f.seek(size - 3)
+        f.write(b"end")
+    assert server.client("upload", source, "hole.bin")[0]["ok"]
+    uploaded = server.base / "hole.bin"
+    assert uploaded.read_bytes() == source.read_bytes()
+    assert uploaded.stat().st_blocks * 512 < size
+
+    assert server.client("download", "hole.bin", tmp_path / "back.bin")[0]["ok"]
+    assert (tmp_path / "back.bin").read_bytes() == source.read_bytes()
+    assert (tmp_path / "back.bin").stat().st_blocks * 512 < size
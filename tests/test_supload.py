@@ -0,0 +1,43 @@
+"""supload: folder structure sent as batches of SUPLOAD_META records"""
+import socket
+
+from client import SUPLOAD_META_BYTES, _supload_batches, handle_super_upload
+
+
+def test_meta_batches_create_structure(server):
+    channel = server.channel()
+    assert channel.ask("SUPLOAD_BEGIN album") == "SUPLOAD_READY"
+    batch = "SUPLOAD_META 0\nD a\nD a/b\nF a/b/c.txt\nF ../escape.txt\nD /abs"
+    assert channel.ask(batch) == "META_OK 0 SKIP 3,4"
+    assert channel.ask(batch) == "META_OK 0 SKIP 3,4"  # retransmission
+    assert channel.ask("SUPLOAD_META 1\nF d/e.txt") == "META_OK 1"
+    assert channel.ask("SUPLOAD_COMPLETE") == "SUPLOAD_OK"
+    root = server.base / "album"
+    assert (root / "a" / "b").is_dir() and (root / "d").is_dir()
+    assert not (server.base / "escape.txt").exists()
+    assert channel.ask("SUPLOAD_META 2\nD x") == "ERR_NO_SUPLOAD_SESSION"
+
+
+def test_batches_fit_one_packet():
+    records = [f"F dir/file_{i:05d}.txt" for i in range(2000)]
+    batches = list(_supload_batches(records))
+    assert len(batches) > 1
+    assert [record for batch in batches for record in batch] == records
+    assert all(len("\n".join(batch).encode()) <= SUPLOAD_META_BYTES for batch in batches)
+
+
+def test_supload_uploads_tree(server, tmp_path):
+    source = tmp_path / "photos"
+    files = {f"y{year}/m{month}/p.jpg": f"{year}-{month}".encode() for year in range(3) for month in range(4)}
+    for rel_path, data in files.items():
+        (source / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (source / rel_path).write_bytes(data)
+    (source / "empty").mkdir()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        handle_super_upload(sock, server.address, str(source))
+    finally:
+        sock.close()
+    for rel_path, data in files.items():
+        assert (server.base / "photos" / rel_path).read_bytes() == data
+    assert (server.base / "photos" / "empty").is_dir()
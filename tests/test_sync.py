@@ -0,0 +1,30 @@
+"""SYNC_START / SYNC_CHUNK / SYNC_FINISH: the manifest is compared on a builder thread"""
+import hashlib
+import json
+import time
+
+
+def _finish(channel):
+    deadline = time.monotonic() + 5
+    while (reply := channel.ask("SYNC_FINISH")) == "SYNC_PROCESSING" and time.monotonic() < deadline:
+        time.sleep(0.05)  # 目标目录在后台线程中扫描
+    return reply
+
+
+def test_sync_finish_is_polled_until_processed(server):
+    (server.base / "dst").mkdir()
+    (server.base / "dst" / "same.txt").write_text("same")
+    (server.base / "dst" / "stale.txt").write_text("stale")
+    manifest = {"same.txt": hashlib.md5(b"same").hexdigest(), "new.txt": hashlib.md5(b"new").hexdigest()}
+    channel = server.channel()
+    assert channel.ask("SYNC_START dst 1") == "SYNC_READY"
+    assert channel.ask(f"SYNC_CHUNK 0/1\n{json.dumps(manifest)}") == "ACK_CHUNK 0"
+    assert _finish(channel) == "NEEDS_FILES_READY 1"
+    assert channel.ask("SYNC_FINISH") == "NEEDS_FILES_READY 1"  # retransmission
+    assert json.loads(channel.ask("GET_SYNC_CHUNK 0"))["files"] == ["new.txt"]
+    assert not (server.base / "dst" / "stale.txt").exists()
+    assert server.channel().ask("SYNC_START dst 1") == "SYNC_READY"  # 处理完成后锁已释放
+
+
+def test_sync_finish_without_session(server):
+    assert server.ask("SYNC_FINISH") == "ERR_NO_SYNC_SESSION"
@@ -0,0 +1,46 @@
+"""Several sync pairs run concurrently by `sync run`, `sync auto` and the CLI"""
+import json
+
+from client import CONFIG_FILE, SYNC_MAX_BACKOFF, SyncScheduler
+
+
+def _pairs(tmp_path, count):
+    pairs = []
+    for i in range(count):
+        local = tmp_path / f"local{i}"
+        local.mkdir()
+        (local / f"f{i}.txt").write_text(f"pair {i}")
+        pairs.append({"id": i + 1, "local_path": str(local), "remote_path": f"r{i}"})
+    return pairs
+
+
+def test_run_once_syncs_every_pair(server, tmp_path, capsys):
+    pairs = _pairs(tmp_path, 3)
+    pairs.append({"id": 4, "local_path": str(tmp_path / "missing"), "remote_path": "r3"})
+    assert SyncScheduler(server.address, workers=4).run_once(pairs) == 1  # 一个同步对失败，其余不受影响
+    for i in range(3):
+        assert (server.base / f"r{i}" / f"f{i}.txt").read_text() == f"pair {i}"
+    capsys.readouterr()
+
+
+def test_failed_pairs_back_off():
+    scheduler = SyncScheduler(("127.0.0.1", 9))
+    item = {"id": 1, "interval": 2}
+    scheduler._finished(item, False)
+    scheduler._finished(item, False)
+    assert scheduler._delay(item) == 8
+    for _ in range(20):
+        scheduler._finished(item, False)
+    assert scheduler._delay(item) == SYNC_MAX_BACKOFF
+    scheduler._finished(item, True)
+    assert scheduler._delay(item) == 2
+
+
+def test_cli_sync_runs_configured_pairs(server, tmp_path):
+    pairs = _pairs(tmp_path, 3)
+    pairs[2]["ignore"] = ["*.txt"]
+    (tmp_path / CONFIG_FILE).write_text(json.dumps(pairs))
+    record = server.client("sync", cwd=tmp_path)[0]
+    assert record["ok"] and len(record["pairs"]) == 3
+    assert (server.base / "r0" / "f0.txt").exists() and (server.base / "r1" / "f1.txt").exists()
+    assert not (server.base / "r2" / "f2.txt").exists()
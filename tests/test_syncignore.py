@@ -0,0 +1,44 @@
+"""IgnoreRules and .syncignore: excluded paths are neither uploaded nor deleted"""
+from localsend_common import SYNCIGNORE_FILE, IgnoreRules, walk_tree
+
+
+def test_gitignore_style_patterns():
+    rules = IgnoreRules(["# comment", "*.log", "build/", "/top.txt", "docs/**/*.tmp", "!keep.log", "\\!bang"])
+    assert rules.ignored("a.log", False) and rules.ignored("x/y/a.log", False)
+    assert not rules.ignored("keep.log", False)  # 最后匹配的规则生效
+    assert rules.ignored("build", True) and not rules.ignored("build", False)
+    assert rules.ignored("top.txt", False) and not rules.ignored("sub/top.txt", False)
+    assert rules.ignored("docs/a.tmp", False) and rules.ignored("docs/a/b/c.tmp", False)
+    assert rules.ignored("!bang", False)
+    assert rules.patterns == ["*.log", "build/", "/top.txt", "docs/**/*.tmp", "!keep.log", "\\!bang"]
+    assert not IgnoreRules(["# only a comment", ""])
+
+
+def test_rules_for_sync_root(tmp_path):
+    (tmp_path / SYNCIGNORE_FILE).write_text("*.bak\ncache/\n")
+    rules = IgnoreRules.for_sync_root(tmp_path, ignore=["*.tmp"], include=["important.bak"])
+    assert rules.patterns == ["*.tmp", "*.bak", "cache/", "!important.bak"]
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "cache" / "x").write_text("x")
+    for name in ("a.txt", "a.tmp", "a.bak", "important.bak"):
+        (tmp_path / name).write_text(name)
+    found = sorted(entry.rel_path for entry in walk_tree(tmp_path, rules))
+    assert found == [SYNCIGNORE_FILE, "a.txt", "important.bak"]
+
+
+def test_sync_skips_ignored_paths(server, tmp_path):
+    local = tmp_path / "local"
+    (local / "build").mkdir(parents=True)
+    (local / "build" / "out.o").write_text("object")
+    (local / "main.c").write_text("int main;")
+    (local / SYNCIGNORE_FILE).write_text("build/\n*.swp\n")
+    remote = server.base / "proj"
+    remote.mkdir(parents=True)
+    (remote / "notes.swp").write_text("server side, ignored")
+    (remote / "stale.c").write_text("removed locally")
+
+    assert server.client("sync", local, "proj")[0]["ok"]
+    assert (remote / "main.c").read_text() == "int main;"
+    assert not (remote / "build").exists()
+    assert (remote / "notes.swp").exists()  # 被忽略的路径在服务器端也不会删除
+    assert not (remote / "stale.c").exists()
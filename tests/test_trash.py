@@ -0,0 +1,50 @@
+"""KILL_SERVER_FILES and sync deletes go through the trash bin"""
+import hashlib
+import time
+from types import SimpleNamespace
+
+from server import TrashBin
+from test_upload import data_line
+
+
+def _wait_empty(directory):
+    deadline = time.monotonic() + 5
+    while any(directory.iterdir()) and time.monotonic() < deadline:
+        time.sleep(0.05)  # 回收在后台线程中进行
+    return not any(directory.iterdir())
+
+
+def test_discard_and_reclaim(tmp_path):
+    trash = TrashBin(SimpleNamespace(trash_dir=tmp_path / ".trash"))
+    trash.root.mkdir()
+    (tmp_path / "tree" / "a").mkdir(parents=True)
+    (tmp_path / "tree" / "a" / "f").write_text("f")
+    (tmp_path / "file").write_text("x")
+    assert trash.discard(tmp_path / "tree") and trash.discard(tmp_path / "file")
+    assert trash.discard(tmp_path / "missing")
+    assert not (tmp_path / "tree").exists() and len(list(trash.root.iterdir())) == 2
+    trash.reclaim()
+    assert not any(trash.root.iterdir())
+
+
+def test_kill_moves_everything_to_trash(server):
+    (server.base / "a" / "b").mkdir(parents=True)
+    (server.base / "a" / "b" / "f.txt").write_text("f")
+    (server.base / "top.txt").write_text("t")
+    assert server.ask("KILL_SERVER_FILES").startswith("KILL_OK")
+    assert [path.name for path in server.base.iterdir()] == [".trash"]
+    assert _wait_empty(server.base / ".trash")
+
+
+def test_kill_keeps_directory_with_upload_in_progress(server):
+    (server.base / "docs").mkdir(parents=True)
+    (server.base / "other.txt").write_text("o")
+    channel = server.channel()
+    assert channel.ask("UPLOAD docs/new.txt") == "UPLOAD_READY"
+    assert channel.ask(data_line(0, b"data")) == "ACK_DATA 0"
+    assert server.ask("KILL_SERVER_FILES") == "KILL_ERR Could not delete: docs"
+    assert not (server.base / "other.txt").exists()
+    assert channel.ask(f"UPLOAD_DONE 4 {hashlib.md5(b'data').hexdigest()}") == "UPLOAD_COMPLETE"
+    assert (server.base / "docs" / "new.txt").read_bytes() == b"data"
+    assert server.ask("KILL_SERVER_FILES").startswith("KILL_OK")
+    assert not (server.base / "docs").exists()
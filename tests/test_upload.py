@@ -0,0 +1,95 @@
+"""UPLOAD / DATA / UPLOAD_DONE: uploads land atomically after verification"""
+import base64
+import hashlib
+import os
+import time
+import zlib
+
+
+def data_line(offset: int, body: bytes) -> str:
+    return f"DATA {offset} {zlib.crc32(body):08x} {base64.b64encode(body).decode()}"
+
+
+def test_upload_replaces_target_after_verification(server):
+    (server.base / "f.txt").write_text("old")
+    channel = server.channel()
+    body = b"new contents"
+    assert channel.ask("UPLOAD f.txt") == "UPLOAD_READY"
+    assert channel.ask(data_line(0, body)) == "ACK_DATA 0"
+    assert (server.base / "f.txt").read_text() == "old"  # 完成之前旧版本不变
+    assert "f.txt" in channel.ask("LIST_FILES").split() and ".part" not in channel.ask("LIST_FILES")
+    done = f"UPLOAD_DONE {len(body)} {hashlib.md5(body).hexdigest()}"
+    assert channel.ask(done) == "UPLOAD_COMPLETE"
+    assert channel.ask(done) == "UPLOAD_COMPLETE"  # retransmission
+    assert (server.base / "f.txt").read_bytes() == body
+    assert not list(server.base.glob(".*.part"))
+
+
+def test_digest_mismatch_keeps_old_version(server):
+    (server.base / "f.txt").write_text("old")
+    channel = server.channel()
+    body = b"corrupted?"
+    assert channel.ask("UPLOAD f.txt") == "UPLOAD_READY"
+    channel.ask(data_line(0, body))
+    assert channel.ask(f"UPLOAD_DONE {len(body)} {'0' * 32}").startswith("UPLOAD_FAILED")
+    assert (server.base / "f.txt").read_text() == "old"
+    assert not list(server.base.glob(".*.part"))
+
+
+def test_size_mismatch(server):
+    channel = server.channel()
+    assert channel.ask("UPLOAD g.txt") == "UPLOAD_READY"
+    channel.ask(data_line(0, b"abc"))
+    assert channel.ask(f"UPLOAD_DONE 4 {hashlib.md5(b'abc').hexdigest()}").startswith("UPLOAD_FAILED")
+    assert not (server.base / "g.txt").exists()
+
+
+def _partials(base):
+    return [path for path in base.rglob("*.part") if ".trash" not in path.parts]
+
+
+def test_stale_temp_files_are_swept_at_start(start_server, tmp_path):
+    base = tmp_path / "srv0" / "serverfile"
+    (base / "a").mkdir(parents=True)
+    (base / ".x.1234.part").write_text("left over")
+    (base / "a" / ".y.local1.part").write_text("left over")
+    (base / "a" / "keep.txt").write_text("keep")
+    start_server("--no-local")
+    deadline = time.monotonic() + 5
+    while _partials(base) and time.monotonic() < deadline:
+        time.sleep(0.05)  # 清理在后台线程中进行
+    assert not _partials(base)
+    assert (base / "a" / "keep.txt").read_text() == "keep"
+
+
+def test_cli_upload_roundtrip(server, tmp_path):
+    data = os.urandom(300_000)
+    (tmp_path / "v.bin").write_bytes(data)
+    assert server.client("upload", tmp_path / "v.bin", "v.bin")[0]["ok"]
+    assert (server.base / "v.bin").read_bytes() == data
+
+
+def test_data_checksums_and_offsets(server):
+    channel = server.channel()
+    body = b"hello world"
+    assert channel.ask("UPLOAD c.txt") == "UPLOAD_READY"
+    assert channel.ask(data_line(0, body)) == "ACK_DATA 0"
+    assert channel.ask(data_line(0, body)) == "ACK_DATA 0"  # duplicate
+    corrupt = f"DATA 11 00000000 {base64.b64encode(body).decode()}"
+    assert channel.ask(corrupt) == "NACK_DATA 11 CHECKSUM"
+    assert channel.ask(data_line(50, body)) == "NACK_DATA 11 GAP"
+    assert channel.ask(f"UPLOAD_DONE 11 {hashlib.md5(body).hexdigest()}") == "UPLOAD_COMPLETE"
+    assert (server.base / "c.txt").read_bytes() == body
+
+
+def test_late_chunks_after_commit_are_acknowledged(server):
+    channel = server.channel()
+    body = b"late"
+    assert channel.ask("UPLOAD l.txt") == "UPLOAD_READY"
+    assert channel.ask(data_line(0, body)) == "ACK_DATA 0"
+    assert channel.ask(f"UPLOAD_DONE 4 {hashlib.md5(body).hexdigest()}") == "UPLOAD_COMPLETE"
+    # 调度器先处理 UPLOAD_DONE，重复的数据块可能在提交之后才到达
+    assert channel.ask(data_line(0, body)) == "ACK_DATA 0"
+    assert channel.ask("ZERO 4 10") == "ACK_DATA 4"
+    assert (server.base / "l.txt").read_bytes() == body
+    assert server.ask("UPLOAD_DONE 4 " + "0" * 32) == "UPLOAD_FAILED NO_SESSION"
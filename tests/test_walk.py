@@ -0,0 +1,46 @@
+"""walk_tree: scandir-based parallel tree walker"""
+import os
+
+from localsend_common import walk_tree
+
+
+def _make_tree(root):
+    expected = set()
+    for i in range(20):
+        for j in range(3):
+            directory = root / f"d{i}" / f"e{j}"
+            directory.mkdir(parents=True)
+            (directory / "f.txt").write_text(f"{i}{j}")
+            expected |= {f"d{i}", f"d{i}/e{j}", f"d{i}/e{j}/f.txt"}
+    return expected
+
+
+def test_matches_os_walk(tmp_path):
+    expected = _make_tree(tmp_path)
+    entries = list(walk_tree(tmp_path, workers=4))
+    assert len(entries) == len(expected)
+    assert {entry.rel_path for entry in entries} == expected
+    walked = {os.path.relpath(os.path.join(top, name), tmp_path).replace(os.sep, "/")
+              for top, dirs, files in os.walk(tmp_path) for name in dirs + files}
+    assert walked == expected
+    entry = next(entry for entry in entries if entry.rel_path == "d3/e1/f.txt")
+    st = os.stat(entry.path)
+    assert not entry.is_dir and (entry.st_size, entry.st_mtime_ns) == (st.st_size, st.st_mtime_ns)
+
+
+def test_skip_and_non_recursive(tmp_path):
+    _make_tree(tmp_path)
+    (tmp_path / "top.txt").write_text("x")
+    top = {entry.rel_path for entry in walk_tree(tmp_path, recursive=False)}
+    assert top == {f"d{i}" for i in range(20)} | {"top.txt"}
+    kept = {entry.rel_path for entry in walk_tree(tmp_path, skip=lambda rel_path, is_dir: rel_path != "d0"
+                                                  and rel_path.count("/") == 0 and is_dir)}
+    assert kept == {"top.txt", "d0", "d0/e0", "d0/e1", "d0/e2", "d0/e0/f.txt", "d0/e1/f.txt", "d0/e2/f.txt"}
+
+
+def test_symlinked_directories_are_not_followed(tmp_path):
+    (tmp_path / "real").mkdir()
+    (tmp_path / "real" / "f").write_text("f")
+    (tmp_path / "link").symlink_to(tmp_path / "real")
+    found = {entry.rel_path: entry.is_dir for entry in walk_tree(tmp_path)}
+    assert found == {"real": True, "real/f": False, "link": True}
@@ -0,0 +1,27 @@
+"""--workers: several processes on one port sharing client state through SQLite"""
+import asyncio
+import os
+
+from client import AsyncClient
+
+
+def test_workers_share_directories_and_files(start_server, tmp_path):
+    server = start_server("--no-local", "--workers", "2")
+    (server.base / "shared").mkdir(parents=True, exist_ok=True)
+    files = {f"f{i}.bin": os.urandom(10000) for i in range(12)}
+    for name, data in files.items():
+        (tmp_path / name).write_bytes(data)
+
+    async def run():
+        async with AsyncClient("127.0.0.1", server.port) as client:
+            await client.cd("shared")
+            # 每个操作使用新的端口，内核会把它们分散到不同的 worker
+            await asyncio.gather(*(client.upload(tmp_path / name, name) for name in files))
+            listed = await asyncio.gather(*(client.list() for _ in range(6)))
+            paths = await asyncio.gather(*(client.download(name, tmp_path / "dl" / name) for name in files))
+        return listed, paths
+
+    listed, paths = asyncio.run(run())
+    assert all(sorted(entries) == sorted(files) for entries in listed)
+    for path in paths:
+        assert path.read_bytes() == files[path.name]